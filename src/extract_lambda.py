@@ -2,31 +2,229 @@
 
 import json
 import boto3
-from datetime import datetime
-from pg8000.native import identifier
+from datetime import datetime, timedelta
+from pg8000.native import identifier, literal
 from botocore.exceptions import ClientError
 import logging
-from decimal import Decimal  # Added to handle Decimal values
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import partial
+import hashlib
+from array import array
+from bisect import bisect_left
 
 try:  # nosec   # noqa
-    from src.utils import connect_to_database  # nosec  # noqa
+    from src.utils import (  # nosec  # noqa
+        connect_to_database,
+        get_connection,
+        LAYOUTS,
+        combine_entries,
+        load_continuation,
+        manifest_entry,
+        out_of_time,
+        save_continuation,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from utils import (  # nosec  # noqa
+        connect_to_database,
+        get_connection,
+        LAYOUTS,
+        combine_entries,
+        load_continuation,
+        manifest_entry,
+        out_of_time,
+        save_continuation,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+try:  # nosec  # noqa
+    from src.extract_tables import (  # nosec  # noqa
+        DEFAULT_EXTRACTION_TIME,
+        EXTRACT_LAYOUT,
+        TABLE_LIST,
+        TIMESTAMP_FORMAT,
+        WATERMARK_COLUMNS,
+        attach_snapshot,
+        begin_repeatable_read,
+        build_range_query,
+        changed_since,
+        column_modifiers,
+        column_types,
+        export_snapshot,
+        extraction_filepaths,
+        get_prepared_statement,
+        get_table_columns,
+        max_watermark,
+        primary_key,
+        read_json_object,
+        run_table_query,
+        select_list,
+        statement_columns,
+        table_spec,
+        updated_range,
+        write_run_manifest,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_tables import (  # nosec  # noqa
+        DEFAULT_EXTRACTION_TIME,
+        EXTRACT_LAYOUT,
+        TABLE_LIST,
+        TIMESTAMP_FORMAT,
+        WATERMARK_COLUMNS,
+        attach_snapshot,
+        begin_repeatable_read,
+        build_range_query,
+        changed_since,
+        column_modifiers,
+        column_types,
+        export_snapshot,
+        extraction_filepaths,
+        get_prepared_statement,
+        get_table_columns,
+        max_watermark,
+        primary_key,
+        read_json_object,
+        run_table_query,
+        select_list,
+        statement_columns,
+        table_spec,
+        updated_range,
+        write_run_manifest,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+try:  # nosec  # noqa
+    from src.extract_encoders import (  # nosec  # noqa
+        COPY_FORMAT,
+        ENCODER_CONTENT_TYPES,
+        EXTRACT_FORMAT,
+        EXTRACT_FORMATS,
+        S3MultipartWriter,
+        gzip_compressor,
+        make_encoder,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_encoders import (  # nosec  # noqa
+        COPY_FORMAT,
+        ENCODER_CONTENT_TYPES,
+        EXTRACT_FORMAT,
+        EXTRACT_FORMATS,
+        S3MultipartWriter,
+        gzip_compressor,
+        make_encoder,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+try:  # nosec  # noqa
+    from src.extract_planner import (  # nosec  # noqa
+        diagnose,
+        plan_extraction,
+        record_plan,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_planner import (  # nosec  # noqa
+        diagnose,
+        plan_extraction,
+        record_plan,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+try:  # nosec  # noqa
+    from src.extract_cdc import (  # nosec  # noqa
+        CDC_MAX_CHANGES,
+        advance_replication_slot,
+        extract_changes,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_cdc import (  # nosec  # noqa
+        CDC_MAX_CHANGES,
+        advance_replication_slot,
+        extract_changes,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+try:  # nosec  # noqa
+    from src.extract_reconcile import (  # nosec  # noqa
+        pk_snapshot_key,
+        reconcile,
+    )
 except:  # nosec  # noqa
     pass  # nosec # noqa
 
 try:  # nosec  # noqa
-    from utils import connect_to_database  # nosec  # noqa
+    from extract_reconcile import (  # nosec  # noqa
+        pk_snapshot_key,
+        reconcile,
+    )
 except:  # nosec   # noqa
     pass  # nosec  # noqa
 
 logger = logging.getLogger("extract_logger")
 logger.setLevel(logging.INFO)
 
+STREAM_CHUNK_SIZE = 10000
+EXTRACT_WORKERS = 1
+# Tables extracted with COPY ... TO STDOUT by default; see copy_table
+COPY_TABLES = ()
+COPY_OPTIONS = "FORMAT csv, HEADER true, NULL '\\N', FORCE_QUOTE *"
+WATERMARK_KEY = "watermarks/current.json"
+# Held by the run being extracted, so an overlapping execution doesn't extract the same
+# delta again; see acquire_run_lease
+RUN_LEASE_KEY = "runs/lease.json"
+RUN_LEASE_SECONDS = 1800
+# S3's answers to a conditional put that lost
+LEASE_CONFLICTS = ("PreconditionFailed", "ConditionalRequestConflict")
+BACKFILL_RANGE_SIZE = 50000
+BACKFILL_CHECKPOINT_KEY = "backfill/checkpoint.json"
+BACKFILL_TIME_MARGIN_MS = 60000
+# Parts handed on to transform at a time; see backfill_increment
+BACKFILL_HANDOFF_PARTS = 20
+ROW_HASH_PREFIX = "row_hashes"
+# Source load budget, e.g. {"rows_per_second": 50000, "max_queries": 2, "latency_ms": 500,
+# "tables": {"sales_order": {...}}}; see Throttle. None extracts flat out.
+EXTRACT_BUDGET = None
+EXTRACT_PLAN = False
+THROTTLE_MAX_BACKOFF = 8
+# COPY messages (rows) counted between throttle checks
+COPY_THROTTLE_ROWS = 1000
+
 
 def lambda_handler(event, context):
     """
     AWS Lambda handler to fetch data extraction times, write data from source database to S3,
     and return the filepaths of this data to pass on to next lambda.
 
+    Each table is extracted from its own watermark (see write_data for the event options). # noqa
+    The new watermarks are only staged; the state machine commits them with
+    {"action": "commit_watermarks"} once transform and load have succeeded. "mode" picks
+    "cdc", "backfill", "reconcile" or "diagnose" instead of the incremental scan. A run that
+    runs short of time returns {"status": "in-progress", "continuation": token} and carries
+    on when invoked again with the token. A backfill increment is returned with "resume"
+    instead, to be invoked with once it has been transformed and loaded. Only one run extracts
+    at a time (see acquire_run_lease); another one started meanwhile is a no-op.
+
     Args:
         event (dict): EventBridge trigger metadata
         context (object): AWS Lambda context object: empty
@@ -36,60 +234,462 @@ def lambda_handler(event, context):
     """
 
     s3_client = boto3.client("s3")
-    db = connect_to_database()
-    time_result = get_time(s3_client)
-    last_extraction_time = time_result[0]
-    this_extraction_time = time_result[1]
-    result = write_data(last_extraction_time, this_extraction_time, s3_client, db)
+    if event.get("action") == "commit_watermarks":
+        return commit_watermarks(
+            s3_client, event["pending_watermarks"], connect=get_connection
+        )
+
+    connect_started = time.perf_counter()
+    db = get_connection()
+    connect_ms = round((time.perf_counter() - connect_started) * 1000, 1)
+    logger.info(f"Database connection ready in {connect_ms} ms.")
+    this_extraction_time = str(datetime.now())
+    continuation = event.get("continuation")
+    state = {}
+    if continuation:
+        state = load_continuation(
+            s3_client, "totes-extract-bucket-20250227154810549900000003", continuation
+        )
+        event, this_extraction_time = state["event"], state["run"]
+
+    if event.get("mode") != "diagnose" and not acquire_run_lease(
+        s3_client, this_extraction_time
+    ):
+        result = {
+            "status": "no-op",
+            "filepaths": [],
+            "pending_watermarks": None,
+            "metrics": {"connect_ms": connect_ms},
+        }
+        print(result)
+        return result
+
+    if event.get("mode") == "cdc":
+        result = extract_changes(
+            db,
+            s3_client,
+            this_extraction_time,
+            get_watermarks(s3_client, TABLE_LIST),
+            max_changes=event.get("max_changes", CDC_MAX_CHANGES),
+            extract_format=event.get("extract_format", EXTRACT_FORMAT),
+            layout=event.get("layout", EXTRACT_LAYOUT),
+        )
+        db.rollback()
+        result["pending_watermarks"] = stage_watermarks(
+            s3_client,
+            result["watermarks"],
+            this_extraction_time,
+            row_hashes=dict.fromkeys(result["watermarks"]),
+            cdc=result["cdc"],
+        )
+        result["metrics"] = {"connect_ms": connect_ms}
+        print(result)
+        return result
+
+    if event.get("mode") == "reconcile":
+        result = reconcile(
+            db,
+            s3_client,
+            this_extraction_time,
+            layout=event.get("layout", EXTRACT_LAYOUT),
+        )
+        db.rollback()
+        result["pending_watermarks"] = stage_watermarks(
+            s3_client, {}, this_extraction_time, pk_snapshots=result["pk_snapshots"]
+        )
+        result["metrics"] = {"connect_ms": connect_ms}
+        print(result)
+        return result
+
+    if event.get("mode") == "diagnose":
+        result = diagnose(
+            db,
+            s3_client,
+            this_extraction_time,
+            get_watermarks(s3_client, TABLE_LIST),
+        )
+        db.rollback()
+        result["pending_watermarks"] = None
+        result["metrics"] = {"connect_ms": connect_ms}
+        print(result)
+        return result
+
+    if event.get("mode") == "backfill":
+        result = backfill(
+            db,
+            s3_client,
+            context,
+            this_extraction_time,
+            range_size=event.get("range_size", BACKFILL_RANGE_SIZE),
+            extract_format=event.get("extract_format", EXTRACT_FORMAT),
+            layout=event.get("layout", EXTRACT_LAYOUT),
+            handoff_parts=event.get("handoff_parts", BACKFILL_HANDOFF_PARTS),
+            handed=state.get("handed"),
+        )
+        db.rollback()
+        result["pending_watermarks"] = None
+        if result["status"] == "in-progress":
+            token = save_continuation(
+                s3_client,
+                "totes-extract-bucket-20250227154810549900000003",
+                "extract",
+                this_extraction_time,
+                {
+                    "event": event,
+                    "run": this_extraction_time,
+                    "handed": result["handed"],
+                },
+            )
+            # an increment goes through transform and load before extract resumes
+            result["resume" if result["filepaths"] else "continuation"] = token
+        else:
+            if continuation:
+                s3_client.delete_object(
+                    Bucket="totes-extract-bucket-20250227154810549900000003",
+                    Key=continuation,
+                )
+            result["pending_watermarks"] = stage_watermarks(
+                s3_client,
+                result["watermarks"],
+                result["run"],
+                row_hashes=dict.fromkeys(result["watermarks"]),
+                lease=this_extraction_time,
+            )
+        result["metrics"] = {"connect_ms": connect_ms}
+        print(result)
+        return result
+
+    watermarks = state.get("watermarks") or get_watermarks(s3_client, TABLE_LIST)
+    stream = event.get("stream", DEFAULT_EXTRACTION_TIME in watermarks.values())
+    if not state and event.get("probe", True) and not probe_changes(db, watermarks):
+        db.rollback()
+        release_run_lease(s3_client, this_extraction_time)
+        logger.info("No changes since the last run.")
+        result = {
+            "status": "no-op",
+            "filepaths": [],
+            "watermarks": watermarks,
+            "pending_watermarks": None,
+            "metrics": {"connect_ms": connect_ms},
+        }
+        print(result)
+        return result
+    plan = state.get("plan")
+    if not state and event.get("plan", EXTRACT_PLAN):
+        plan = plan_extraction(
+            db, s3_client, watermarks, thresholds=event.get("plan_thresholds")
+        )
+    result = write_data(
+        watermarks,
+        this_extraction_time,
+        s3_client,
+        db,
+        stream=stream,
+        workers=event.get("workers", EXTRACT_WORKERS),
+        extract_format=event.get("extract_format", EXTRACT_FORMAT),
+        copy_tables=event.get("copy_tables", COPY_TABLES),
+        suppress_unchanged=event.get("suppress_unchanged", True),
+        layout=event.get("layout", EXTRACT_LAYOUT),
+        range_tables=event.get("range_tables"),
+        budget=event.get("budget", EXTRACT_BUDGET),
+        plan=plan,
+        context=context,
+        completed=state.get("partial"),
+    )
+    db.rollback()
+    if result["remaining"]:
+        metrics = {"connect_ms": connect_ms}
+        if "throttle" in result:
+            metrics["throttle"] = result.pop("throttle")
+        continuation = save_continuation(
+            s3_client,
+            "totes-extract-bucket-20250227154810549900000003",
+            "extract",
+            this_extraction_time,
+            {
+                "event": event,
+                "run": this_extraction_time,
+                "watermarks": watermarks,
+                "plan": plan,
+                "partial": result,
+            },
+        )
+        result = {
+            "status": "in-progress",
+            "continuation": continuation,
+            "filepaths": [],
+            "pending_watermarks": None,
+            "metrics": metrics,
+        }
+        print(result)
+        return result
+    if continuation:
+        s3_client.delete_object(
+            Bucket="totes-extract-bucket-20250227154810549900000003", Key=continuation
+        )
+    result["pending_watermarks"] = stage_watermarks(
+        s3_client,
+        result["watermarks"],
+        this_extraction_time,
+        row_hashes=result["row_hashes"],
+    )
+    result["metrics"] = {"connect_ms": connect_ms}
+    if "throttle" in result:
+        result["metrics"]["throttle"] = result.pop("throttle")
+    if plan:
+        record_plan(s3_client, this_extraction_time, plan, result)
+        result["metrics"]["plan"] = {
+            table: decision["strategy"] for table, decision in plan.items()
+        }
     print(result)
     return result
 
 
-def get_time(s3_client, bucketname="totes-extract-bucket-20250227154810549900000003"):
+def get_watermarks(
+    s3_client,
+    table_list,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+):  # noqa
     """
-    Retrieves the last data extraction time from S3 and updates it with the current time.
+    Retrieves the committed per-table watermarks from S3.
 
-    If the 'last_extraction_times.json' file exists, the function reads the last extraction time.
-    If it doesn't exist, it initializes the time with a default value. The current extraction time
-    is then appended, and the updated list is uploaded back to S3.
+    A watermark is the largest watermark column value extracted from a table by a run # noqa
+    that went on to load successfully. Tables with no watermark yet start from the default time, # noqa
+    unless the old 'last_extraction_times.json' exists, in which case its last entry is used.
 
     Args:
         s3_client (boto3.client): The S3 client instance.
+        table_list (list): The tables to return watermarks for.
         bucketname (str): The S3 bucket name. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
 
     Returns:
-        tuple: The last extraction time and the current extraction time.
+        dict: A dictionary mapping each table to its watermark string.
 
     Raises:
         ClientError: If there is an error accessing S3.
     """
+    try:
+        current = read_json_object(s3_client, bucketname, WATERMARK_KEY)
+        committed = current["tables"]
+        fallback = DEFAULT_EXTRACTION_TIME
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            logger.error("ERROR! Issues getting extraction time.")
+            raise
+        committed = {}
+        fallback = get_legacy_extraction_time(s3_client, bucketname)
+    return {table: committed.get(table, fallback) for table in table_list}
 
-    this_extraction_time = str(datetime.now())
-    last_extraction_times = []
+
+def get_legacy_extraction_time(s3_client, bucketname):
+    """Returns the last entry of the old 'last_extraction_times.json', or the default time."""
     try:
-        get_last_extraction_file = s3_client.get_object(
-            Bucket=bucketname, Key="last_extraction_times.json"
-        )
-        last_extraction_times = json.loads(
-            get_last_extraction_file["Body"].read().decode("utf-8")
-        )
-        last_extraction_time = str(last_extraction_times[-1])
+        times = read_json_object(s3_client, bucketname, "last_extraction_times.json")
+        return str(times[-1])
     except ClientError as e:
-        if e.response["Error"]["Code"] == "NoSuchKey":
-            last_extraction_time = "0001-01-01 00:00:00.000000"
-            last_extraction_times.append(last_extraction_time)
-            logger.error("ERROR! No most recent extraction time.")
-        else:
+        if e.response["Error"]["Code"] != "NoSuchKey":
             logger.error("ERROR! Issues getting extraction time.")
-            raise ClientError(e.response, e.operation_name)
-    last_extraction_times.append(this_extraction_time)
+            raise
+        logger.error("ERROR! No most recent extraction time.")
+        return DEFAULT_EXTRACTION_TIME
+
+
+def stage_watermarks(
+    s3_client,
+    watermarks,
+    this_extraction_time,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    row_hashes=None,
+    cdc=None,
+    pk_snapshots=None,
+    lease=None,
+):  # noqa
+    """
+    Writes the watermarks reached by this run to a pending object, to be committed later.
+
+    Args:
+        s3_client (boto3.client): The S3 client instance.
+        watermarks (dict): Table name to watermark string.
+        this_extraction_time (str): The timestamp of this run.
+        bucketname (str): The S3 bucket name. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        row_hashes (dict, optional): Table name to the key of its pending row hash index, committed alongside the watermarks, or to None to drop the table's index. # noqa
+        cdc (dict, optional): The replication "slot" and "lsn" consumed by a CDC run, advanced on commit. # noqa
+        pk_snapshots (dict, optional): Table name to the key of its pending primary key snapshot from a reconcile run. # noqa
+        lease (str, optional): The run holding the run lease, released on commit. Defaults to this_extraction_time. # noqa
+
+    Returns:
+        str: The key of the pending watermark object.
+    """
+    key = f"watermarks/pending/{this_extraction_time.replace(' ', 'T')}.json"
+    s3_client.put_object(
+        Bucket=bucketname,
+        Key=key,
+        Body=json.dumps(
+            {
+                "run": this_extraction_time,
+                "tables": watermarks,
+                "row_hashes": row_hashes or {},
+                "cdc": cdc,
+                "pk_snapshots": pk_snapshots or {},
+                "lease": lease or this_extraction_time,
+            }
+        ),
+        ContentType="application/json",
+    )
+    return key
+
+
+def commit_watermarks(
+    s3_client,
+    pending_key,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    connect=None,
+):  # noqa
+    """
+    Commits a run's pending watermarks once every downstream stage has succeeded.
+
+    The current watermark object only ever moves forward per table, so a late commit from an # noqa
+    older run can't rewind a newer one. Row hash indexes and primary key snapshots staged by the run replace the current ones # noqa
+    (an index staged as None is deleted, as the run wrote rows it didn't hash), # noqa
+    and a CDC run's replication slot is advanced past the changes it consumed. The committed run is also written to its own immutable # noqa
+    history segment, grouped by day, so history never has to be read back or rewritten. # noqa
+    Finally the run lease is released, so the next execution can extract.
+
+    Args:
+        s3_client (boto3.client): The S3 client instance.
+        pending_key (str): The key returned by stage_watermarks, or None for a run that staged nothing. # noqa
+        connect (callable, optional): Returns a database connection, used to advance the replication slot after a CDC run. # noqa
+        bucketname (str): The S3 bucket name. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+
+    Returns:
+        dict: The committed per-table watermarks under "watermarks".
+    """
+    if pending_key is None:
+        logger.info("No watermarks to commit.")
+        return {"watermarks": None}
+    pending = read_json_object(s3_client, bucketname, pending_key)
+    if pending.get("cdc"):
+        advance_replication_slot(connect(), **pending["cdc"])
+    try:
+        committed = read_json_object(s3_client, bucketname, WATERMARK_KEY)["tables"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        committed = {}
+    for table, watermark in pending["tables"].items():
+        committed[table] = max(watermark, committed.get(table, watermark))
+
+    run = pending["run"]
     s3_client.put_object(
         Bucket=bucketname,
-        Key="last_extraction_times.json",
-        Body=json.dumps(last_extraction_times),
+        Key=WATERMARK_KEY,
+        Body=json.dumps({"run": run, "tables": committed}),
         ContentType="application/json",
     )
-    return (last_extraction_time, this_extraction_time)
+    s3_client.put_object(
+        Bucket=bucketname,
+        Key=f"watermarks/history/{run[:10]}/{pending_key.split('/')[-1]}",
+        Body=json.dumps(pending),
+        ContentType="application/json",
+    )
+    dropped = [
+        table for table, key in pending.get("row_hashes", {}).items() if key is None
+    ]
+    for table in dropped:
+        s3_client.delete_object(Bucket=bucketname, Key=RowHashIndex.current_key(table))
+    staged = [
+        (RowHashIndex.current_key(table), key)
+        for table, key in pending.get("row_hashes", {}).items()
+        if key is not None
+    ] + [
+        (pk_snapshot_key(table), key)
+        for table, key in pending.get("pk_snapshots", {}).items()
+    ]
+    for current_key, staged_key in staged:
+        s3_client.copy_object(
+            Bucket=bucketname,
+            Key=current_key,
+            CopySource={"Bucket": bucketname, "Key": staged_key},
+        )
+        s3_client.delete_object(Bucket=bucketname, Key=staged_key)
+    s3_client.delete_object(Bucket=bucketname, Key=pending_key)
+    release_run_lease(s3_client, pending.get("lease", run), bucketname)
+    logger.info("Watermarks committed.")
+    return {"watermarks": committed}
+
+
+def acquire_run_lease(
+    s3_client,
+    run,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    now=None,
+):  # noqa
+    """
+    Takes, or renews, the lease that lets one run extract at a time.
+
+    EventBridge starts an execution every few minutes whether or not the last one has # noqa
+    finished, and watermarks only move when a run is committed, so an overlapping run would # noqa
+    extract (and load) the same delta again. The lease is created with a conditional put, so # noqa
+    only one run can take it. The run holding it renews it on every invocation, and a lease # noqa
+    left behind by a failed run can be taken over once it is RUN_LEASE_SECONDS old. It is # noqa
+    released by commit_watermarks.
+
+    Args:
+        s3_client (boto3.client): The S3 client instance.
+        run (str): The timestamp of the run taking the lease.
+        bucketname (str): The S3 bucket name. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        now (datetime, optional): The current time. Defaults to datetime.now().
+
+    Returns:
+        bool: Whether `run` holds the lease.
+    """
+    now = now or datetime.now()
+    expires = now + timedelta(seconds=RUN_LEASE_SECONDS)
+    put = partial(
+        s3_client.put_object,
+        Bucket=bucketname,
+        Key=RUN_LEASE_KEY,
+        Body=json.dumps({"run": run, "expires": expires.strftime(TIMESTAMP_FORMAT)}),
+        ContentType="application/json",
+    )
+    try:
+        put(IfNoneMatch="*")
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in LEASE_CONFLICTS:
+            raise
+    try:
+        response = s3_client.get_object(Bucket=bucketname, Key=RUN_LEASE_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        # released in the meantime
+        return acquire_run_lease(s3_client, run, bucketname, now)
+    lease = json.loads(response["Body"].read().decode("utf-8"))
+    if lease["run"] != run and lease["expires"] > now.strftime(TIMESTAMP_FORMAT):
+        logger.info(f"Run {lease['run']} holds the lease until {lease['expires']}.")
+        return False
+    try:
+        put(IfMatch=response["ETag"])
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in LEASE_CONFLICTS:
+            raise
+        return False
+    return True
+
+
+def release_run_lease(
+    s3_client, run, bucketname="totes-extract-bucket-20250227154810549900000003"
+):
+    """Deletes the run lease, if `run` still holds it."""
+    try:
+        lease = read_json_object(s3_client, bucketname, RUN_LEASE_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return
+    if lease.get("run") == run:
+        s3_client.delete_object(Bucket=bucketname, Key=RUN_LEASE_KEY)
 
 
 def write_data(
@@ -98,94 +698,1246 @@ def write_data(
     s3_client,
     db,
     bucketname="totes-extract-bucket-20250227154810549900000003",
+    stream=False,
+    chunk_size=STREAM_CHUNK_SIZE,
+    workers=1,
+    connect=None,
+    extract_format=EXTRACT_FORMAT,
+    copy_tables=(),
+    suppress_unchanged=False,
+    layout=EXTRACT_LAYOUT,
+    range_tables=None,
+    budget=None,
+    plan=None,
+    context=None,
+    completed=None,
 ):  # noqa
     """
     Extracts data from the database, formats it, and writes it to an S3 bucket.
 
     This function retrieves data from specified tables, filters records based on `last_extraction_time`,
     to get most recent data, formats it, and uploads it to an S3 bucket as a series of jsons. It organizes the files in directories based on year, # noqa
-    month, day, and time, and returns the file paths where the data is stored.
+    month, day, and time, and returns the file paths where the data is stored, along with the # noqa
+    largest watermark column value actually seen in each table as its new watermark.
+
+    When `stream` is True each table is read through a server-side cursor `chunk_size` rows at a time # noqa
+    and every serialized chunk is sent straight to an S3 multipart upload, so peak memory depends on # noqa
+    the chunk size rather than on the size of the table.
+
+    When `workers` is greater than 1 the tables are extracted in parallel, each worker on its own # noqa
+    connection from `connect`, all attached to one snapshot exported from `db` so the tables are # noqa
+    mutually consistent. Uploads run in the background while workers fetch their next table or chunk. # noqa
+
+    Only the columns declared in TABLE_REGISTRY are selected (see get_table_columns). # noqa
+
+    Tables in `copy_tables`, or registered with the "copy" strategy, skip Python row decoding entirely: PostgreSQL's own CSV output from # noqa
+    COPY ... TO STDOUT is gzipped straight into the S3 object (see copy_table). They are read # noqa
+    under a repeatable-read snapshot so the row count can be checked against a count(*).
+
+    Tables in `range_tables`, or registered with the "range" strategy, have their delta split # noqa
+    into primary key ranges (see key_ranges). Every range is read on its own connection, all # noqa
+    attached to one snapshot, and written as a numbered part, "{filepath}/part-00001" and so # noqa
+    on. Their manifest entry lists the parts (see combine_entries).
+
+    With a `budget`, every table's queries draw on a Throttle for the run, and on one of its # noqa
+    own if the budget has an entry for it under "tables"; what they were held back by is # noqa
+    returned under "throttle".
+
+    With `suppress_unchanged`, rows whose hash matches the table's RowHashIndex are dropped # noqa
+    before they are serialized; only the watermark still moves past them. The updated indexes # noqa
+    are written as pending objects for stage_watermarks. COPY and range tables aren't filtered, # noqa
+    and neither is any table without `suppress_unchanged`; their rows aren't hashed, so their # noqa
+    indexes are staged as None and dropped on commit rather than left to suppress a row that # noqa
+    has since changed back.
+
+    With a Lambda `context`, no table is started once the invocation is out of time (see # noqa
+    out_of_time). Tables that weren't finished are returned under "remaining" with their # noqa
+    watermarks unmoved and the run manifest isn't written; passing that result back as # noqa
+    `completed` carries on from where it stopped.
 
     Args:
-        last_extraction_time (str): The timestamp for the last data extraction.
+        last_extraction_time (str or dict): The timestamp for the last data extraction, or a dictionary of per-table watermarks. # noqa
         this_extraction_time (str): The timestamp for the current data extraction.
         s3_client (boto3.client): The S3 client instance used for uploading files.
         db (DatabaseClient): A database client instance for querying data.
         bucketname (str, optional): The name of the S3 bucket. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        stream (bool, optional): Use the chunked, streaming extraction mode. Defaults to False.
+        chunk_size (int, optional): Rows fetched per round trip in streaming mode. Defaults to STREAM_CHUNK_SIZE. # noqa
+        workers (int, optional): Size of the worker pool for parallel extraction. Defaults to 1.
+        connect (callable, optional): Opens a new database connection for each worker. Defaults to connect_to_database. # noqa
+        extract_format (str, optional): One of EXTRACT_FORMATS, recorded in each object's metadata. Defaults to EXTRACT_FORMAT. # noqa
+        copy_tables (iterable, optional): Tables to extract with COPY as COPY_FORMAT. Defaults to none. # noqa
+        suppress_unchanged (bool, optional): Drop rows that haven't changed since they were last extracted. Defaults to False. # noqa
+        layout (str, optional): One of LAYOUTS, see extraction_filepaths. Defaults to EXTRACT_LAYOUT. # noqa
+        range_tables (dict, optional): Table name to the number of key ranges to split it into, on top of the tables registered with the "range" strategy. Defaults to none. # noqa
+        budget (dict, optional): Rows and bytes per second, concurrent queries and latency target for the run, with per-table budgets under "tables" (see Throttle). Defaults to no limit. # noqa
+        plan (dict, optional): Table name to a plan_extraction decision, overriding `stream`, `copy_tables` and `range_tables` for that table. Defaults to none. # noqa
+        context (object, optional): The Lambda context, to stop before it times out. Defaults to none. # noqa
+        completed (dict, optional): A partial result returned earlier for the same run; its tables aren't extracted again. Defaults to none. # noqa
 
     Returns:
-        dict: A dictionary containing a list of file paths where the data was written in S3 for each table, all under key of "filepaths". # noqa
-    """
-    filepaths = []
-    table_list = [
-        "counterparty",
-        "currency",
-        "department",
-        "design",
-        "staff",
-        "sales_order",
-        "address",
-        # "payment",
-        # "purchase_order",
-        # "payment_type",
-        # "transaction",
-    ]
-    # Convert last_extraction_time to datetime for proper comparison
-    last_extraction_dt = datetime.strptime(last_extraction_time, "%Y-%m-%d %H:%M:%S.%f")
+        dict: A dictionary containing a list of file paths where the data was written in S3 for each table (or each part), all under key of "filepaths", # noqa
+              the per-table watermarks reached under "watermarks", rows dropped as unchanged under # noqa
+              "suppressed", the keys of pending row hash indexes (None for an index to drop) under "row_hashes", the # noqa
+              run manifest (see write_manifest) under "manifest", the milliseconds spent on # noqa
+              each table under "timings", the tables left unfinished under "remaining" and, # noqa
+              with a budget, the Throttle metrics under "throttle".
+    """
+    if extract_format not in EXTRACT_FORMATS:
+        raise ValueError(f"Unknown extract format: {extract_format}")
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout}")
+    table_list = TABLE_LIST
+    copy_tables = set(copy_tables) | {
+        table for table in table_list if table_spec(table)["strategy"] == "copy"
+    }
+    if isinstance(last_extraction_time, str):
+        last_extraction_time = {table: last_extraction_time for table in table_list}
+    completed = completed or {}
+    watermarks = {**last_extraction_time, **completed.get("watermarks", {})}
+    suppressed = dict(completed.get("suppressed", {}))
+    row_hashes = dict(completed.get("row_hashes", {}))
+    manifest = dict(completed.get("manifest", {}))
+    table_columns = get_table_columns(db, table_list)
 
-    for table in table_list:
-        columns_query = """SELECT column_name FROM information_schema.columns
-                            WHERE table_name = :table_name
-                            ORDER BY ordinal_position"""
-        columnsdata = db.run(columns_query, table_name=table)
-        columns = [row[0] for row in columnsdata]
-        query_string = f"""SELECT * FROM {identifier(table)}
-                           WHERE created_at > :last_extract_time
-                           OR last_updated > :last_extract_time"""  # nosec
-        data = db.run(query_string, last_extract_time=last_extraction_dt)
-
-        # Build list of dictionaries from rows and pre-format any datetime or Decimal objects
-        formatted = []
-        for row in data:
-            rec = dict(zip(columns, row))
-            for key, value in rec.items():
-                if isinstance(value, datetime):
-                    rec[key] = value.strftime("%Y-%m-%d %H:%M:%S.%f")
-                elif isinstance(value, Decimal):
-                    rec[key] = float(value)
-            formatted.append(rec)
-
-        months = {
-            "01": "January",
-            "02": "February",
-            "03": "March",
-            "04": "April",
-            "05": "May",
-            "06": "June",
-            "07": "July",
-            "08": "August",
-            "09": "September",
-            "10": "October",
-            "11": "November",
-            "12": "December",
+    filepaths = extraction_filepaths(this_extraction_time, table_list, layout)
+    range_tables = {
+        table: parts
+        for table, parts in {
+            **{
+                table: table_spec(table).get("parts", 1)
+                for table in table_list
+                if table_spec(table)["strategy"] == "range"
+            },
+            **dict(range_tables or {}),
+        }.items()
+        if table in table_list and table not in copy_tables and parts > 1
+    }
+    stream_tables = set(table_list) if stream else set()
+    for table, decision in (plan or {}).items():
+        copy_tables.discard(table)
+        range_tables.pop(table, None)
+        stream_tables.discard(table)
+        if decision["strategy"] == "copy":
+            copy_tables.add(table)
+        elif decision["strategy"] == "range":
+            range_tables[table] = decision["parts"]
+        elif decision["strategy"] == "stream":
+            stream_tables.add(table)
+    parts = {}
+    timings = dict(completed.get("timings", {}))
+    skipped = set()
+    watermarks_lock = threading.Lock()
+    run_throttle = Throttle.from_budget(budget)
+    table_budgets = (budget or {}).get("tables", {})
+    throttles = {
+        table: Throttle.from_budget(table_budgets.get(table), parent=run_throttle)
+        for table in table_list
+    }
+
+    def advance_watermark(table, watermark):
+        with watermarks_lock:
+            watermarks[table] = max(watermarks[table], watermark)
+
+    def drop_index(table):
+        # rows written without being hashed leave the table's index out of date
+        with watermarks_lock:
+            row_hashes[table] = None
+
+    def extract_table(conn, table, filepath, bounds=None, uploader=None):
+        columns = table_columns[table]
+        # Convert last_extraction_time to datetime for proper comparison
+        last_extraction_dt = datetime.strptime(
+            last_extraction_time[table], TIMESTAMP_FORMAT
+        )
+        params = {"last_extract_time": last_extraction_dt}
+        stats = manifest.setdefault(table, {})
+        throttle = throttles[table]
+        condition = ""
+        if bounds is not None:
+            condition, range_params = key_range_filter(table, bounds)
+            params.update(range_params)
+            stats = parts[table].setdefault(filepath, {})
+
+        def build_query(columns):
+            if not condition:
+                return f"""SELECT {select_list(columns)} FROM {identifier(table)}
+                           WHERE {changed_since(table)}"""  # nosec
+            return f"""SELECT {select_list(columns)} FROM {identifier(table)}
+                       WHERE ({changed_since(table)}){condition}"""  # nosec
+
+        query_string = build_query(columns)
+
+        if table in copy_tables:
+            _, watermarks[table] = copy_table(
+                conn,
+                table,
+                query_string,
+                last_extraction_dt,
+                s3_client,
+                bucketname,
+                filepath,
+                uploader=uploader,
+                watermark=last_extraction_time[table],
+                stats=stats,
+                throttle=throttle,
+            )
+            drop_index(table)
+            return None
+
+        watermark_columns = table_spec(table)["watermark_columns"]
+        index = None
+        if suppress_unchanged and bounds is None:
+            index = RowHashIndex.load(s3_client, bucketname, table)
+        else:
+            drop_index(table)
+
+        if table in stream_tables:
+            _, watermark = stream_table(
+                conn,
+                query_string,
+                params,
+                columns,
+                s3_client,
+                bucketname,
+                filepath,
+                chunk_size=chunk_size,
+                uploader=uploader,
+                extract_format=extract_format,
+                watermark=last_extraction_time[table],
+                watermark_columns=watermark_columns,
+                row_filter=index and partial(index.filter, table, columns),
+                stats=stats,
+                throttle=throttle,
+            )
+            advance_watermark(table, watermark)
+            save_index(table, index)
+            return None
+
+        with throttle.query():
+            data, columns, statement = run_table_query(
+                conn,
+                table,
+                query_string,
+                columns,
+                build_query=build_query,
+                snapshot=shared_snapshot,
+                **params,
+            )
+
+        advance_watermark(
+            table,
+            max_watermark(
+                columns, data, last_extraction_time[table], watermark_columns
+            ),
+        )
+        if index is not None:
+            data = index.filter(table, columns, data)
+            save_index(table, index)
+        types = column_types(statement)
+        encoder = make_encoder(
+            extract_format, columns, types, column_modifiers(statement)
+        )
+        body = encoder.encode(data) + encoder.finish()
+        throttle.consume(len(data), len(body))
+        stats.update(
+            manifest_entry(
+                filepath,
+                len(data),
+                len(body),
+                hashlib.sha256(body).hexdigest(),
+                [columns, types],
+                updated_range(columns, data, watermark_columns=watermark_columns),
+            )
+        )
+        put = partial(
+            s3_client.put_object,
+            Bucket=bucketname,
+            Key=filepath,
+            Body=body,
+            ContentType=encoder.content_type,
+            Metadata={"extract-format": extract_format},
+        )
+        return uploader.submit(put) if uploader else put()
+
+    def timed_extract(conn, table, filepath, bounds=None, uploader=None):
+        if out_of_time(context):
+            with watermarks_lock:
+                skipped.add(table)
+            return None
+        started = time.perf_counter()
+        try:
+            return extract_table(conn, table, filepath, bounds, uploader)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with watermarks_lock:
+                timings[table] = round(timings.get(table, 0) + elapsed, 1)
+
+    def save_index(table, index):
+        if index is None:
+            return
+        suppressed[table] = index.suppressed
+        if index.changes:
+            key = index.pending_key(table, this_extraction_time)
+            index.merged().save(s3_client, bucketname, key)
+            row_hashes[table] = key
+
+    jobs = []
+    range_counts = {}
+    for table, filepath in zip(table_list, filepaths):
+        if table in completed.get("manifest", {}):
+            continue
+        ranges = None
+        if table in range_tables:
+            ranges = key_ranges(
+                db, table, range_tables[table], last_extraction_time[table]
+            )
+        if ranges:
+            parts[table] = {}
+            range_counts[table] = len(ranges)
+            jobs += [
+                (table, f"{filepath}/part-{number:05d}", bounds)
+                for number, bounds in enumerate(ranges, 1)
+            ]
+        else:
+            jobs.append((table, filepath, None))
+
+    # every connection below reads from one exported (or, for COPY, one REPEATABLE READ) snapshot # noqa
+    shared_snapshot = bool(workers > 1 or parts or copy_tables)
+    if workers > 1 or parts:
+        extract_in_parallel(
+            db,
+            connect or connect_to_database,
+            jobs,
+            timed_extract,
+            # enough workers to scan every range of a table at once
+            max(workers, *range_counts.values(), 1),
+        )
+    else:
+        if copy_tables:
+            begin_repeatable_read(db)
+        for job in jobs:
+            timed_extract(db, *job)
+    for table in skipped:
+        watermarks[table] = last_extraction_time[table]
+        for finished in (manifest, parts, row_hashes, suppressed, timings):
+            finished.pop(table, None)
+    if suppressed:
+        logger.info(f"Unchanged rows suppressed: {suppressed}")
+    for table, written in parts.items():
+        manifest[table] = combine_entries(
+            filepaths[table_list.index(table)],
+            [written[key] for key in sorted(written)],
+        )
+    if skipped:
+        logger.info(f"Out of time, tables left for later: {sorted(skipped)}")
+    else:
+        manifest = write_run_manifest(
+            s3_client,
+            bucketname,
+            this_extraction_time,
+            filepaths,
+            {table: manifest[table] for table in table_list},
+            layout,
+        )
+        logger.info("Successfully written to bucket!")
+    result = {
+        "filepaths": completed.get("filepaths", [])
+        + [job[1] for job in jobs if job[0] not in skipped],
+        "watermarks": watermarks,
+        "suppressed": suppressed,
+        "row_hashes": row_hashes,
+        "manifest": manifest,
+        "timings": timings,
+        "remaining": sorted(skipped),
+    }
+    if budget:
+        result["throttle"] = {
+            "run": run_throttle.metrics(),
+            "tables": {
+                table: throttle.metrics()
+                for table, throttle in throttles.items()
+                if throttle is not run_throttle
+            },
         }
-        split = this_extraction_time.split("-")
-        year = split[0]
-        month = split[1]
-        split2 = split[2].split(" ")
-        day = split2[0]
-        time = split2[1]
-        monthstr = f"{month}-{months[month]}"
-        filepath = f"data/by time/{year}/{monthstr}/{day}/{time}/{table}"
-        filepaths.append(filepath)
+        logger.info(f"Throttling applied: {result['throttle']}")
+    return result
+
+
+def key_ranges(db, table, parts, watermark):
+    """
+    Splits a table's changed rows into `parts` primary key ranges of equal width.
+
+    The smallest and largest key changed since `watermark` are read in one query and the span # noqa
+    between them cut into `parts`. The first range has no lower bound and the last no upper # noqa
+    bound, so a row changed after the bounds were read still falls into one of them.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        table (str): The table name; its primary key must be an integer.
+        parts (int): The number of ranges wanted.
+        watermark (str): The table's watermark.
+
+    Returns:
+        list: (start, end) bounds for key_range_filter, None on an open end, or an empty list # noqa
+              if nothing changed.
+    """
+    pk = identifier(primary_key(table))
+    low, high = db.run(
+        f"SELECT min({pk}), max({pk}) FROM {identifier(table)} "  # nosec
+        f"WHERE {changed_since(table)}",
+        last_extract_time=datetime.strptime(watermark, TIMESTAMP_FORMAT),
+    )[0]
+    if low is None:
+        return []
+    width = max(-(-(high - low + 1) // parts), 1)
+    cuts = [low + width * n for n in range(1, parts) if low + width * n <= high]
+    return list(zip([None, *cuts], [*cuts, None]))
+
+
+def key_range_filter(table, bounds):
+    """
+    Returns the condition restricting a table's query to one of key_ranges' ranges.
+
+    Returns:
+        tuple: The SQL to append (starting with " AND") and its parameters.
+    """
+    pk = identifier(primary_key(table))
+    start, end = bounds
+    condition, params = "", {}
+    if start is not None:
+        condition += f" AND {pk} >= :range_start"
+        params["range_start"] = start
+    if end is not None:
+        condition += f" AND {pk} < :range_end"
+        params["range_end"] = end
+    return condition, params
+
+
+def probe_changes(db, watermarks, table_list=None):
+    """
+    Finds which tables have rows newer than their watermark, in one round trip.
+
+    The newest value of every table's watermark columns (see table_spec) is read with a # noqa
+    single UNION ALL query.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        watermarks (dict): Table name to watermark string.
+        table_list (list, optional): The tables to probe. Defaults to TABLE_LIST.
+
+    Returns:
+        dict: Table name to newest timestamp, for only the tables that changed.
+    """
+    table_list = table_list or TABLE_LIST
+    query_string = " UNION ALL ".join(
+        f"SELECT {literal(table)}, {newest_watermark(table)} "
+        f"FROM {identifier(table)}"  # nosec
+        for table in table_list
+    )
+    changed = {}
+    for table, latest in db.run(query_string):
+        if latest is None:
+            continue
+        latest = latest.strftime(TIMESTAMP_FORMAT)
+        if latest > watermarks.get(table, DEFAULT_EXTRACTION_TIME):
+            changed[table] = latest
+    return changed
+
+
+def newest_watermark(table):
+    """Returns the expression for the newest value of `table`'s watermark columns."""
+    newest = ", ".join(
+        f"max({identifier(column)})"
+        for column in table_spec(table)["watermark_columns"]
+    )
+    return f"greatest({newest})"
+
+
+def extract_in_parallel(db, connect, jobs, extract_table, workers):
+    """
+    Runs `extract_table` for every (table, filepath, bounds) job on a bounded pool of worker connections. # noqa
+
+    A REPEATABLE READ snapshot is exported from `db` and every worker connection attaches to it # noqa
+    before querying, so all tables are read as of the same instant. Each worker keeps one connection # noqa
+    for all the jobs it picks up. Uploads are handed to a separate pool so a worker can start its # noqa
+    next fetch while the previous object is still being sent.
+
+    Args:
+        db (DatabaseClient): The coordinating connection that exports the snapshot.
+        connect (callable): Opens a new database connection.
+        jobs (list): (table, filepath, bounds) jobs to extract.
+        extract_table (callable): Called as extract_table(conn, table, filepath, bounds, uploader). # noqa
+        workers (int): Maximum number of concurrent workers.
+
+    Returns:
+        None
+    """
+    snapshot_id = export_snapshot(db)
+    local = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def worker_connection():
+        if not hasattr(local, "conn"):
+            conn = connect()
+            attach_snapshot(conn, snapshot_id)
+            with connections_lock:
+                connections.append(conn)
+            local.conn = conn
+        return local.conn
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as uploader:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    pool.submit(
+                        lambda job: extract_table(worker_connection(), *job, uploader),
+                        job,
+                    )
+                    for job in jobs
+                ]
+                uploads = [future.result() for future in futures]
+            for upload in uploads:
+                if upload is not None:
+                    upload.result()
+    finally:
+        for conn in connections:
+            try:
+                conn.rollback()
+                conn.close()
+            except Exception as e:
+                logger.warning(f"Couldn't close worker connection cleanly: {e}")
+        db.rollback()
+
+
+class Throttle:
+    """
+    Token buckets limiting how hard an extraction leans on the source database.
+
+    Rows and bytes are drawn from buckets refilled at `rows_per_second` and `bytes_per_second` # noqa
+    and holding at most one second's worth. A caller that overdraws sleeps until the debt is # noqa
+    repaid, so small bursts go straight through and large chunks are spread out. At most # noqa
+    `max_queries` queries run against the source at once.
+
+    When a query takes longer than `latency_ms` the source is taken to be struggling and the # noqa
+    rates are halved, down to 1/THROTTLE_MAX_BACKOFF of the budget; every fast query wins a # noqa
+    quarter of the way back. A throttle with a `parent` (the run's budget, for a table's) draws # noqa
+    on both. A throttle with no limits does nothing.
+    """
+
+    def __init__(
+        self,
+        rows_per_second=None,
+        bytes_per_second=None,
+        max_queries=None,
+        latency_ms=None,
+        parent=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rates = {"rows": rows_per_second, "bytes": bytes_per_second}
+        self.tokens = {name: rate for name, rate in self.rates.items() if rate}
+        self.slots = threading.BoundedSemaphore(max_queries) if max_queries else None
+        self.latency_ms = latency_ms
+        self.parent = parent
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.refilled = clock()
+        self.backoff = 1.0
+        self.max_backoff = 1.0
+        self.waited = 0.0
+        self.queries = 0
+        self.slow_queries = 0
+
+    @classmethod
+    def from_budget(cls, budget, parent=None):
+        """Builds a throttle from a budget dict, or returns `parent` (or a no-op) without one."""  # noqa
+        if not budget:
+            return parent or cls()
+        return cls(
+            rows_per_second=budget.get("rows_per_second"),
+            bytes_per_second=budget.get("bytes_per_second"),
+            max_queries=budget.get("max_queries"),
+            latency_ms=budget.get("latency_ms"),
+            parent=parent,
+        )
+
+    @contextmanager
+    def query(self, observe=True):
+        """Holds a query slot while the block runs and, if `observe`, times it for backoff."""  # noqa
+        with ExitStack() as stack:
+            if self.parent is not None:
+                stack.enter_context(self.parent.query(observe))
+            if self.slots is not None:
+                queued = self.clock()
+                self.slots.acquire()
+                stack.callback(self.slots.release)
+                with self.lock:
+                    self.waited += self.clock() - queued
+            started = self.clock()
+            yield
+            if observe:
+                self.observe((self.clock() - started) * 1000)
+
+    def observe(self, latency_ms):
+        """Records a query's latency and adjusts the backoff."""
+        with self.lock:
+            self.queries += 1
+            if self.latency_ms is None:
+                return
+            if latency_ms > self.latency_ms:
+                self.slow_queries += 1
+                self.backoff = min(self.backoff * 2, THROTTLE_MAX_BACKOFF)
+                self.max_backoff = max(self.max_backoff, self.backoff)
+            else:
+                self.backoff = 1 + (self.backoff - 1) * 0.75
+
+    def consume(self, rows, byte_count=0):
+        """Draws rows and bytes from the buckets, sleeping off any overdraft."""
+        if self.parent is not None:
+            self.parent.consume(rows, byte_count)
+        if not self.tokens:
+            return
+        with self.lock:
+            now = self.clock()
+            elapsed = now - self.refilled
+            self.refilled = now
+            wait = 0.0
+            for name, amount in (("rows", rows), ("bytes", byte_count)):
+                if name not in self.tokens:
+                    continue
+                rate = self.rates[name] / self.backoff
+                self.tokens[name] = (
+                    min(self.tokens[name] + elapsed * rate, rate) - amount
+                )
+                if self.tokens[name] < 0:
+                    wait = max(wait, -self.tokens[name] / rate)
+            self.waited += wait
+        if wait:
+            self.sleep(wait)
+
+    def metrics(self):
+        """The throttling applied so far, for the run metrics."""
+        with self.lock:
+            return {
+                "throttled_ms": round(self.waited * 1000, 1),
+                "queries": self.queries,
+                "slow_queries": self.slow_queries,
+                "backoff": round(self.backoff, 2),
+                "max_backoff": self.max_backoff,
+            }
+
+
+def stream_table(
+    db,
+    query_string,
+    params,
+    columns,
+    s3_client,
+    bucketname,
+    key,
+    chunk_size=STREAM_CHUNK_SIZE,
+    cursor_name="extract_cursor",
+    uploader=None,
+    extract_format=EXTRACT_FORMAT,
+    watermark=DEFAULT_EXTRACTION_TIME,
+    row_filter=None,
+    stats=None,
+    throttle=None,
+    watermark_columns=WATERMARK_COLUMNS,
+):  # noqa
+    """
+    Streams the result of a query from a server-side cursor into an S3 object.
+
+    Rows are fetched `chunk_size` at a time with FETCH FORWARD, serialized, and handed to an # noqa
+    S3MultipartWriter, so only one chunk of rows and one upload part are held in memory at once. # noqa
+    Column types and numeric precision come from the query's prepared row description, so
+    the object is encoded exactly as the non-streaming path would encode it.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        query_string (str): The SELECT statement to run.
+        params (dict): Named parameters for the query.
+        columns (list): The column names returned by the query.
+        s3_client (boto3.client): The S3 client instance used for uploading files.
+        bucketname (str): The name of the S3 bucket.
+        key (str): The S3 object key to write.
+        chunk_size (int, optional): Rows fetched per round trip. Defaults to STREAM_CHUNK_SIZE.
+        cursor_name (str, optional): Name of the server-side cursor. Defaults to 'extract_cursor'. # noqa
+        uploader (Executor, optional): Uploads parts in the background while the next chunk is fetched. # noqa
+        extract_format (str, optional): One of EXTRACT_FORMATS. Defaults to EXTRACT_FORMAT.
+        watermark (str, optional): The table's watermark before this run. Defaults to DEFAULT_EXTRACTION_TIME. # noqa
+        row_filter (callable, optional): Applied to each chunk after the watermark is taken, to drop rows before they are written. # noqa
+        stats (dict, optional): Filled with the object's manifest_entry once it is written.
+        throttle (Throttle, optional): Every FETCH is run through it and its rows and bytes drawn from it. # noqa
+        watermark_columns (tuple, optional): The table's watermark columns (see table_spec). Defaults to WATERMARK_COLUMNS. # noqa
+
+    Returns:
+        tuple: The number of rows written and the table's new watermark.
+    """
+    throttle = throttle or Throttle()
+    writer = S3MultipartWriter(
+        s3_client,
+        bucketname,
+        key,
+        content_type=ENCODER_CONTENT_TYPES[extract_format],
+        metadata={"extract-format": extract_format},
+        uploader=uploader,
+    )
+    cursor = identifier(cursor_name)
+    row_count = 0
+    updated = (None, None)
+    encoder = None
+    try:
+        # the legacy connection has no row description with type modifiers of its own, so
+        # they are taken from the query prepared as it would be on the non-streaming path
+        statement = get_prepared_statement(db, query_string)
+        types, modifiers = column_types(statement), column_modifiers(statement)
+        declare = f"DECLARE {cursor} NO SCROLL CURSOR FOR {query_string}"  # nosec
+        db.run(declare, **params)
+        while True:
+            with throttle.query():
+                rows = db.run(f"FETCH FORWARD {int(chunk_size)} FROM {cursor}")  # nosec
+            if encoder is None:
+                if types is None:
+                    types, modifiers = column_types(db), column_modifiers(db)
+                encoder = make_encoder(extract_format, columns, types, modifiers)
+            if not rows:
+                break
+            watermark = max_watermark(columns, rows, watermark, watermark_columns)
+            if row_filter is not None:
+                rows = row_filter(rows)
+            encoded = encoder.encode(rows)
+            throttle.consume(len(rows), len(encoded))
+            writer.write(encoded)
+            updated = updated_range(columns, rows, updated, watermark_columns)
+            row_count += len(rows)
+        writer.write(encoder.finish())
+        db.run(f"CLOSE {cursor}")  # nosec
+        writer.close()
+        if stats is not None:
+            stats.update(
+                manifest_entry(
+                    key,
+                    row_count,
+                    writer.bytes_written,
+                    writer.checksum(),
+                    [columns, encoder.types],
+                    updated,
+                )
+            )
+    except Exception:
+        logger.error(f"ERROR! Failed to stream {key} to bucket.")
+        writer.abort()
+        raise
+    return row_count, watermark
+
+
+class RowHashIndex:
+    """
+    Sorted primary key -> 64-bit row hash index for one table, kept in S3 between runs.
+
+    Keys and hashes are two parallel stdlib arrays, 16 bytes a row, searched with bisect. # noqa
+    A row's hash covers every column except the watermark columns, so a row whose only change # noqa
+    is a bumped last_updated hashes the same and can be dropped. New hashes are collected in # noqa
+    `changes` and merged into a new index once the table is done.
+    """
+
+    def __init__(self, keys=None, hashes=None):
+        self.keys = keys if keys is not None else array("q")
+        self.hashes = hashes if hashes is not None else array("Q")
+        self.changes = {}
+        self.suppressed = 0
+
+    @staticmethod
+    def current_key(table):
+        return f"{ROW_HASH_PREFIX}/current/{table}.bin"
+
+    @staticmethod
+    def pending_key(table, this_extraction_time):
+        run = this_extraction_time.replace(" ", "T")
+        return f"{ROW_HASH_PREFIX}/pending/{run}/{table}.bin"
+
+    @classmethod
+    def load(cls, s3_client, bucketname, table):
+        """Reads a table's committed index, or returns an empty one if it has none yet."""
+        try:
+            response = s3_client.get_object(
+                Bucket=bucketname, Key=cls.current_key(table)
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return cls()
+        return cls.from_bytes(response["Body"].read())
+
+    @classmethod
+    def from_bytes(cls, data):
+        keys, hashes = array("q"), array("Q")
+        half = len(data) // 2
+        keys.frombytes(data[:half])
+        hashes.frombytes(data[half:])
+        return cls(keys, hashes)
+
+    def to_bytes(self):
+        return self.keys.tobytes() + self.hashes.tobytes()
+
+    def save(self, s3_client, bucketname, key):
         s3_client.put_object(
             Bucket=bucketname,
-            Key=filepath,
-            Body=json.dumps(formatted, indent=4),
-            ContentType="application/json",
+            Key=key,
+            Body=self.to_bytes(),
+            ContentType="application/octet-stream",
         )
-    logger.info("Successfully written to bucket!")
-    return {"filepaths": filepaths}
+
+    def get(self, key):
+        """Returns the stored hash for a primary key, or None."""
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.hashes[i]
+        return None
+
+    def filter(self, table, columns, rows):
+        """
+        Drops rows whose hash is already in the index and records the hashes of the rest. # noqa
+
+        Tables without a {table}_id column are passed through untouched.
+        """
+        pk = primary_key(table)
+        if pk not in columns:
+            return rows
+        pk_index = columns.index(pk)
+        watermark_columns = table_spec(table)["watermark_columns"]
+        positions = [
+            i for i, column in enumerate(columns) if column not in watermark_columns
+        ]
+        kept = []
+        for row in rows:
+            row_hash = hash_row(row, positions)
+            key = row[pk_index]
+            if self.changes.get(key, self.get(key)) == row_hash:
+                self.suppressed += 1
+                continue
+            self.changes[key] = row_hash
+            kept.append(row)
+        return kept
+
+    def merged(self):
+        """Returns a new index with `changes` merged in, still sorted by key."""
+        keys, hashes = array("q"), array("Q")
+        start = 0
+        for key, row_hash in sorted(self.changes.items()):
+            i = bisect_left(self.keys, key, start)
+            keys.extend(self.keys[start:i])
+            hashes.extend(self.hashes[start:i])
+            keys.append(key)
+            hashes.append(row_hash)
+            start = i + 1 if i < len(self.keys) and self.keys[i] == key else i
+        keys.extend(self.keys[start:])
+        hashes.extend(self.hashes[start:])
+        return RowHashIndex(keys, hashes)
+
+
+def hash_row(row, positions):
+    """Returns a 64-bit hash of the values of `row` at `positions`."""
+    values = repr(tuple(row[i] for i in positions)).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(values, digest_size=8).digest(), "little")
+
+
+def copy_table(
+    db,
+    table,
+    query_string,
+    last_extraction_dt,
+    s3_client,
+    bucketname,
+    key,
+    uploader=None,
+    watermark=DEFAULT_EXTRACTION_TIME,
+    stats=None,
+    throttle=None,
+):  # noqa
+    """
+    Extracts a table with COPY (...) TO STDOUT, gzipping PostgreSQL's CSV output into S3.
+
+    pg8000 hands each CopyData message straight to a CopySink, so no Python objects are built # noqa
+    per row. COPY can't take bind parameters, so the extraction time is inlined as a literal. # noqa
+    NULL is written as an unquoted \\N and every other value is quoted, so NULLs and empty # noqa
+    strings stay distinguishable. The column type oids go in the object's metadata for the # noqa
+    transform lambda to restore types.
+
+    A count(*) and the max watermark columns are read first with the same predicate. PostgreSQL # noqa
+    sends one CopyData message per row, so the rows written can be checked against the count; # noqa
+    `db` should be in a REPEATABLE READ transaction for the two to agree.
+
+    With a `throttle`, the count(*) query's latency drives its backoff and the CopySink draws # noqa
+    rows and bytes from it as they arrive; while it waits pg8000 stops reading the socket, so # noqa
+    the server is held back too.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        table (str): The table being extracted.
+        query_string (str): The table's SELECT, with a :last_extract_time parameter.
+        last_extraction_dt (datetime): The table's watermark before this run.
+        s3_client (boto3.client): The S3 client instance used for uploading files.
+        bucketname (str): The name of the S3 bucket.
+        key (str): The S3 object key to write.
+        uploader (Executor, optional): Uploads parts in the background.
+        watermark (str, optional): The table's watermark before this run. Defaults to DEFAULT_EXTRACTION_TIME. # noqa
+        stats (dict, optional): Filled with the object's manifest_entry once it is written.
+        throttle (Throttle, optional): Limits the load the copy puts on the source.
+
+    Returns:
+        tuple: The number of rows written and the table's new watermark.
+    """
+    throttle = throttle or Throttle()
+    statement = get_prepared_statement(db, query_string)
+    types = column_types(statement) or []
+    watermark_columns = table_spec(table)["watermark_columns"]
+    changed = ", ".join(identifier(column) for column in watermark_columns)
+    newest = ", ".join(f"max({identifier(column)})" for column in watermark_columns)
+    summary = f"""SELECT count(*), min(greatest({changed})), {newest}
+                  FROM ({query_string}) AS delta"""  # nosec
+    with throttle.query():
+        expected, oldest, *latest = db.run(
+            summary, last_extract_time=last_extraction_dt
+        )[0]
+    watermark = max_watermark(watermark_columns, [latest], watermark, watermark_columns)
+
+    since = literal(last_extraction_dt.strftime(TIMESTAMP_FORMAT))
+    select = query_string.replace(":last_extract_time", f"{since}::timestamp")
+    copy = f"COPY ({select}) TO STDOUT WITH ({COPY_OPTIONS})"  # nosec
+
+    writer = S3MultipartWriter(
+        s3_client,
+        bucketname,
+        key,
+        content_type=ENCODER_CONTENT_TYPES[COPY_FORMAT],
+        metadata={
+            "extract-format": COPY_FORMAT,
+            "column-types": ",".join(str(oid) for oid in types),
+        },
+        uploader=uploader,
+    )
+    sink = CopySink(writer, gzip_compressor(), throttle)
+    try:
+        with throttle.query(observe=False):
+            db.run(copy, stream=sink)
+        sink.finish()
+        row_count = sink.messages - 1  # the header
+        if row_count != expected:
+            raise ValueError(
+                f"COPY wrote {row_count} rows for {table}, count(*) found {expected}"
+            )
+        writer.close()
+        if stats is not None:
+            columns = statement_columns(statement) or []
+            newest = max(
+                (value for value in latest if isinstance(value, datetime)),
+                default=None,
+            )
+            updated = tuple(
+                (
+                    value.strftime(TIMESTAMP_FORMAT)
+                    if isinstance(value, datetime)
+                    else None
+                )
+                for value in (oldest, newest)
+            )
+            stats.update(
+                manifest_entry(
+                    key,
+                    row_count,
+                    writer.bytes_written,
+                    writer.checksum(),
+                    [columns, types],
+                    updated,
+                )
+            )
+    except Exception as e:
+        logger.error(f"ERROR! Failed to copy {table} to bucket: {e}")
+        writer.abort()
+        raise
+    return row_count, watermark
+
+
+class CopySink:
+    """
+    Compresses COPY output as it arrives and writes it on to `writer`.
+
+    Rows and bytes are drawn from `throttle` every COPY_THROTTLE_ROWS messages.
+    """
+
+    def __init__(self, writer, compressor, throttle=None):
+        self.writer = writer
+        self.compressor = compressor
+        self.throttle = throttle
+        self.messages = 0
+        self.unthrottled = [0, 0]
+
+    def write(self, data):
+        self.messages += 1
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.writer.write(compressed)
+        if self.throttle is not None:
+            self.unthrottled[0] += 1
+            self.unthrottled[1] += len(data)
+            if self.unthrottled[0] >= COPY_THROTTLE_ROWS:
+                self.throttle.consume(*self.unthrottled)
+                self.unthrottled = [0, 0]
+        return len(data)
+
+    def finish(self):
+        if self.throttle is not None and self.unthrottled[0]:
+            self.throttle.consume(*self.unthrottled)
+            self.unthrottled = [0, 0]
+        self.writer.write(self.compressor.flush())
+
+
+def backfill(
+    db,
+    s3_client,
+    context,
+    this_extraction_time,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    range_size=BACKFILL_RANGE_SIZE,
+    extract_format=EXTRACT_FORMAT,
+    table_list=None,
+    layout=EXTRACT_LAYOUT,
+    handoff_parts=BACKFILL_HANDOFF_PARTS,
+    handed=None,
+):  # noqa
+    """
+    Extracts whole tables in primary key ranges, checkpointing after every range.
+
+    Each table is read with keyset pagination (WHERE pk > last key ORDER BY pk LIMIT n) and # noqa
+    every page is written as its own part, "{filepath}/part-00001" and so on, under the same # noqa
+    run filepaths write_data would use. After each part the last key is saved to
+    BACKFILL_CHECKPOINT_KEY. When the Lambda gets within BACKFILL_TIME_MARGIN_MS of its # noqa
+    timeout it stops, and the next backfill invocation carries on from the checkpoint with # noqa
+    the original run's filepaths.
+
+    Parts are handed on to transform in increments of about `handoff_parts` (see # noqa
+    backfill_increment), so transform never has to read the whole backfill at once. Once an # noqa
+    increment is ready no more parts are written; the result is "in-progress" with the # noqa
+    increment's parts as "filepaths" and the parts handed on per table as "handed", which # noqa
+    the next invocation is given back once the increment has been loaded. Dependent tables # noqa
+    (address and counterparty, department and staff) are always handed on together.
+
+    The watermarks are the newest timestamps seen, capped at the database time when the # noqa
+    backfill started. Rows changed while it was running are picked up again by the next # noqa
+    incremental run.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        s3_client (boto3.client): The S3 client instance used for uploading files.
+        context (object): The Lambda context, used for the time remaining if it has one.
+        this_extraction_time (str): The timestamp of this invocation, used if no backfill is in progress. # noqa
+        bucketname (str, optional): The name of the S3 bucket. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        range_size (int, optional): Rows per part. Defaults to BACKFILL_RANGE_SIZE.
+        extract_format (str, optional): One of EXTRACT_FORMATS. Defaults to EXTRACT_FORMAT.
+        table_list (list, optional): The tables to backfill. Defaults to TABLE_LIST.
+        layout (str, optional): One of LAYOUTS, kept in the checkpoint so a resumed backfill stays in the layout it started in. Defaults to EXTRACT_LAYOUT. # noqa
+        handoff_parts (int, optional): Parts per increment. Defaults to BACKFILL_HANDOFF_PARTS. # noqa
+        handed (dict, optional): The "handed" of the last increment, once it has been loaded. Defaults to none. # noqa
+
+    Returns:
+        dict: "status" ("in-progress" or "complete"), the backfill's "run" time, the parts # noqa
+              handed on by this invocation as "filepaths", the parts handed on so far per # noqa
+              table as "handed" and, once complete, the "watermarks".
+    """
+    table_list = table_list or TABLE_LIST
+    try:
+        checkpoint = read_json_object(s3_client, bucketname, BACKFILL_CHECKPOINT_KEY)
+        logger.info(f"Resuming backfill from run {checkpoint['run']}.")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            logger.error("ERROR! Issues reading backfill checkpoint.")
+            raise
+        started = db.run("SELECT localtimestamp")[0][0]
+        checkpoint = {
+            "run": this_extraction_time,
+            "layout": layout,
+            "started": started.strftime(TIMESTAMP_FORMAT),
+            "tables": {
+                table: {
+                    "last_key": None,
+                    "parts": 0,
+                    "handed": 0,
+                    "done": False,
+                    "watermark": DEFAULT_EXTRACTION_TIME,
+                }
+                for table in table_list
+            },
+        }
+    for table, count in (handed or {}).items():
+        checkpoint["tables"][table]["handed"] = count
+
+    table_columns = get_table_columns(db, table_list)
+    table_filepaths = extraction_filepaths(
+        checkpoint["run"], table_list, checkpoint.get("layout", EXTRACT_LAYOUT)
+    )
+    written = 0
+    status = "complete"
+    for table, filepath in zip(table_list, table_filepaths):
+        progress = checkpoint["tables"][table]
+        pk = primary_key(table)
+        while not progress["done"]:
+            ready = backfill_increment(checkpoint, table_list, handoff_parts)
+            waiting = sum(
+                ready[table] - checkpoint["tables"][table]["handed"]
+                for table in table_list
+            )
+            if waiting >= handoff_parts or out_of_time(
+                context, BACKFILL_TIME_MARGIN_MS
+            ):
+                status = "in-progress"
+                break
+            key = progress["last_key"]
+            query_string = build_range_query(
+                table, key is not None, table_columns[table]
+            )
+            params = {"limit": range_size}
+            if key is not None:
+                params["after"] = key
+            rows, columns, statement = run_table_query(
+                db,
+                table,
+                query_string,
+                table_columns[table],
+                build_query=partial(build_range_query, table, key is not None),
+                **params,
+            )
+            table_columns[table] = columns
+
+            if rows or progress["parts"] == 0:
+                part = f"{filepath}/part-{progress['parts'] + 1:05d}"
+                encoder = make_encoder(
+                    extract_format,
+                    columns,
+                    column_types(statement),
+                    column_modifiers(statement),
+                )
+                s3_client.put_object(
+                    Bucket=bucketname,
+                    Key=part,
+                    Body=encoder.encode(rows) + encoder.finish(),
+                    ContentType=encoder.content_type,
+                    Metadata={"extract-format": extract_format},
+                )
+                written += 1
+                progress["parts"] += 1
+            if rows:
+                progress["last_key"] = rows[-1][columns.index(pk)]
+                progress["watermark"] = max_watermark(
+                    columns,
+                    rows,
+                    progress["watermark"],
+                    table_spec(table)["watermark_columns"],
+                )
+            progress["done"] = len(rows) < range_size
+            save_checkpoint(s3_client, bucketname, checkpoint)
+        if status != "complete":
+            break
+
+    ready = backfill_increment(checkpoint, table_list, handoff_parts)
+    if any(
+        ready[table] < progress["parts"]
+        for table, progress in checkpoint["tables"].items()
+    ):
+        status = "in-progress"
+    result = {
+        "filepaths": [
+            f"{filepath}/part-{n:05d}"
+            for table, filepath in zip(table_list, table_filepaths)
+            for n in range(checkpoint["tables"][table]["handed"] + 1, ready[table] + 1)
+        ],
+        "status": status,
+        "run": checkpoint["run"],
+        "handed": ready,
+    }
+    if status == "complete":
+        result["watermarks"] = {
+            table: min(progress["watermark"], checkpoint["started"])
+            for table, progress in checkpoint["tables"].items()
+        }
+        s3_client.delete_object(Bucket=bucketname, Key=BACKFILL_CHECKPOINT_KEY)
+        logger.info("Backfill complete.")
+    else:
+        logger.info(
+            f"Backfill paused after {written} parts, "
+            f"handing on {len(result['filepaths'])}."
+        )
+    return result
+
+
+def backfill_increment(checkpoint, table_list, limit):
+    """
+    Picks the parts a backfill hands on next.
+
+    A table that no other depends on is handed on a part at a time as its parts are written. # noqa
+    Tables that depend on each other (see table_spec) are only handed on as a group, once # noqa
+    every table in it is done, since transform joins them. An increment stops at `limit` # noqa
+    parts unless it is a single group that is larger on its own.
+
+    Args:
+        checkpoint (dict): The backfill checkpoint.
+        table_list (list): The tables being backfilled.
+        limit (int): Parts per increment.
+
+    Returns:
+        dict: Table name to the number of its parts handed on once this increment has been. # noqa
+    """
+    tables = checkpoint["tables"]
+    ready = {table: tables[table]["handed"] for table in table_list}
+    taken = 0
+    for group in backfill_groups(table_list):
+        waiting = sum(tables[table]["parts"] - ready[table] for table in group)
+        if not waiting:
+            continue
+        if len(group) == 1:
+            count = min(waiting, limit - taken)
+            ready[group[0]] += count
+            taken += count
+        elif all(tables[table]["done"] for table in group) and (
+            not taken or taken + waiting <= limit
+        ):
+            for table in group:
+                ready[table] = tables[table]["parts"]
+            taken += waiting
+        if taken >= limit:
+            break
+    return ready
+
+
+def backfill_groups(table_list):
+    """Splits `table_list` into groups of tables that depend on each other, in list order."""
+    group_of = {table: {table} for table in table_list}
+    for table in table_list:
+        for other in table_spec(table)["depends_on"]:
+            if other in group_of:
+                group = group_of[table] | group_of[other]
+                for member in group:
+                    group_of[member] = group
+    groups = []
+    for table in table_list:
+        group = [member for member in table_list if member in group_of[table]]
+        if group not in groups:
+            groups.append(group)
+    return groups
+
+
+def save_checkpoint(s3_client, bucketname, checkpoint):
+    """Writes the backfill's progress to BACKFILL_CHECKPOINT_KEY."""
+    s3_client.put_object(
+        Bucket=bucketname,
+        Key=BACKFILL_CHECKPOINT_KEY,
+        Body=json.dumps(checkpoint),
+        ContentType="application/json",
+    )
 
 
 # if __name__ == "__main__":
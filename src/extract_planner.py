@@ -0,0 +1,414 @@
+"""Plans each table's extraction strategy and diagnoses its incremental query."""
+
+import json
+import logging
+from datetime import datetime
+from botocore.exceptions import ClientError
+from pg8000.native import identifier, literal
+
+try:  # nosec  # noqa
+    from src.utils import run_id  # nosec  # noqa
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from utils import run_id  # nosec  # noqa
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+try:  # nosec  # noqa
+    from src.extract_tables import (  # nosec  # noqa
+        DEFAULT_EXTRACTION_TIME,
+        TABLE_LIST,
+        TIMESTAMP_FORMAT,
+        changed_since,
+        get_table_columns,
+        read_json_object,
+        select_list,
+        table_spec,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_tables import (  # nosec  # noqa
+        DEFAULT_EXTRACTION_TIME,
+        TABLE_LIST,
+        TIMESTAMP_FORMAT,
+        changed_since,
+        get_table_columns,
+        read_json_object,
+        select_list,
+        table_spec,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+logger = logging.getLogger("extract_logger")
+logger.setLevel(logging.INFO)
+
+DIAGNOSTICS_PREFIX = "diagnostics"
+PLAN_PREFIX = "plans"
+PLAN_KEY = f"{PLAN_PREFIX}/latest.json"
+# Estimated delta sizes at which plan_extraction moves to the next strategy; see choose_strategy # noqa
+PLAN_THRESHOLDS = {
+    "fetch_max_rows": 50000,
+    "stream_max_rows": 500000,
+    "copy_max_rows": 2000000,
+    "range_rows_per_part": 1000000,
+    "max_range_parts": 8,
+    # tables bigger than this aren't count(*)ed, their delta comes from the last run
+    "count_max_reltuples": 1000000,
+}
+
+
+def diagnose(
+    db,
+    s3_client,
+    this_extraction_time,
+    watermarks,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    table_list=None,
+):  # noqa
+    """
+    Profiles every table's incremental query and suggests a predicate PostgreSQL can index. # noqa
+
+    The "created_at > :t OR last_updated > :t" predicate write_data uses usually can't be # noqa
+    answered from one index, so it tends to seq-scan. Each table's query is run under # noqa
+    EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) from its watermark and summarised (see # noqa
+    summarise_plan). Two rewrites are costed with a plain EXPLAIN:
+
+    - "union": one range scan per watermark column, combined with UNION.
+    - "last_updated_only": a single range scan, valid only if no row's last_updated is # noqa
+      earlier than its created_at, which is checked.
+
+    The report recommends the cheapest valid form, or "keep" if the query already avoids a # noqa
+    seq scan, with CREATE INDEX statements for any watermark column that has no index. It is # noqa
+    written to "{DIAGNOSTICS_PREFIX}/{run id}.json" (see run_id) and returned. Nothing is # noqa
+    changed in the database.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        s3_client (boto3.client): The S3 client instance used for uploading the report.
+        this_extraction_time (str): The timestamp of this run.
+        watermarks (dict): Per-table watermarks the queries are profiled from.
+        bucketname (str, optional): The name of the S3 bucket. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        table_list (list, optional): The tables to profile. Defaults to TABLE_LIST.
+
+    Returns:
+        dict: "status" "no-op" and no "filepaths" for transform, the report key under "key" # noqa
+              and one diagnose_table report per table under "tables".
+    """
+    table_list = table_list or TABLE_LIST
+    table_columns = get_table_columns(db, table_list)
+    indexed = indexed_columns(db, table_list)
+    tables = {}
+    for table in table_list:
+        tables[table] = diagnose_table(
+            db,
+            table,
+            table_columns[table],
+            watermarks.get(table, DEFAULT_EXTRACTION_TIME),
+            indexed.get(table, set()),
+        )
+        logger.info(
+            f"{table}: {tables[table]['plan']['node_types']}, "
+            f"recommend {tables[table]['recommendation']}"
+        )
+    key = f"{DIAGNOSTICS_PREFIX}/{run_id(this_extraction_time)}.json"
+    s3_client.put_object(
+        Bucket=bucketname,
+        Key=key,
+        Body=json.dumps(tables, default=str),
+        ContentType="application/json",
+    )
+    return {"status": "no-op", "filepaths": [], "key": key, "tables": tables}
+
+
+def diagnose_table(db, table, columns, watermark, indexed):
+    """
+    Profiles one table's incremental query; see diagnose.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        table (str): The table name.
+        columns (list): The projected columns.
+        watermark (str): The table's watermark.
+        indexed (set): Columns that lead an existing index on the table.
+
+    Returns:
+        dict: The "plan" summary, the costed "candidates", the "recommendation" and the # noqa
+              "index_ddl" it needs.
+    """
+    params = {"last_extract_time": datetime.strptime(watermark, TIMESTAMP_FORMAT)}
+    select = f"SELECT {select_list(columns)} FROM {identifier(table)}"  # nosec
+    watermark_columns = table_spec(table)["watermark_columns"]
+    query_string = f"{select} WHERE {changed_since(table)}"  # nosec
+    plan = summarise_plan(
+        db.run(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query_string}", **params)[0][
+            0
+        ]
+    )
+
+    candidates = {
+        "union": {
+            "sql": " UNION ".join(
+                f"{select} WHERE {identifier(column)} > :last_extract_time"  # nosec
+                for column in watermark_columns
+            ),
+            "index_columns": list(watermark_columns),
+            "valid": True,
+        }
+    }
+    if set(watermark_columns) == {"created_at", "last_updated"}:
+        (earlier,) = db.run(
+            f"SELECT count(*) FROM {identifier(table)} "  # nosec
+            "WHERE last_updated < created_at"
+        )[0]
+        candidates["last_updated_only"] = {
+            "sql": f"{select} WHERE last_updated > :last_extract_time",  # nosec
+            "index_columns": ["last_updated"],
+            "valid": earlier == 0,
+        }
+    for candidate in candidates.values():
+        candidate["estimated_cost"] = summarise_plan(
+            db.run(f"EXPLAIN (FORMAT JSON) {candidate['sql']}", **params)[0][0]
+        )["total_cost"]
+
+    if not plan["seq_scans"]:
+        recommendation = "keep"
+        needed = []
+    else:
+        valid = {name: c for name, c in candidates.items() if c["valid"]}
+        # fewer indexes to maintain wins a tie
+        recommendation = min(
+            valid,
+            key=lambda name: (
+                valid[name]["estimated_cost"],
+                len(valid[name]["index_columns"]),
+            ),
+        )
+        needed = candidates[recommendation]["index_columns"]
+    return {
+        "plan": plan,
+        "candidates": candidates,
+        "recommendation": recommendation,
+        "index_ddl": [
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            f"{identifier(f'{table}_{column}_idx')} "
+            f"ON {identifier(table)} ({identifier(column)})"
+            for column in needed
+            if column not in indexed
+        ],
+    }
+
+
+def summarise_plan(explained):
+    """
+    Reduces EXPLAIN (FORMAT JSON) output to the figures diagnose reports.
+
+    Args:
+        explained (list or str): The single value EXPLAIN returns.
+
+    Returns:
+        dict: The plan's node types, the relations it seq-scans, rows returned and scanned, # noqa
+              buffer hits and reads, planning and execution time and total cost. The # noqa
+              ANALYZE figures are None for a plain EXPLAIN.
+    """
+    if isinstance(explained, str):
+        explained = json.loads(explained)
+    top = explained[0]
+    nodes = []
+    pending = [top["Plan"]]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get("Plans", []))
+    scans = [node for node in nodes if node["Node Type"].endswith("Scan")]
+    analyzed = "Actual Rows" in top["Plan"]
+    return {
+        "node_types": sorted({node["Node Type"] for node in nodes}),
+        "seq_scans": sorted(
+            {
+                node.get("Relation Name")
+                for node in nodes
+                if node["Node Type"] == "Seq Scan"
+            }
+        ),
+        "rows_returned": top["Plan"].get("Actual Rows"),
+        "rows_scanned": (
+            sum(
+                (node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0))
+                * node.get("Actual Loops", 1)
+                for node in scans
+            )
+            if analyzed
+            else None
+        ),
+        "shared_hit_blocks": top["Plan"].get("Shared Hit Blocks"),
+        "shared_read_blocks": top["Plan"].get("Shared Read Blocks"),
+        "planning_ms": top.get("Planning Time"),
+        "execution_ms": top.get("Execution Time"),
+        "total_cost": top["Plan"]["Total Cost"],
+    }
+
+
+def indexed_columns(db, table_list):
+    """Returns the columns leading an index on each table, from pg_index."""
+    rows = db.run(
+        """SELECT t.relname, a.attname
+             FROM pg_index i
+             JOIN pg_class t ON t.oid = i.indrelid
+             JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[0]
+            WHERE t.relname = ANY(:table_names)""",
+        table_names=list(table_list),
+    )
+    indexed = {}
+    for table, column in rows:
+        indexed.setdefault(table, set()).add(column)
+    return indexed
+
+
+def plan_extraction(
+    db,
+    s3_client,
+    watermarks,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    table_list=None,
+    thresholds=None,
+):  # noqa
+    """
+    Picks an extraction strategy for every table from a cheap estimate of its delta.
+
+    Table sizes come from pg_class.reltuples. Tables no bigger than "count_max_reltuples" get # noqa
+    an exact count(*) of their delta, all in one UNION ALL query. For bigger tables the delta # noqa
+    is taken from the last recorded run (see record_plan), or the whole table on a first run. # noqa
+    The estimate is then mapped to a strategy by choose_strategy.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        s3_client (boto3.client): The S3 client, for the last run's plan.
+        watermarks (dict): Per-table watermarks.
+        bucketname (str, optional): The name of the S3 bucket. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        table_list (list, optional): The tables to plan. Defaults to TABLE_LIST.
+        thresholds (dict, optional): Overrides for PLAN_THRESHOLDS.
+
+    Returns:
+        dict: Table name to its "strategy", range "parts", "estimated_rows" and the # noqa
+              "estimate_source" ("count", "previous run" or "reltuples").
+    """
+    table_list = table_list or TABLE_LIST
+    thresholds = {**PLAN_THRESHOLDS, **(thresholds or {})}
+    try:
+        previous = read_json_object(s3_client, bucketname, PLAN_KEY)["tables"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            logger.error("ERROR! Issues reading the last extraction plan.")
+            raise
+        previous = {}
+
+    reltuples = {
+        table: max(int(estimate), 0)
+        for table, estimate in db.run(
+            """SELECT relname, reltuples FROM pg_class
+                WHERE relkind = 'r' AND relname = ANY(:table_names)""",
+            table_names=list(table_list),
+        )
+    }
+    countable = [
+        table
+        for table in table_list
+        if reltuples.get(table, 0) <= thresholds["count_max_reltuples"]
+    ]
+    counts = {}
+    if countable:
+        query_string = " UNION ALL ".join(
+            f"SELECT {literal(table)}, count(*) FROM {identifier(table)} "  # nosec
+            f"WHERE {changed_since(table).replace(':last_extract_time', f':since_{n}')}"
+            for n, table in enumerate(countable)
+        )
+        params = {
+            f"since_{n}": datetime.strptime(
+                watermarks.get(table, DEFAULT_EXTRACTION_TIME), TIMESTAMP_FORMAT
+            )
+            for n, table in enumerate(countable)
+        }
+        counts = dict(db.run(query_string, **params))
+
+    plan = {}
+    for table in table_list:
+        first_run = (
+            watermarks.get(table, DEFAULT_EXTRACTION_TIME) == DEFAULT_EXTRACTION_TIME
+        )
+        if table in counts:
+            estimate, source = counts[table], "count"
+        elif not first_run and "actual_rows" in previous.get(table, {}):
+            estimate, source = previous[table]["actual_rows"], "previous run"
+        else:
+            estimate, source = reltuples.get(table, 0), "reltuples"
+        strategy, parts = choose_strategy(estimate, thresholds)
+        plan[table] = {
+            "strategy": strategy,
+            "parts": parts,
+            "estimated_rows": estimate,
+            "estimate_source": source,
+        }
+    logger.info(f"Extraction plan: {plan}")
+    return plan
+
+
+def choose_strategy(estimated_rows, thresholds=None):
+    """
+    Maps an estimated delta size to a strategy.
+
+    Up to "fetch_max_rows" the delta is fetched in one go; up to "stream_max_rows" it is # noqa
+    streamed through a server-side cursor; up to "copy_max_rows" it is COPYed; beyond that it # noqa
+    is split into key ranges of about "range_rows_per_part" rows, at most "max_range_parts". # noqa
+
+    Returns:
+        tuple: The strategy ("fetch", "stream", "copy" or "range") and the number of parts. # noqa
+    """
+    thresholds = {**PLAN_THRESHOLDS, **(thresholds or {})}
+    if estimated_rows <= thresholds["fetch_max_rows"]:
+        return "fetch", 1
+    if estimated_rows <= thresholds["stream_max_rows"]:
+        return "stream", 1
+    if estimated_rows <= thresholds["copy_max_rows"]:
+        return "copy", 1
+    parts = -(-estimated_rows // thresholds["range_rows_per_part"])
+    return "range", min(max(parts, 2), thresholds["max_range_parts"])
+
+
+def record_plan(
+    s3_client,
+    this_extraction_time,
+    plan,
+    result,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+):  # noqa
+    """
+    Stores a run's plan next to what actually happened, for tuning PLAN_THRESHOLDS.
+
+    Each table's decision gets the rows and bytes written, from the manifest, and the time # noqa
+    spent on it. The record is written to "{PLAN_PREFIX}/{run id}.json" and PLAN_KEY, which # noqa
+    the next run's planner reads.
+
+    Returns:
+        dict: The record.
+    """
+    tables = {}
+    for table, decision in plan.items():
+        entry = result["manifest"]["tables"].get(table, {})
+        tables[table] = {
+            **decision,
+            "actual_rows": entry.get("row_count"),
+            "actual_bytes": entry.get("byte_size"),
+            "elapsed_ms": result["timings"].get(table),
+        }
+    record = {"run": this_extraction_time, "tables": tables}
+    body = json.dumps(record)
+    for key in (f"{PLAN_PREFIX}/{run_id(this_extraction_time)}.json", PLAN_KEY):
+        s3_client.put_object(
+            Bucket=bucketname, Key=key, Body=body, ContentType="application/json"
+        )
+    return record
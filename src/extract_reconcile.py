@@ -0,0 +1,337 @@
+"""Finds rows deleted from the source by comparing primary key snapshots."""
+
+import io
+import json
+import logging
+import struct
+import zlib
+import numpy as np
+from botocore.exceptions import ClientError
+from pg8000.native import identifier
+
+try:  # nosec  # noqa
+    from src.extract_tables import (  # nosec  # noqa
+        EXTRACT_LAYOUT,
+        TABLE_LIST,
+        begin_repeatable_read,
+        extraction_filepaths,
+        primary_key,
+        tombstone_filepath,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_tables import (  # nosec  # noqa
+        EXTRACT_LAYOUT,
+        TABLE_LIST,
+        begin_repeatable_read,
+        extraction_filepaths,
+        primary_key,
+        tombstone_filepath,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+try:  # nosec  # noqa
+    from src.extract_encoders import S3MultipartWriter  # nosec  # noqa
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_encoders import S3MultipartWriter  # nosec  # noqa
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+logger = logging.getLogger("extract_logger")
+logger.setLevel(logging.INFO)
+
+PK_SNAPSHOT_PREFIX = "pk_snapshots"
+# COPY rows buffered before they are parsed into a key array
+KEY_CHUNK_ROWS = 250000
+
+
+def reconcile(
+    db,
+    s3_client,
+    this_extraction_time,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    table_list=None,
+    layout=EXTRACT_LAYOUT,
+):  # noqa
+    """
+    Detects rows hard-deleted from the source by diffing primary key sets.
+
+    Timestamp watermarks never see a deleted row. Instead, every table's primary keys are read # noqa
+    in key order under one REPEATABLE READ snapshot (see fetch_keys) and merged, a chunk at a # noqa
+    time, against the sorted keys saved by the previous reconcile (see KeyMerge). Keys that # noqa
+    have gone are streamed out as tombstones in the same per-table layout as write_data, and # noqa
+    the new keys are streamed into a pending snapshot, committed with the watermarks; a # noqa
+    table's first reconcile only saves its snapshot.
+
+    Only a chunk of KEY_CHUNK_ROWS keys from each side is held at once, 8 bytes a key, however # noqa
+    big the table. Snapshots are delta encoded and compressed (see encode_keys), so a dense # noqa
+    key space costs a few bytes per thousand keys in S3.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        s3_client (boto3.client): The S3 client instance used for uploading files.
+        this_extraction_time (str): The timestamp of this run.
+        bucketname (str, optional): The name of the S3 bucket. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        table_list (list, optional): The tables to reconcile. Defaults to TABLE_LIST.
+        layout (str, optional): One of LAYOUTS. Defaults to EXTRACT_LAYOUT.
+
+    Returns:
+        dict: "status" "no-op" and no "filepaths" for transform, the "tombstones" written, # noqa
+              the number of keys "deleted" per table and the "pk_snapshots" to commit.
+    """
+    table_list = table_list or TABLE_LIST
+    begin_repeatable_read(db)
+    tombstones = []
+    deleted = {}
+    pk_snapshots = {}
+    for table, filepath in zip(
+        table_list, extraction_filepaths(this_extraction_time, table_list, layout)
+    ):
+        try:
+            response = s3_client.get_object(
+                Bucket=bucketname, Key=pk_snapshot_key(table)
+            )
+            previous = iter_keys(response["Body"])
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                logger.error(f"ERROR! Issues reading the key snapshot for {table}.")
+                raise
+            logger.info(f"No key snapshot for {table} yet, saving the first one.")
+            previous = None
+
+        key = pk_snapshot_key(table, this_extraction_time)
+        snapshot = S3MultipartWriter(
+            s3_client, bucketname, key, content_type="application/octet-stream"
+        )
+        gone = TombstoneStream(s3_client, bucketname, filepath, primary_key(table))
+        merge = KeyMerge(previous, snapshot, gone.write)
+        try:
+            fetch_keys(db, table, merge.add)
+            merge.finish()
+            snapshot.close()
+            tombstone = gone.close()
+        except Exception:
+            snapshot.abort()
+            gone.abort()
+            raise
+        if previous is not None:
+            deleted[table] = gone.count
+        if tombstone:
+            tombstones.append(tombstone)
+        pk_snapshots[table] = key
+
+    logger.info(f"Reconciled keys, deleted rows found: {deleted}")
+    return {
+        "status": "no-op",
+        "filepaths": [],
+        "tombstones": tombstones,
+        "deleted": deleted,
+        "pk_snapshots": pk_snapshots,
+    }
+
+
+def pk_snapshot_key(table, this_extraction_time=None):
+    """Returns the key of a table's committed key snapshot, or a run's pending one."""
+    if this_extraction_time is None:
+        return f"{PK_SNAPSHOT_PREFIX}/current/{table}.keys"
+    run = this_extraction_time.replace(" ", "T")
+    return f"{PK_SNAPSHOT_PREFIX}/pending/{run}/{table}.keys"
+
+
+def fetch_keys(db, table, consume):
+    """
+    Reads a table's primary keys in order, handing them to `consume` as int64 arrays.
+
+    The keys come through COPY ... TO STDOUT and are parsed KEY_CHUNK_ROWS at a time (see # noqa
+    KeySink), so no Python object is built per key and only one chunk is held at once.
+    """
+    pk = identifier(primary_key(table))
+    sink = KeySink(consume)
+    db.run(
+        f"COPY (SELECT {pk} FROM {identifier(table)} ORDER BY {pk}) TO STDOUT",  # nosec
+        stream=sink,
+    )
+    sink.flush()
+
+
+class KeySink:
+    """Parses COPY text output of one integer column into int64 arrays, a chunk at a time."""
+
+    def __init__(self, consume, chunk_rows=None):
+        self.consume = consume
+        self.chunk_rows = chunk_rows or KEY_CHUNK_ROWS
+        self.buffer = bytearray()
+        self.rows = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.rows += 1
+        if self.rows >= self.chunk_rows:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.consume(np.loadtxt(io.BytesIO(self.buffer), dtype=np.int64, ndmin=1))
+        self.buffer.clear()
+        self.rows = 0
+
+
+class KeyMerge:
+    """
+    Merges a table's current keys against its previous snapshot as both stream past.
+
+    `add` is called with the current keys in ascending chunks. Each chunk is written to the # noqa
+    new `snapshot`, and the `previous` chunks are pulled one at a time until one runs past it; # noqa
+    previous keys up to the chunk's last key that aren't in it have been deleted and go to # noqa
+    `gone`. Whatever is left of `previous` once the current keys run out was deleted too. # noqa
+    With no previous snapshot only the new one is written.
+    """
+
+    def __init__(self, previous, snapshot, gone):
+        self.previous = previous
+        self.snapshot = snapshot
+        self.gone = gone
+        self.pending = np.empty(0, dtype=np.int64)
+
+    def add(self, keys):
+        if not keys.size:
+            return
+        self.snapshot.write(encode_keys(keys))
+        if self.previous is None:
+            return
+        last = keys[-1]
+        while True:
+            covered = np.searchsorted(self.pending, last, side="right")
+            self.emit(diff_keys(self.pending[:covered], keys))
+            self.pending = self.pending[covered:]
+            if self.pending.size:
+                break
+            # one previous chunk at a time, however many the current chunk spans
+            self.pending = next(self.previous, None)
+            if self.pending is None:
+                self.pending = np.empty(0, dtype=np.int64)
+                break
+
+    def finish(self):
+        if self.previous is None:
+            return
+        self.emit(self.pending)
+        self.pending = np.empty(0, dtype=np.int64)
+        for chunk in self.previous:
+            self.emit(chunk)
+
+    def emit(self, keys):
+        if keys.size:
+            self.gone(keys)
+
+
+class TombstoneStream:
+    """
+    Streams deleted keys to a table's tombstone key as they are found.
+
+    The object is the same JSON list of {primary key: key} identities write_tombstones writes, # noqa
+    and is only created once a deleted key turns up.
+    """
+
+    def __init__(self, s3_client, bucketname, filepath, pk):
+        self.s3_client = s3_client
+        self.bucketname = bucketname
+        self.key = tombstone_filepath(filepath)
+        self.pk = json.dumps(pk)
+        self.writer = None
+        self.count = 0
+
+    def write(self, keys):
+        if self.writer is None:
+            self.writer = S3MultipartWriter(self.s3_client, self.bucketname, self.key)
+            self.writer.write(b"[")
+        else:
+            self.writer.write(b", ")
+        self.writer.write(
+            ", ".join(f"{{{self.pk}: {key}}}" for key in keys.tolist()).encode()
+        )
+        self.count += int(keys.size)
+
+    def close(self):
+        """Finishes the object; returns its key, or None if nothing was deleted."""
+        if self.writer is None:
+            return None
+        self.writer.write(b"]")
+        self.writer.close()
+        return self.key
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+
+
+def diff_keys(previous, current):
+    """
+    Returns the keys in `previous` that aren't in `current`; both sorted int64 arrays.
+
+    Every previous key is binary searched in `current`, O(n log n) with no Python loop and # noqa
+    no copy of either array beyond the index and mask.
+    """
+    if not current.size:
+        return previous
+    positions = np.searchsorted(current, previous)
+    np.minimum(positions, current.size - 1, out=positions)
+    return previous[current[positions] != previous]
+
+
+# first key, key count, gap width in bytes and compressed length of an encode_keys frame
+KEY_FRAME = struct.Struct("<qIBI")
+
+
+def encode_keys(keys):
+    """
+    Serialises a sorted chunk of keys as one snapshot frame.
+
+    A frame is a KEY_FRAME header followed by the zlib compressed gaps between consecutive # noqa
+    keys, in the smallest unsigned type that holds them. A snapshot is its frames one after # noqa
+    another, read back with iter_keys.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if not keys.size:
+        return b""
+    gaps = np.diff(keys)
+    width = np.min_scalar_type(int(gaps.max())).itemsize if gaps.size else 1
+    body = zlib.compress(gaps.astype(f"<u{width}").tobytes())
+    return KEY_FRAME.pack(int(keys[0]), int(keys.size), width, len(body)) + body
+
+
+def iter_keys(stream):
+    """Reads the frames written by encode_keys from a file-like `stream`, one array each."""
+    while True:
+        header = read_exactly(stream, KEY_FRAME.size)
+        if not header:
+            return
+        first, count, width, length = KEY_FRAME.unpack(header)
+        gaps = np.frombuffer(
+            zlib.decompress(read_exactly(stream, length)), dtype=f"<u{width}"
+        )
+        keys = np.empty(count, dtype=np.int64)
+        keys[0] = first
+        np.cumsum(gaps, out=keys[1:], dtype=np.int64)
+        keys[1:] += first
+        yield keys
+
+
+def read_exactly(stream, size):
+    """Reads `size` bytes from `stream`, or b"" at its end."""
+    data = b""
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            if data:
+                raise ValueError("Key snapshot ends part way through a frame")
+            break
+        data += more
+    return data
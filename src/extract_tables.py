@@ -0,0 +1,506 @@
+"""The source tables the extractor reads and the queries shared by every mode."""
+
+import json
+import logging
+import threading
+import weakref
+from datetime import datetime
+from pg8000.native import identifier, literal
+
+try:  # nosec  # noqa
+    from src.utils import (  # nosec  # noqa
+        partition_prefix,
+        run_manifest_prefix,
+        update_partition_index,
+        write_manifest,
+    )
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from utils import (  # nosec  # noqa
+        partition_prefix,
+        run_manifest_prefix,
+        update_partition_index,
+        write_manifest,
+    )
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+logger = logging.getLogger("extract_logger")
+logger.setLevel(logging.INFO)
+
+DEFAULT_EXTRACTION_TIME = "0001-01-01 00:00:00.000000"
+WATERMARK_COLUMNS = ("created_at", "last_updated")
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+EXTRACT_LAYOUT = "by-time"
+
+MONTHS = {
+    "01": "January",
+    "02": "February",
+    "03": "March",
+    "04": "April",
+    "05": "May",
+    "06": "June",
+    "07": "July",
+    "08": "August",
+    "09": "September",
+    "10": "October",
+    "11": "November",
+    "12": "December",
+}
+
+# Every source table the extractor reads: its primary key, the columns its watermark is
+# taken from, the columns transform uses and how it is extracted: "select", "copy", or
+# "range" with the number of key ranges to scan in parallel under "parts" (see key_ranges).
+# "depends_on" names the tables transform joins it with, which a backfill hands on with it.
+# Only the primary key, watermark columns and "columns" are selected, so anything else
+# never leaves the database.
+TABLE_REGISTRY = {
+    "counterparty": {
+        "primary_key": "counterparty_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": ("counterparty_legal_name", "legal_address_id"),
+        "strategy": "select",
+        "depends_on": ("address",),
+    },
+    "currency": {
+        "primary_key": "currency_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": ("currency_code",),
+        "strategy": "select",
+    },
+    "department": {
+        "primary_key": "department_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": ("department_name", "location"),
+        "strategy": "select",
+    },
+    "design": {
+        "primary_key": "design_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": ("design_name", "file_location", "file_name"),
+        "strategy": "select",
+    },
+    "staff": {
+        "primary_key": "staff_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": ("first_name", "last_name", "department_id", "email_address"),
+        "strategy": "select",
+        "depends_on": ("department",),
+    },
+    "sales_order": {
+        "primary_key": "sales_order_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": (
+            "design_id",
+            "staff_id",
+            "counterparty_id",
+            "units_sold",
+            "unit_price",
+            "currency_id",
+            "agreed_delivery_date",
+            "agreed_payment_date",
+            "agreed_delivery_location_id",
+        ),
+        "strategy": "select",
+    },
+    "address": {
+        "primary_key": "address_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": (
+            "address_line_1",
+            "address_line_2",
+            "district",
+            "city",
+            "postal_code",
+            "country",
+            "phone",
+        ),
+        "strategy": "select",
+    },
+    # "payment", "purchase_order", "payment_type", "transaction"
+}
+
+TABLE_LIST = list(TABLE_REGISTRY)
+
+# Module level so warm invocations reuse them; see invalidate_column_cache
+_column_cache = {}
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
+
+
+def read_json_object(s3_client, bucketname, key):
+    """Downloads and parses a JSON object from S3."""
+    response = s3_client.get_object(Bucket=bucketname, Key=key)
+    return json.loads(response["Body"].read().decode("utf-8"))
+
+
+def extraction_filepaths(this_extraction_time, table_list, layout=EXTRACT_LAYOUT):
+    """
+    Builds the S3 key each table is written to for a run.
+
+    The "by-time" layout organises runs by year, month, day and time, e.g.
+    "data/by time/2025/03-March/07/22:17:13.872739/sales_order". The "hive" layout
+    partitions by table and date instead, e.g.
+    "data/table=sales_order/dt=2025-03-07/run=20250307T221713.872739/sales_order"
+    (see partition_prefix), which sorts numerically and can be pruned by table and date.
+
+    Args:
+        this_extraction_time (str): The timestamp of the run.
+        table_list (list): The tables extracted.
+        layout (str, optional): One of LAYOUTS. Defaults to EXTRACT_LAYOUT.
+
+    Returns:
+        list: One key per table, ending in the table name.
+    """
+    if layout == "hive":
+        return [
+            f"{partition_prefix(table, this_extraction_time)}/{table}"
+            for table in table_list
+        ]
+    split = this_extraction_time.split("-")
+    year = split[0]
+    month = split[1]
+    split2 = split[2].split(" ")
+    day = split2[0]
+    time_of_day = split2[1]
+    monthstr = f"{month}-{MONTHS[month]}"
+    prefix = f"data/by time/{year}/{monthstr}/{day}/{time_of_day}"
+    return [f"{prefix}/{table}" for table in table_list]
+
+
+def write_run_manifest(s3_client, bucketname, run, filepaths, tables, layout):
+    """
+    Writes an extract run's manifest and, for the "hive" layout, its partition indexes.
+
+    A "by-time" manifest goes next to the run's objects. A "hive" run's objects are spread
+    over one partition per table, so its manifest goes under run_manifest_prefix and every
+    partition's index is updated (see update_partition_index).
+
+    Returns:
+        dict: The manifest.
+    """
+    if layout == "hive":
+        update_partition_index(s3_client, bucketname, run, tables)
+        prefix = run_manifest_prefix(run)
+    else:
+        prefix = filepaths[0].rsplit("/", 1)[0]
+    return write_manifest(
+        s3_client, bucketname, "extract", run, prefix, tables, layout=layout
+    )
+
+
+def updated_range(
+    columns, rows, current=(None, None), watermark_columns=WATERMARK_COLUMNS
+):
+    """
+    Widens (oldest, newest) change time to cover `rows`.
+
+    A row's change time is the newest of its watermark columns, so with the default columns # noqa
+    it is its last_updated.
+
+    Args:
+        columns (list): The column names, in row order.
+        rows (list): Rows of raw database values.
+        current (tuple, optional): The range so far, as strings or None.
+        watermark_columns (tuple, optional): The table's watermark columns (see table_spec). # noqa
+
+    Returns:
+        tuple: The oldest and newest change time as strings, or None.
+    """
+    positions = [i for i, column in enumerate(columns) if column in watermark_columns]
+    seen = []
+    for row in rows:
+        changed = [row[i] for i in positions if isinstance(row[i], datetime)]
+        if changed:
+            seen.append(max(changed))
+    if not seen:
+        return current
+    oldest = min(seen).strftime(TIMESTAMP_FORMAT)
+    newest = max(seen).strftime(TIMESTAMP_FORMAT)
+    if current[0] is not None:
+        oldest = min(oldest, current[0])
+        newest = max(newest, current[1])
+    return oldest, newest
+
+
+def max_watermark(columns, rows, watermark, watermark_columns=WATERMARK_COLUMNS):
+    """
+    Returns the largest watermark column value in `rows`, if it is past `watermark`.
+
+    Args:
+        columns (list): The column names, in row order.
+        rows (list): Rows of raw database values.
+        watermark (str): The watermark to start from.
+        watermark_columns (tuple, optional): The table's watermark columns (see table_spec). # noqa
+
+    Returns:
+        str: The new watermark.
+    """
+    positions = [i for i, column in enumerate(columns) if column in watermark_columns]
+    seen = [row[i] for row in rows for i in positions if isinstance(row[i], datetime)]
+    if not seen:
+        return watermark
+    return max(max(seen).strftime(TIMESTAMP_FORMAT), watermark)
+
+
+def export_snapshot(db):
+    """
+    Starts a REPEATABLE READ transaction on `db` and exports its snapshot.
+
+    The transaction must stay open for as long as other connections need to attach to it.
+
+    Args:
+        db (DatabaseClient): The connection whose snapshot is shared.
+
+    Returns:
+        str: The snapshot identifier from pg_export_snapshot().
+    """
+    begin_repeatable_read(db)
+    return db.run("SELECT pg_export_snapshot()")[0][0]
+
+
+def begin_repeatable_read(db):
+    """Ends any open transaction on `db` and starts a REPEATABLE READ one."""
+    db.rollback()
+    db.run("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+
+def attach_snapshot(conn, snapshot_id):
+    """
+    Starts a REPEATABLE READ transaction on `conn` that sees the exported `snapshot_id`.
+
+    Args:
+        conn (DatabaseClient): A worker connection with no transaction in progress.
+        snapshot_id (str): The identifier returned by export_snapshot.
+
+    Returns:
+        None
+    """
+    conn.run("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    conn.run(f"SET TRANSACTION SNAPSHOT {literal(snapshot_id)}")  # nosec
+
+
+def get_table_columns(db, table_list, refresh=False):
+    """
+    Returns the ordered column names of every table in `table_list`, projected to the columns # noqa
+    TABLE_REGISTRY declares for it (see projected_columns).
+
+    All tables are looked up with a single information_schema query and the result is kept # noqa
+    in a module level cache, so warm invocations skip the round trip entirely.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        table_list (list): The tables to look up.
+        refresh (bool, optional): Ignore the cache and query the database. Defaults to False.
+
+    Returns:
+        dict: A dictionary mapping each table name to its list of column names.
+    """
+    if refresh or any(table not in _column_cache for table in table_list):
+        columns_query = """SELECT table_name, column_name FROM information_schema.columns
+                            WHERE table_name = ANY(:table_names)
+                            ORDER BY table_name, ordinal_position"""
+        columnsdata = db.run(columns_query, table_names=list(table_list))
+        fetched = {table: [] for table in table_list}
+        for table_name, column_name in columnsdata:
+            fetched[table_name].append(column_name)
+        _column_cache.update(fetched)
+    return {
+        table: projected_columns(table, _column_cache[table]) for table in table_list
+    }
+
+
+def table_spec(table):
+    """
+    Returns a table's TABLE_REGISTRY entry.
+
+    Tables that aren't registered are keyed on "{table}_id", watermarked on WATERMARK_COLUMNS # noqa
+    and have every column selected. A table without "depends_on" depends on no other table. # noqa
+    """
+    spec = {
+        "primary_key": f"{table}_id",
+        "watermark_columns": WATERMARK_COLUMNS,
+        "columns": None,
+        "strategy": "select",
+        "depends_on": (),
+    }
+    spec.update(TABLE_REGISTRY.get(table, {}))
+    return spec
+
+
+def projected_columns(table, columns):
+    """
+    Narrows a table's columns to its primary key, watermark columns and declared "columns". # noqa
+
+    The table's own column order is kept. Columns the registry declares that the table doesn't # noqa
+    have are left out rather than failing the query.
+
+    Args:
+        table (str): The table name.
+        columns (list): Every column of the table, in order.
+
+    Returns:
+        list: The columns to select.
+    """
+    spec = table_spec(table)
+    if spec["columns"] is None:
+        return list(columns)
+    wanted = {spec["primary_key"], *spec["watermark_columns"], *spec["columns"]}
+    return [column for column in columns if column in wanted]
+
+
+def select_list(columns):
+    """Returns the SELECT list for `columns`, or "*" if there are none to project to."""
+    return ", ".join(identifier(column) for column in columns) or "*"
+
+
+def changed_since(table):
+    """Returns the WHERE condition for rows changed after :last_extract_time."""
+    return " OR ".join(
+        f"{identifier(column)} > :last_extract_time"
+        for column in table_spec(table)["watermark_columns"]
+    )
+
+
+def invalidate_column_cache():
+    """Clears the cached column metadata and any prepared statements built from it."""
+    _column_cache.clear()
+    _prepared_statements.clear()
+
+
+def get_prepared_statement(db, query_string):
+    """
+    Returns a prepared statement for `query_string` on `db`, preparing it on first use.
+
+    Statements are cached per connection, so they are only reused while the connection is. # noqa
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        query_string (str): The SQL to prepare.
+
+    Returns:
+        PreparedStatement: The cached prepared statement.
+    """
+    with _prepared_statements_lock:
+        statements = _prepared_statements.setdefault(db, {})
+    if query_string not in statements:
+        statements[query_string] = db.prepare(query_string)
+    return statements[query_string]
+
+
+def run_table_query(
+    db, table, query_string, columns, build_query=None, snapshot=False, **params
+):
+    """
+    Runs a table's extraction query as a prepared statement and checks it against the cache. # noqa
+
+    If the statement fails, the table's schema is assumed to have changed: the transaction is # noqa
+    rolled back, the caches are invalidated, the columns are looked up again and the query is # noqa
+    rebuilt for them with `build_query` before it is prepared and run again. On a connection # noqa
+    reading from a shared snapshot the rollback would end the snapshot, so the error is # noqa
+    raised instead. If the columns a statement returns no longer match the cached metadata, # noqa
+    the caches are refreshed and the returned columns are used.
+
+    Args:
+        db (DatabaseClient): A database client instance for querying data.
+        table (str): The table being queried.
+        query_string (str): The SELECT statement to run.
+        columns (list): The cached column names for the table.
+        build_query (callable, optional): Builds the SELECT statement for a list of columns. Defaults to rerunning query_string as it is. # noqa
+        snapshot (bool, optional): Whether `db` is in a transaction attached to a shared snapshot. Defaults to False. # noqa
+        **params: Named parameters for the query.
+
+    Returns:
+        tuple: The rows returned, the column names they correspond to and the statement run.
+    """
+    try:
+        statement = get_prepared_statement(db, query_string)
+        data = statement.run(**params)
+    except Exception as e:
+        if snapshot:
+            logger.error(f"ERROR! Query for {table} failed in a shared snapshot: {e}")
+            raise
+        logger.warning(f"Prepared query for {table} failed, refreshing metadata: {e}")
+        db.rollback()
+        invalidate_column_cache()
+        columns = get_table_columns(db, [table], refresh=True)[table]
+        if build_query is not None:
+            query_string = build_query(columns)
+        statement = get_prepared_statement(db, query_string)
+        data = statement.run(**params)
+
+    described = statement_columns(statement)
+    if described is not None and described != columns:
+        logger.warning(f"Schema change detected for {table}, refreshing metadata.")
+        invalidate_column_cache()
+        get_table_columns(db, [table], refresh=True)
+        columns = described
+    return data, columns, statement
+
+
+def build_range_query(table, after, columns):
+    """Returns backfill's query for `table`'s next :limit rows by key, after :after if `after`."""
+    pk = identifier(primary_key(table))
+    query_string = f"SELECT {select_list(columns)} FROM {identifier(table)}"  # nosec
+    if after:
+        query_string += f" WHERE {pk} > :after"  # nosec
+    return query_string + f" ORDER BY {pk} LIMIT :limit"  # nosec
+
+
+def statement_columns(statement):
+    """Returns the column names a prepared statement produces, or None if they are unknown."""
+    row_desc = getattr(statement, "row_desc", None)
+    if not isinstance(row_desc, list):
+        return None
+    return [column["name"] for column in row_desc]
+
+
+def column_types(source):
+    """
+    Returns the PostgreSQL type oid of each result column, or None if they are unknown.
+
+    Args:
+        source: A prepared statement (uses its row description) or a connection (uses the
+            description of its last query).
+
+    Returns:
+        list: Type oids in column order, or None.
+    """
+    row_desc = getattr(source, "row_desc", None)
+    if isinstance(row_desc, list):
+        return [column["type_oid"] for column in row_desc]
+    description = getattr(source, "description", None)
+    if isinstance(description, (list, tuple)):
+        return [column[1] for column in description]
+    return None
+
+
+def column_modifiers(source):
+    """
+    Returns the PostgreSQL type modifier of each result column, or None if they are unknown.
+
+    Args:
+        source: A prepared statement or a connection, as for column_types.
+
+    Returns:
+        list: Type modifiers in column order (-1 where a type has none), or None.
+    """
+    for row_desc in (
+        getattr(source, "row_desc", None),
+        getattr(source, "columns", None),
+    ):
+        if isinstance(row_desc, list):
+            return [column.get("type_modifier", -1) for column in row_desc]
+    return None
+
+
+def primary_key(table):
+    """Returns a table's primary key column from TABLE_REGISTRY."""
+    return table_spec(table)["primary_key"]
+
+
+def tombstone_filepath(filepath):
+    """Returns the key deleted rows are recorded under for a table's extract key."""
+    return filepath.replace("data/", "tombstones/", 1)
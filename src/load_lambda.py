@@ -2,6 +2,7 @@ import boto3
 import pyarrow.parquet as pa
 import pandas as pd
 import io
+from datetime import datetime
 from botocore.exceptions import ClientError
 import logging
 from sqlalchemy import create_engine
@@ -10,10 +11,24 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 try:
-    from src.utils import get_db_credentials
+    from src.utils import (
+        get_db_credentials,
+        load_continuation,
+        manifest_keys,
+        open_with_refresh,
+        out_of_time,
+        save_continuation,
+    )
 except ImportError:  # pragma: no cover
     try:  # pragma: no cover
-        from utils import get_db_credentials  # pragma: no cover
+        from utils import (  # pragma: no cover
+            get_db_credentials,
+            load_continuation,
+            manifest_keys,
+            open_with_refresh,
+            out_of_time,
+            save_continuation,
+        )
     except ImportError:  # pragma: no cover
         raise ImportError("Could not import get_db_credentials")  # pragma: no cover
 
@@ -32,7 +47,12 @@ def lambda_handler(
     This function:
     - Reads parquet files specified in the event input.
     - Loads data into predefined tables (fact and dimension tables).
-    - Skips tables if no data is found for that table.
+    - Skips tables if no data is found for that table, or the transform manifest records them as empty. # noqa
+    - Fails with a RuntimeError if the transform manifest has no entry for one of the tables. # noqa
+    - Returns straight away for a {"status": "no-op"} run, without touching S3 or the warehouse. # noqa
+    - Stops between tables when the Lambda runs short of time (see out_of_time), saving the # noqa
+      tables loaded so far (see save_continuation). Invoked again with {"continuation": token}, # noqa
+      it reads and loads only the tables that are left.
 
     Parameters:
         event (dict): The input event,containing S3 file paths (via "filepaths" key).
@@ -42,13 +62,22 @@ def lambda_handler(
         bucket_name (str, optional): The name of the S3 bucket from which parquet files are read. Defaults to "totes-transform-bucket-20250227154810549700000001". # noqa
 
     Returns:
-        None
+        None, {"status": "no-op"} for a run with nothing to load, or {"status": "in-progress", # noqa
+        "continuation": token} for a run that isn't finished.
     """
 
+    if event.get("status") == "no-op":
+        logger.info("Nothing to load.")
+        return {"status": "no-op"}
+
     if client is None:
         client = boto3.client("s3")
 
-    dataframes = read_parquet(event["filepaths"], client, bucket_name)
+    continuation = event.get("continuation")
+    state = {}
+    if continuation:
+        state = load_continuation(client, bucket_name, continuation)
+        event = state["event"]
 
     tables = [
         "dim_counterparty",
@@ -60,11 +89,47 @@ def lambda_handler(
         "fact_sales_order",
     ]
 
+    file_paths = event["filepaths"]
+    manifest = event.get("manifest")
+    if manifest:
+        missing = [table for table in tables if table not in manifest["tables"]]
+        if missing:
+            # a table transform failed to write would otherwise be skipped for good
+            logger.error(
+                f"ERROR! Tables missing from the transform manifest: {missing}"
+            )
+            raise RuntimeError(f"Tables missing from the transform manifest: {missing}")
+        # empty tables are known from the transform manifest, no need to download them
+        file_paths = manifest_keys(manifest)
+
+    loaded = list(state.get("loaded", []))
+    file_paths = [
+        file_path
+        for file_path in file_paths
+        if file_path.split("/")[-1].split(".")[0] not in loaded
+    ]
+    dataframes = read_parquet(file_paths, client, bucket_name)
+
     for table in tables:
+        if table in loaded:
+            continue
+        if len(loaded) > len(state.get("loaded", [])) and out_of_time(context):
+            continuation = save_continuation(
+                client,
+                bucket_name,
+                "load",
+                (manifest or {}).get("run") or str(datetime.now()),
+                {"event": event, "loaded": loaded},
+            )
+            logger.info(f"Out of time, {len(tables) - len(loaded)} tables left.")
+            return {"status": "in-progress", "continuation": continuation}
         if table in dataframes:
             load_df_to_warehouse(dataframes[table], table, conn)
         else:
             logger.warning(f"ERROR! Data for table {table} not found; skipping.")
+        loaded.append(table)
+    if continuation:
+        client.delete_object(Bucket=bucket_name, Key=continuation)
 
 
 def read_parquet(
@@ -148,10 +213,22 @@ def connect_to_warehouse(
                             Defaults to "project_warehouse_credentials".
         region_name (str): The AWS region where the secret is stored. Defaults to "eu-west-2". # noqa
 
+    Credentials come from the in-process cache in utils; if the warehouse rejects them the secret is refetched and the connection retried once. # noqa
+
     Returns:
         Connection: A SQLAlchemy Connection object connected to the data warehouse."
     """  # noqa
     credentials = get_db_credentials(secret_name, region_name)
+    conn, _ = open_with_refresh(
+        secret_name, region_name, credentials, warehouse_connection
+    )
+    return conn
+
+
+def warehouse_connection(credentials):
+    """
+    Opens a SQLAlchemy connection to the warehouse from a credentials dictionary.
+    """
     db_url = (
         f"postgresql+pg8000://{credentials['user']}:{credentials['password']}"  # nosec # noqa
         f"@{credentials['host']}:{credentials['port']}/{credentials['database']}"  # nosec # noqa
@@ -1,13 +1,150 @@
 import logging
 import boto3
+import gzip
+import hashlib
+import io
 import json
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import pandas as pd
-import pycountry
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # pragma: no cover
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+try:
+    from src.utils import (
+        load_continuation,
+        manifest_entry,
+        manifest_keys,
+        out_of_time,
+        partition_prefix,
+        partition_values,
+        run_manifest_prefix,
+        run_time,
+        save_continuation,
+        update_partition_index,
+        write_manifest,
+    )
+except ImportError:  # pragma: no cover
+    try:  # pragma: no cover
+        from utils import (  # pragma: no cover
+            load_continuation,
+            manifest_entry,
+            manifest_keys,
+            out_of_time,
+            partition_prefix,
+            partition_values,
+            run_manifest_prefix,
+            run_time,
+            save_continuation,
+            update_partition_index,
+            write_manifest,
+        )
+    except ImportError:  # pragma: no cover
+        raise ImportError("Could not import manifest helpers")  # pragma: no cover
+
+# concurrent S3 requests made by read and write, and the size of the client's connection pool
+TRANSFORM_WORKERS = 8
+
+# read the extract objects straight into typed Arrow columns, see decode_columnar
+TRANSFORM_COLUMNAR = False
+
+# Arrow types of the source columns transform reads, for decode_columnar. Columns that
+# aren't listed keep whatever type Arrow infers.
+EXTRACT_SCHEMAS = {
+    "counterparty": {
+        "counterparty_id": pa.int64(),
+        "counterparty_legal_name": pa.string(),
+        "legal_address_id": pa.int64(),
+        "commercial_contact": pa.string(),
+        "delivery_contact": pa.string(),
+        "created_at": pa.timestamp("us"),
+        "last_updated": pa.timestamp("us"),
+    },
+    "currency": {
+        "currency_id": pa.int64(),
+        "currency_code": pa.string(),
+        "created_at": pa.timestamp("us"),
+        "last_updated": pa.timestamp("us"),
+    },
+    "department": {
+        "department_id": pa.int64(),
+        "department_name": pa.string(),
+        "location": pa.string(),
+        "manager": pa.string(),
+        "created_at": pa.timestamp("us"),
+        "last_updated": pa.timestamp("us"),
+    },
+    "design": {
+        "design_id": pa.int64(),
+        "design_name": pa.string(),
+        "file_location": pa.string(),
+        "file_name": pa.string(),
+        "created_at": pa.timestamp("us"),
+        "last_updated": pa.timestamp("us"),
+    },
+    "staff": {
+        "staff_id": pa.int64(),
+        "first_name": pa.string(),
+        "last_name": pa.string(),
+        "department_id": pa.int64(),
+        "email_address": pa.string(),
+        "created_at": pa.timestamp("us"),
+        "last_updated": pa.timestamp("us"),
+    },
+    "sales_order": {
+        "sales_order_id": pa.int64(),
+        "design_id": pa.int64(),
+        "staff_id": pa.int64(),
+        "counterparty_id": pa.int64(),
+        "units_sold": pa.int64(),
+        "unit_price": pa.float64(),
+        "currency_id": pa.int64(),
+        "agreed_delivery_date": pa.string(),
+        "agreed_payment_date": pa.string(),
+        "agreed_delivery_location_id": pa.int64(),
+        "created_at": pa.timestamp("us"),
+        "last_updated": pa.timestamp("us"),
+    },
+    "address": {
+        "address_id": pa.int64(),
+        "address_line_1": pa.string(),
+        "address_line_2": pa.string(),
+        "district": pa.string(),
+        "city": pa.string(),
+        "postal_code": pa.string(),
+        "country": pa.string(),
+        "phone": pa.string(),
+        "created_at": pa.timestamp("us"),
+        "last_updated": pa.timestamp("us"),
+    },
+}
+
+# S3 clients shared by the worker threads and kept between warm invocations, by pool size
+_s3_clients = {}
+
+
+def get_s3_client(workers=TRANSFORM_WORKERS):
+    """
+    Returns an S3 client with a connection pool big enough for `workers` concurrent requests, # noqa
+    created once per process. boto3 clients are thread safe, so every worker shares it.
+    """
+    if workers not in _s3_clients:
+        _s3_clients[workers] = boto3.client(
+            "s3", config=Config(max_pool_connections=workers)
+        )
+    return _s3_clients[workers]
+
 
 def lambda_handler(
     event, context, client=None, extractbucketname=None, transformbucketname=None
@@ -23,8 +160,29 @@ def lambda_handler(
     2. Transform the raw data for the different tables (e.g., sales order, staff, design, etc.).
     3. Ensure that the date dimension table is updated if necessary.
     4. Write the transformed data to the appropriate S3 location, organized by time.
+       Each table is uploaded in the background while the next one is transformed.
     5. Return the list of file paths where the transformed data is stored in the transform S3.
 
+    A {"status": "no-op"} result from the extract lambda is passed straight on without touching S3. # noqa
+    When the extract result carries a run manifest, the run's key prefix comes from it, tables # noqa
+    it records as empty aren't downloaded, and a run where every table is empty is passed on # noqa
+    as a no-op. A manifest of the transformed objects is written and returned for load.
+
+    The transformed objects follow the extract run's key layout. For the "hive" layout each # noqa
+    output table gets its own "table=.../dt=.../run=..." partition (see partition_prefix) and # noqa
+    the partition indexes in the transform bucket are updated.
+
+    When the Lambda runs short of time between output tables (see out_of_time), the tables # noqa
+    written so far are saved (see save_continuation) and {"status": "in-progress", # noqa
+    "continuation": token} is returned. Invoked again with {"continuation": token}, it # noqa
+    carries on with the tables that are left.
+
+    A table that can't be written (see write) fails the run with a RuntimeError, so it is # noqa
+    never left out of the manifest handed to load.
+
+    With "columnar" set in the event (or TRANSFORM_COLUMNAR), the extract objects are parsed # noqa
+    straight into typed columns (see decode_columnar) instead of lists of row dictionaries. # noqa
+
     Args:
         event (dict):
             A dictionary containing the input data. It includes a list of file paths pointing to the raw data # noqa
@@ -35,8 +193,12 @@ def lambda_handler(
     Returns:
         dict: A dictionary containing the file paths of the transformed data stored in S3.
     """
+    if event.get("status") == "no-op":
+        logger.info("Extract found no changes, skipping transform.")
+        return {"status": "no-op", "filepaths": []}
+
     if client is None:
-        client = boto3.client("s3")
+        client = get_s3_client()
 
     if transformbucketname is None:
         transformbucketname = "totes-transform-bucket-20250227154810549700000001"
@@ -44,14 +206,52 @@ def lambda_handler(
     if extractbucketname is None:
         extractbucketname = "totes-extract-bucket-20250227154810549900000003"
 
-    loaded__files = read(event["filepaths"], client, bucketname=extractbucketname)
-    counterparty = loaded__files["counterparty"]
-    currency = loaded__files["currency"]
-    department = loaded__files["department"]
-    design = loaded__files["design"]
-    staff = loaded__files["staff"]
-    sales_order = loaded__files["sales_order"]
-    address = loaded__files["address"]
+    continuation = event.get("continuation")
+    state = {}
+    if continuation:
+        state = load_continuation(client, transformbucketname, continuation)
+        event = state["event"]
+
+    if not event["filepaths"]:
+        logger.info("Nothing extracted, skipping transform.")
+        return {"filepaths": []}
+
+    manifest = event.get("manifest")
+    if manifest:
+        layout = manifest.get("layout", "by-time")
+        run = manifest["run"]
+        prefix = manifest["prefix"]
+        file_paths = manifest_keys(manifest)
+        if not file_paths:
+            logger.info("Every extracted table is empty, skipping transform.")
+            return {"status": "no-op", "filepaths": []}
+    elif "/table=" in event["filepaths"][0]:
+        file_paths = event["filepaths"]
+        layout = "hive"
+        run = run_time(partition_values(file_paths[0])["run"])
+        prefix = run_manifest_prefix(run)
+    else:
+        file_paths = event["filepaths"]
+        layout = "by-time"
+        split = file_paths[0].split("/")
+        year, month, day, time = split[2], split[3], split[4], split[5]
+        prefix = f"data/by time/{year}/{month}/{day}/{time}"
+        run = f"{year}-{month[:2]}-{day} {time}"
+
+    loaded__files = read(
+        file_paths,
+        client,
+        bucketname=extractbucketname,
+        columnar=event.get("columnar", TRANSFORM_COLUMNAR),
+    )
+    # a backfill increment only carries the tables it reached, the rest are empty
+    counterparty = loaded__files.get("counterparty", [])
+    currency = loaded__files.get("currency", [])
+    department = loaded__files.get("department", [])
+    design = loaded__files.get("design", [])
+    staff = loaded__files.get("staff", [])
+    sales_order = loaded__files.get("sales_order", [])
+    address = loaded__files.get("address", [])
 
     # only needed for extension
 
@@ -60,152 +260,353 @@ def lambda_handler(
     # payment_type = loaded__files["payment_type"]
     # transaction = loaded__files["transaction"]
 
-    split = event["filepaths"][0].split("/")
-    year, month, day, time = split[2], split[3], split[4], split[5]
-
-    # Get file_exists flag from load_date_range
-    start_date, end_date, file_exists = load_date_range(
-        client, "date_table_last_date.json", bucketname=transformbucketname
-    )  # noqa
-    today = pd.to_datetime("today")
-    needs_update = (end_date - today).days <= 14 * 365
-
-    if (not file_exists) or needs_update:
-        if needs_update:
-            start_date = end_date
-            end_date = today + pd.DateOffset(years=50)
-
-            date_range = {
-                "start_date": start_date.strftime("%Y-%m-%d"),
-                "end_date": end_date.strftime("%Y-%m-%d"),
-            }  # noqa
-
-            save_date_range(
-                s3_client=client,
-                bucketname="totes-transform-bucket-20250227154810549700000001",
-                object_key="date_table_last_date.json",
-                date_range=date_range,
-            )
-
-        transformed_date = generate_date_table(start_date, end_date)
-    else:
-        transformed_date = pd.DataFrame([])
-
-    transformed_sales_order = transform_fact_sales_order(sales_order)
-    transformed_staff = transform_staff(staff, department)
-    transformed_location = transform_location(address)
-    transformed_design = transform_design(design)
-    transformed_currency = transform_currency(currency)
-    transformed_counterparty = transform_counterparty(address, counterparty)
-
-    write(
-        transformed_sales_order,
-        client,
-        f"data/by time/{year}/{month}/{day}/{time}/fact_sales_order",
-        bucketname=transformbucketname,
-    )
-    write(
-        transformed_staff,
-        client,
-        f"data/by time/{year}/{month}/{day}/{time}/dim_staff",
-        bucketname=transformbucketname,
-    )
-
-    write(
-        transformed_location,
-        client,
-        f"data/by time/{year}/{month}/{day}/{time}/dim_location",
-        bucketname=transformbucketname,
-    )
-
-    write(
-        transformed_design,
-        client,
-        f"data/by time/{year}/{month}/{day}/{time}/dim_design",
-        bucketname=transformbucketname,
-    )
-
-    write(
-        transformed_currency,
-        client,
-        f"data/by time/{year}/{month}/{day}/{time}/dim_currency",
-        bucketname=transformbucketname,
-    )
-
-    write(
-        transformed_counterparty,
-        client,
-        f"data/by time/{year}/{month}/{day}/{time}/dim_counterparty",
-        bucketname=transformbucketname,
-    )
+    def transform_date():
+        # Get file_exists flag from load_date_range
+        start_date, end_date, file_exists = load_date_range(
+            client, "date_table_last_date.json", bucketname=transformbucketname
+        )  # noqa
+        today = pd.to_datetime("today")
+        needs_update = (end_date - today).days <= 14 * 365
+
+        if (not file_exists) or needs_update:
+            if needs_update:
+                start_date = end_date
+                end_date = today + pd.DateOffset(years=50)
+
+                date_range = {
+                    "start_date": start_date.strftime("%Y-%m-%d"),
+                    "end_date": end_date.strftime("%Y-%m-%d"),
+                }  # noqa
+
+                save_date_range(
+                    s3_client=client,
+                    bucketname="totes-transform-bucket-20250227154810549700000001",
+                    object_key="date_table_last_date.json",
+                    date_range=date_range,
+                )
 
-    write(
-        transformed_date,
-        client,
-        f"data/by time/{year}/{month}/{day}/{time}/dim_date",
-        bucketname=transformbucketname,
-    )
+            return generate_date_table(start_date, end_date)
+        return pd.DataFrame([])
 
-    return {
-        "filepaths": [
-            f"data/by time/{year}/{month}/{day}/{time}/fact_sales_order.parquet",
-            f"data/by time/{year}/{month}/{day}/{time}/dim_staff.parquet",
-            f"data/by time/{year}/{month}/{day}/{time}/dim_location.parquet",
-            f"data/by time/{year}/{month}/{day}/{time}/dim_design.parquet",
-            f"data/by time/{year}/{month}/{day}/{time}/dim_currency.parquet",
-            f"data/by time/{year}/{month}/{day}/{time}/dim_counterparty.parquet",
-            f"data/by time/{year}/{month}/{day}/{time}/dim_date.parquet",
-        ]
+    # each output is only built when its turn comes, so a run can stop between tables
+    outputs = {
+        "fact_sales_order": lambda: transform_fact_sales_order(sales_order),
+        "dim_staff": lambda: transform_staff(staff, department),
+        "dim_location": lambda: transform_location(address),
+        "dim_design": lambda: transform_design(design),
+        "dim_currency": lambda: transform_currency(currency),
+        "dim_counterparty": lambda: transform_counterparty(address, counterparty),
+        "dim_date": transform_date,
     }
+    filenames = {
+        table: (
+            f"{partition_prefix(table, run)}/{table}"
+            if layout == "hive"
+            else f"{prefix}/{table}"
+        )
+        for table in outputs
+    }
+    done = list(state.get("done", []))
+    written = dict(state.get("written", {}))
+    uploads = {}
+
+    def finish_uploads():
+        for table, upload in uploads.items():
+            entry = upload.result()
+            if entry is None:
+                # failing the run keeps the extract watermarks where they are
+                raise RuntimeError(f"Failed to write {table}, stopping the run.")
+            written[table] = entry
+            done.append(table)
+        uploads.clear()
+
+    with ThreadPoolExecutor(max_workers=TRANSFORM_WORKERS) as pool:
+        for table, transform in outputs.items():
+            if table in done:
+                continue
+            if uploads and out_of_time(context):
+                finish_uploads()
+                continuation = save_continuation(
+                    client,
+                    transformbucketname,
+                    "transform",
+                    run,
+                    {"event": event, "done": done, "written": written},
+                )
+                logger.info(f"Out of time, {len(outputs) - len(done)} tables left.")
+                return {"status": "in-progress", "continuation": continuation}
+            uploads[table] = pool.submit(
+                write,
+                transform(),
+                client,
+                filenames[table],
+                bucketname=transformbucketname,
+            )
+        finish_uploads()
+    if continuation:
+        client.delete_object(Bucket=transformbucketname, Key=continuation)
+
+    if layout == "hive":
+        update_partition_index(client, transformbucketname, run, written)
+    result = {"filepaths": [f"{filenames[table]}.parquet" for table in outputs]}
+    if manifest:
+        result["manifest"] = write_manifest(
+            client,
+            transformbucketname,
+            "transform",
+            run,
+            prefix,
+            written,
+            layout=layout,
+        )
+    return result
 
 
 ################################ read each of the json files ######################################################## # noqa
 
 
 def read(
-    file_paths, client, bucketname="totes-extract-bucket-20250227154810549900000003"
+    file_paths,
+    client,
+    bucketname="totes-extract-bucket-20250227154810549900000003",
+    workers=TRANSFORM_WORKERS,
+    columnar=False,
 ):
     """
     Reads JSON files from extract lambda put in an S3 and returns their contents (source table data) as a dictionary. # noqa
 
     This function retrieves JSON files from the extract S3 bucket using the provided file paths, decodes the content, # noqa
     and stores it in a dictionary where the keys are table names derived from the file paths.
+    The decoder is picked from the "extract-format" metadata the extract lambda records on each object; # noqa
+    objects without it are treated as plain JSON. Parts of one table ("{table}/part-00001", ...) # noqa
+    are concatenated under the table's name, in the order their keys are given.
+
+    Up to `workers` objects are fetched and decoded at once, all through the one `client`. # noqa
+    A missing object is skipped; any other error is raised for the key it happened on.
+
+    With `columnar`, each object is parsed into an Arrow table typed from EXTRACT_SCHEMAS # noqa
+    (see decode_columnar) and every table is returned as a DataFrame, so no row is ever held # noqa
+    as Python objects.
 
     Args:
         file_paths (list): A list of file paths (S3 keys) to be read from the specified bucket.
         client (boto3.client): The S3 client instance used for interacting with Amazon S3.
         bucketname (str, optional): The S3 bucket name. Defaults to 'totes-extract-bucket-20250227154810549900000003'. # noqa
+        workers (int, optional): Maximum number of concurrent requests. Defaults to TRANSFORM_WORKERS. # noqa
+        columnar (bool, optional): Decode into typed DataFrames instead of lists of dictionaries. Defaults to False. # noqa
 
     Returns:
         dict: A dictionary where keys are table names (derived from file paths) and values are the JSON (raw) data loaded # noqa
-              from the respective files.
+              from the respective files, or with `columnar` a DataFrame of it.
     """
-    file_dict = {}
 
-    for file_path in file_paths:
+    def fetch(file_path):
         try:
             file = client.get_object(Bucket=bucketname, Key=file_path)
 
-            file_data = json.loads(file["Body"].read().decode("utf-8"))
+            extract_format = file.get("Metadata", {}).get("extract-format", "json")
 
-            table_name = file_path.split("/")[-1]
+            column_types = file.get("Metadata", {}).get("column-types")
 
-            file_dict[table_name] = file_data
+            if columnar:
+                file_data = decode_columnar(
+                    file["Body"].read(),
+                    extract_format,
+                    table_name_from_key(file_path),
+                    column_types,
+                )
+            else:
+                file_data = decode_extract(
+                    file["Body"].read(), extract_format, column_types
+                )
 
             logger.info("JSON file correctly read!")
+            return file_data
 
         except ClientError as e:
             if e.response["Error"]["Code"] == "NoSuchKey":
                 logger.error(
                     f"ERROR! Warning: File {file_path} does not exist in S3. Skipping."
                 )
+                return None
+            logger.error(f"ERROR! Couldn't read {file_path}: {e}")
+            raise
+
+    file_dict = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for file_path, file_data in zip(file_paths, pool.map(fetch, file_paths)):
+            if file_data is None:
                 continue
+
+            table_name = table_name_from_key(file_path)
+
+            if table_name in file_dict:
+                # a table written in parts (e.g. by a backfill) is read back as one
+                file_dict[table_name] = (
+                    pa.concat_tables(
+                        [file_dict[table_name], file_data], promote_options="default"
+                    )
+                    if columnar
+                    else file_dict[table_name] + file_data
+                )
             else:
-                raise
+                file_dict[table_name] = file_data
 
+    if columnar:
+        return {name: table.to_pandas() for name, table in file_dict.items()}
     return file_dict
 
 
+def table_name_from_key(file_path):
+    """Returns the table an extract key belongs to, allowing for "/part-00001" suffixes."""
+    segments = file_path.split("/")
+    if segments[-1].startswith("part-"):
+        return segments[-2]
+    return segments[-1]
+
+
+def decode_extract(body, extract_format="json", column_types=None):
+    """
+    Decodes the bytes of one extract object into a list of row dictionaries.
+
+    Args:
+        body (bytes): The raw object body.
+        extract_format (str, optional): The format recorded by the extract lambda. Defaults to 'json'. # noqa
+        column_types (str, optional): Comma separated PostgreSQL type oids, recorded with csv.gz extracts. # noqa
+
+    Returns:
+        list: The decoded rows.
+    """
+    if extract_format == "json":
+        return json.loads(body)
+    if extract_format in ("ndjson.gz", "ndjson.zst"):
+        lines = decompress_ndjson(body, extract_format)
+        # one object per line, so joining the lines with commas gives a single JSON array
+        return json.loads(b"[" + b",".join(lines.splitlines()) + b"]")
+    if extract_format == "parquet":
+        return pq.read_table(io.BytesIO(body)).to_pylist()
+    if extract_format == "csv.gz":
+        return decode_copy_csv(gzip.decompress(body), column_types)
+    raise ValueError(f"Unknown extract format: {extract_format}")
+
+
+def decompress_ndjson(body, extract_format):
+    """Returns the newline delimited JSON inside an ndjson.gz or ndjson.zst object."""
+    if extract_format == "ndjson.gz":
+        return gzip.decompress(body)
+    if zstandard is None:
+        raise ValueError("ndjson.zst needs the zstandard package")
+    return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+
+def decode_columnar(body, extract_format="json", table=None, column_types=None):
+    """
+    Decodes the bytes of one extract object into an Arrow table, typed from EXTRACT_SCHEMAS. # noqa
+
+    ndjson and csv.gz objects are parsed by Arrow's own readers straight into columns with # noqa
+    the table's schema, so no row becomes a Python object on the way. Parquet is cast to the # noqa
+    schema; the legacy json array is still parsed by json.loads first. Columns keep the order # noqa
+    they have in the object, and columns missing from it stay missing, as with decode_extract. # noqa
+
+    Args:
+        body (bytes): The raw object body.
+        extract_format (str, optional): The format recorded by the extract lambda. Defaults to 'json'. # noqa
+        table (str, optional): The source table, to look its schema up in EXTRACT_SCHEMAS. Defaults to none. # noqa
+        column_types (str, optional): Unused; csv.gz columns are typed from the schema. # noqa
+
+    Returns:
+        pyarrow.Table: The decoded columns.
+    """
+    types = EXTRACT_SCHEMAS.get(table, {})
+    if extract_format == "json":
+        return cast_columns(pa.Table.from_pylist(json.loads(body)), types)
+    if extract_format in ("ndjson.gz", "ndjson.zst"):
+        lines = decompress_ndjson(body, extract_format)
+        if not lines.strip():
+            return pa.table({})
+        # every line has every column, so the first one gives the columns and their order
+        columns = list(json.loads(lines.split(b"\n", 1)[0]))
+        table = pa_json.read_json(
+            io.BytesIO(lines),
+            parse_options=pa_json.ParseOptions(
+                explicit_schema=pa.schema(
+                    [(column, types[column]) for column in columns if column in types]
+                ),
+                unexpected_field_behavior="infer",
+            ),
+        )
+        return table.select(columns)
+    if extract_format == "parquet":
+        return cast_columns(pq.read_table(io.BytesIO(body)), types)
+    if extract_format == "csv.gz":
+        return pa_csv.read_csv(
+            io.BytesIO(gzip.decompress(body)),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=types,
+                null_values=["\\N"],
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False,
+                true_values=["t"],
+                false_values=["f"],
+            ),
+        )
+    raise ValueError(f"Unknown extract format: {extract_format}")
+
+
+def cast_columns(table, types):
+    """Casts the columns of an Arrow table that have an entry in `types` to that type."""
+    return table.cast(
+        pa.schema(
+            [
+                pa.field(field.name, types.get(field.name, field.type))
+                for field in table.schema
+            ]
+        )
+    )
+
+
+# PostgreSQL type oid -> how to turn the COPY text of a value back into what the json extract holds # noqa
+CSV_CONVERTERS = {
+    16: lambda value: value == "t",
+    20: int,
+    21: int,
+    23: int,
+    700: float,
+    701: float,
+    1700: float,
+    1114: lambda value: pd.Timestamp(value).strftime("%Y-%m-%d %H:%M:%S.%f"),
+}
+
+
+def decode_copy_csv(data, column_types=None):
+    """
+    Decodes the CSV written by the extract lambda's COPY path into a list of row dictionaries. # noqa
+
+    Every value is read as text and \\N as NULL, then converted by column type so the rows match # noqa
+    those of the json extract.
+
+    Args:
+        data (bytes): The uncompressed CSV, with a header row.
+        column_types (str, optional): Comma separated PostgreSQL type oids, in column order.
+
+    Returns:
+        list: The decoded rows.
+    """
+    df = pd.read_csv(
+        io.BytesIO(data),
+        dtype=object,
+        keep_default_na=False,
+        na_values=["\\N"],
+    )
+    types = [int(oid) for oid in column_types.split(",")] if column_types else []
+    for column, oid in zip(df.columns, types):
+        if oid in CSV_CONVERTERS:
+            df[column] = df[column].map(CSV_CONVERTERS[oid], na_action="ignore")
+    df = df.astype(object)
+    return df.where(df.notna(), None).to_dict("records")
+
+
 def write(
     transformed_dataframe,
     client,
@@ -225,7 +626,7 @@ def write(
         bucketname (str, optional): The name of the S3 bucket. Defaults to 'totes-transform-bucket-20250227154810549700000001'. # noqa
 
     Returns:
-        None
+        dict: The object's run manifest entry, or None if it couldn't be written.
     """
     try:
         parquet_file = transformed_dataframe.to_parquet(index=True)
@@ -238,10 +639,33 @@ def write(
             Body=parquet_file,
         )
 
+        return manifest_entry(
+            f"{filename}.parquet",
+            len(transformed_dataframe),
+            len(parquet_file),
+            hashlib.sha256(parquet_file).hexdigest(),
+            transformed_dataframe.dtypes.astype(str).to_dict(),
+        )
+
     except Exception as e:
         logger.error(f"ERROR! Failed to upload transformed data to S3. Error: {e}")
 
 
+def has_rows(rows):
+    """Whether a table read by `read` has any rows, as a list or (columnar) a DataFrame."""
+    return rows is not None and len(rows) > 0
+
+
+def as_frame(rows):
+    """
+    Returns a table read by `read` as a DataFrame the caller can change in place. A columnar # noqa
+    DataFrame is copied shallowly, so the same source table can feed several transforms.
+    """
+    if isinstance(rows, pd.DataFrame):
+        return rows.copy(deep=False)
+    return pd.DataFrame(rows)
+
+
 ###################################### transform the data for dim location table ###################################   # noqa
 
 
@@ -251,14 +675,14 @@ def transform_location(address):
     and sorting columns.
 
     Args:
-        address (list of dict): Location data to be transformed.
+        address (list of dict or pandas.DataFrame): Location data to be transformed.
 
     Returns:
         pandas.DataFrame: Transformed data or an empty DataFrame if the transformation fails.
     """
     # try:
-    if address:
-        df = pd.DataFrame(address)
+    if has_rows(address):
+        df = as_frame(address)
 
         logger.info(f"Columns in address DataFrame: {df.columns}")
 
@@ -289,20 +713,20 @@ def transform_staff(staff_data, department_data):
     Transforms staff data by merging with department data and formatting columns.
 
     Args:
-        staff_data (list of dict): Staff data to be transformed.
-        department_data (list of dict): Department data to merge with staff data.
+        staff_data (list of dict or pandas.DataFrame): Staff data to be transformed.
+        department_data (list of dict or pandas.DataFrame): Department data to merge with staff data. # noqa
 
     Returns:
         pandas.DataFrame: Transformed staff data or an empty DataFrame if input data is missing.
     """
     # try:
-    if staff_data and department_data:
-        staff_df = pd.DataFrame(staff_data)
+    if has_rows(staff_data) and has_rows(department_data):
+        staff_df = as_frame(staff_data)
 
         if "created_at" in staff_df.columns and "last_updated" in staff_df.columns:
             staff_df.drop(columns=["created_at", "last_updated"], inplace=True)
 
-        dep_df = pd.DataFrame(department_data)
+        dep_df = as_frame(department_data)
 
         if "created_at" in dep_df.columns and "last_updated" in dep_df.columns:
             dep_df.drop(columns=["created_at", "last_updated"], inplace=True)
@@ -349,7 +773,7 @@ def load_date_range(s3_client, object_key, bucketname):
             - start_date (datetime): The start date of the range.
             - end_date (datetime): The end date of the range.
             - file_exists (bool): Flag indicating whether the file was found (True) or not (False).
-    """ # noqa
+    """  # noqa
     try:
         response = s3_client.get_object(Bucket=bucketname, Key=object_key)
         date_range = json.load(response["Body"])
@@ -396,7 +820,7 @@ def generate_date_table(start_date, end_date):
     Returns:
         pandas.DataFrame: A DataFrame containing the date table with columns like 'year', 'month', 'day',
                           'day_of_week', 'day_name', 'month_name', 'quarter', and 'date_id'.
-    """ # noqa
+    """  # noqa
     dates = pd.date_range(start=start_date, end=end_date, freq="D")
     date_table = pd.DataFrame({"date_id": dates})
     date_table["year"] = date_table["date_id"].dt.year
@@ -419,14 +843,14 @@ def transform_design(design):
     and sorting by design_id.
 
     Args:
-        design (list of dict): Design data to be transformed.
+        design (list of dict or pandas.DataFrame): Design data to be transformed.
 
     Returns:
         pandas.DataFrame: Transformed design data or an empty DataFrame if input data is missing.
     """
     # try:
-    if design:
-        df = pd.DataFrame(design)
+    if has_rows(design):
+        df = as_frame(design)
 
         if "created_at" in df.columns and "last_updated" in df.columns:
             df.drop(columns=["created_at", "last_updated"], inplace=True)
@@ -446,16 +870,196 @@ def transform_design(design):
 ############################# transform currency ############################## noqa
 
 
+# ISO 4217 code -> currency name, as pycountry 24.6.1 has them. Shipped with the code so
+# the lambda doesn't have to load pycountry's whole database to name a handful of codes.
+CURRENCY_NAMES = {
+    "AED": "UAE Dirham",
+    "AFN": "Afghani",
+    "ALL": "Lek",
+    "AMD": "Armenian Dram",
+    "ANG": "Netherlands Antillean Guilder",
+    "AOA": "Kwanza",
+    "ARS": "Argentine Peso",
+    "AUD": "Australian Dollar",
+    "AWG": "Aruban Florin",
+    "AZN": "Azerbaijan Manat",
+    "BAM": "Convertible Mark",
+    "BBD": "Barbados Dollar",
+    "BDT": "Taka",
+    "BGN": "Bulgarian Lev",
+    "BHD": "Bahraini Dinar",
+    "BIF": "Burundi Franc",
+    "BMD": "Bermudian Dollar",
+    "BND": "Brunei Dollar",
+    "BOB": "Boliviano",
+    "BOV": "Mvdol",
+    "BRL": "Brazilian Real",
+    "BSD": "Bahamian Dollar",
+    "BTN": "Ngultrum",
+    "BWP": "Pula",
+    "BYN": "Belarusian Ruble",
+    "BZD": "Belize Dollar",
+    "CAD": "Canadian Dollar",
+    "CDF": "Congolese Franc",
+    "CHE": "WIR Euro",
+    "CHF": "Swiss Franc",
+    "CHW": "WIR Franc",
+    "CLF": "Unidad de Fomento",
+    "CLP": "Chilean Peso",
+    "CNY": "Yuan Renminbi",
+    "COP": "Colombian Peso",
+    "COU": "Unidad de Valor Real",
+    "CRC": "Costa Rican Colon",
+    "CUC": "Peso Convertible",
+    "CUP": "Cuban Peso",
+    "CVE": "Cabo Verde Escudo",
+    "CZK": "Czech Koruna",
+    "DJF": "Djibouti Franc",
+    "DKK": "Danish Krone",
+    "DOP": "Dominican Peso",
+    "DZD": "Algerian Dinar",
+    "EGP": "Egyptian Pound",
+    "ERN": "Nakfa",
+    "ETB": "Ethiopian Birr",
+    "EUR": "Euro",
+    "FJD": "Fiji Dollar",
+    "FKP": "Falkland Islands Pound",
+    "GBP": "Pound Sterling",
+    "GEL": "Lari",
+    "GHS": "Ghana Cedi",
+    "GIP": "Gibraltar Pound",
+    "GMD": "Dalasi",
+    "GNF": "Guinean Franc",
+    "GTQ": "Quetzal",
+    "GYD": "Guyana Dollar",
+    "HKD": "Hong Kong Dollar",
+    "HNL": "Lempira",
+    "HRK": "Kuna",
+    "HTG": "Gourde",
+    "HUF": "Forint",
+    "IDR": "Rupiah",
+    "ILS": "New Israeli Sheqel",
+    "INR": "Indian Rupee",
+    "IQD": "Iraqi Dinar",
+    "IRR": "Iranian Rial",
+    "ISK": "Iceland Krona",
+    "JMD": "Jamaican Dollar",
+    "JOD": "Jordanian Dinar",
+    "JPY": "Yen",
+    "KES": "Kenyan Shilling",
+    "KGS": "Som",
+    "KHR": "Riel",
+    "KMF": "Comorian Franc",
+    "KPW": "North Korean Won",
+    "KRW": "Won",
+    "KWD": "Kuwaiti Dinar",
+    "KYD": "Cayman Islands Dollar",
+    "KZT": "Tenge",
+    "LAK": "Lao Kip",
+    "LBP": "Lebanese Pound",
+    "LKR": "Sri Lanka Rupee",
+    "LRD": "Liberian Dollar",
+    "LSL": "Loti",
+    "LYD": "Libyan Dinar",
+    "MAD": "Moroccan Dirham",
+    "MDL": "Moldovan Leu",
+    "MGA": "Malagasy Ariary",
+    "MKD": "Denar",
+    "MMK": "Kyat",
+    "MNT": "Tugrik",
+    "MOP": "Pataca",
+    "MRU": "Ouguiya",
+    "MUR": "Mauritius Rupee",
+    "MVR": "Rufiyaa",
+    "MWK": "Malawi Kwacha",
+    "MXN": "Mexican Peso",
+    "MXV": "Mexican Unidad de Inversion (UDI)",
+    "MYR": "Malaysian Ringgit",
+    "MZN": "Mozambique Metical",
+    "NAD": "Namibia Dollar",
+    "NGN": "Naira",
+    "NIO": "Cordoba Oro",
+    "NOK": "Norwegian Krone",
+    "NPR": "Nepalese Rupee",
+    "NZD": "New Zealand Dollar",
+    "OMR": "Rial Omani",
+    "PAB": "Balboa",
+    "PEN": "Sol",
+    "PGK": "Kina",
+    "PHP": "Philippine Peso",
+    "PKR": "Pakistan Rupee",
+    "PLN": "Zloty",
+    "PYG": "Guarani",
+    "QAR": "Qatari Rial",
+    "RON": "Romanian Leu",
+    "RSD": "Serbian Dinar",
+    "RUB": "Russian Ruble",
+    "RWF": "Rwanda Franc",
+    "SAR": "Saudi Riyal",
+    "SBD": "Solomon Islands Dollar",
+    "SCR": "Seychelles Rupee",
+    "SDG": "Sudanese Pound",
+    "SEK": "Swedish Krona",
+    "SGD": "Singapore Dollar",
+    "SHP": "Saint Helena Pound",
+    "SLE": "Leone",
+    "SLL": "Leone",
+    "SOS": "Somali Shilling",
+    "SRD": "Surinam Dollar",
+    "SSP": "South Sudanese Pound",
+    "STN": "Dobra",
+    "SVC": "El Salvador Colon",
+    "SYP": "Syrian Pound",
+    "SZL": "Lilangeni",
+    "THB": "Baht",
+    "TJS": "Somoni",
+    "TMT": "Turkmenistan New Manat",
+    "TND": "Tunisian Dinar",
+    "TOP": "Pa\u2019anga",
+    "TRY": "Turkish Lira",
+    "TTD": "Trinidad and Tobago Dollar",
+    "TWD": "New Taiwan Dollar",
+    "TZS": "Tanzanian Shilling",
+    "UAH": "Hryvnia",
+    "UGX": "Uganda Shilling",
+    "USD": "US Dollar",
+    "USN": "US Dollar (Next day)",
+    "UYI": "Uruguay Peso en Unidades Indexadas (UI)",
+    "UYU": "Peso Uruguayo",
+    "UYW": "Unidad Previsional",
+    "UZS": "Uzbekistan Sum",
+    "VED": "Bol\u00edvar Soberano",
+    "VES": "Bol\u00edvar Soberano",
+    "VND": "Dong",
+    "VUV": "Vatu",
+    "WST": "Tala",
+    "XAF": "CFA Franc BEAC",
+    "XAG": "Silver",
+    "XAU": "Gold",
+    "XBA": "Bond Markets Unit European Composite Unit (EURCO)",
+    "XBB": "Bond Markets Unit European Monetary Unit (E.M.U.-6)",
+    "XBC": "Bond Markets Unit European Unit of Account 9 (E.U.A.-9)",
+    "XBD": "Bond Markets Unit European Unit of Account 17 (E.U.A.-17)",
+    "XCD": "East Caribbean Dollar",
+    "XDR": "SDR (Special Drawing Right)",
+    "XOF": "CFA Franc BCEAO",
+    "XPD": "Palladium",
+    "XPF": "CFP Franc",
+    "XPT": "Platinum",
+    "XSU": "Sucre",
+    "XTS": "Codes specifically reserved for testing purposes",
+    "XUA": "ADB Unit of Account",
+    "XXX": "The codes assigned for transactions where no currency is involved",
+    "YER": "Yemeni Rial",
+    "ZAR": "Rand",
+    "ZMW": "Zambian Kwacha",
+    "ZWL": "Zimbabwe Dollar",
+}
+
+
 def get_currency_name(currency_code: str):
-    """Returns the full currency name given a currency code."""
-    # try:
-    currency = pycountry.currencies.get(alpha_3=currency_code.upper())
-    if currency:
-        return currency.name
-    else:
-        return None
-    # except AttributeError:
-    #     return None
+    """Returns the full currency name given a currency code, or None for an unknown code."""
+    return CURRENCY_NAMES.get(currency_code.upper())
 
 
 def transform_currency(currency):
@@ -463,17 +1067,18 @@ def transform_currency(currency):
     Transforms currency data by adding a currency name and sorting by currency_id.
 
     Args:
-        currency (list of dict): Currency data to be transformed.
+        currency (list of dict or pandas.DataFrame): Currency data to be transformed.
 
     Returns:
         pandas.DataFrame: Transformed currency data or an empty DataFrame if input data is missing.
     """
     # try:
-    if currency:
-        df = pd.DataFrame(currency)
+    if has_rows(currency):
+        df = as_frame(currency)
 
         if "currency_code" in df.columns:
-            df["currency_name"] = df["currency_code"].apply(get_currency_name)
+            # one vectorised lookup for the whole column rather than a call per row
+            df["currency_name"] = df["currency_code"].str.upper().map(CURRENCY_NAMES)
         else:
             df["currency_name"] = None
 
@@ -498,17 +1103,17 @@ def transform_counterparty(address, counterparty):
     Transforms counterparty and address data by merging and renaming columns to match the warehouse schema. # noqa
 
     Args:
-        address (list or dict): Address data to be merged with counterparty data.
-        counterparty (list or dict): Counterparty data to be transformed.
+        address (list or pandas.DataFrame): Address data to be merged with counterparty data. # noqa
+        counterparty (list or pandas.DataFrame): Counterparty data to be transformed.
 
     Returns:
         pandas.DataFrame: Transformed counterparty data or an empty DataFrame if input data is missing.
 
     """
     # try:
-    if counterparty and address:
-        counterparty_df = pd.DataFrame(counterparty)
-        address_df = pd.DataFrame(address)
+    if has_rows(counterparty) and has_rows(address):
+        counterparty_df = as_frame(counterparty)
+        address_df = as_frame(address)
 
         if (
             "created_at" in counterparty_df.columns
@@ -567,15 +1172,15 @@ def transform_counterparty(address, counterparty):
 
 
 def transform_fact_sales_order(sales_order):
-    """ # noqa
+    """# noqa
     Transforms raw sales order data to match the warehouse schema, including date formatting and renaming columns.
 
     Args:
-        sales_order (list of dict): Raw sales order data to be transformed.
+        sales_order (list of dict or pandas.DataFrame): Raw sales order data to be transformed.
 
     Returns:
         pandas.DataFrame: Transformed sales order data or an empty DataFrame if input data is empty or invalid.
-    """ # noqa
+    """  # noqa
     expected_columns = [
         "sales_order_id",
         "created_date",
@@ -593,7 +1198,7 @@ def transform_fact_sales_order(sales_order):
         "agreed_delivery_location_id",
     ]
     # try:
-    sales_order_df = pd.DataFrame(sales_order)
+    sales_order_df = as_frame(sales_order)
     if sales_order_df.empty:
         return pd.DataFrame([])
 
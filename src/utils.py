@@ -1,4 +1,11 @@
+import atexit
+import hashlib
 import json
+import os
+import signal
+from functools import partial
+import threading
+import time
 import boto3
 import pg8000
 from botocore.exceptions import ClientError
@@ -7,22 +14,337 @@ import logging
 logger = logging.getLogger("utils_logger")
 logger.setLevel(logging.INFO)
 
+# Seconds a secret is trusted before it is fetched again
+CREDENTIALS_TTL = 300
+AUTH_ERROR_CODES = ("28P01", "28000")
 
-def get_db_credentials(secret_name, region_name="eu-west-2"):
+# (secret_name, region_name) -> (expires_at, secret)
+_credentials_cache = {}
+_secrets_clients = {}
+_credentials_lock = threading.Lock()
+
+# Connections kept alive between warm invocations, keyed by secret name
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Key layouts for the extract and transform buckets, see partition_prefix
+LAYOUTS = ("by-time", "hive")
+PARTITION_ROOT = "data"
+PARTITION_INDEX = "_index.json"
+
+# Where a stage that ran out of time leaves its progress, see save_continuation
+CONTINUATION_PREFIX = "continuations"
+CONTINUATION_MARGIN_MS = 60000
+
+
+def manifest_entry(key, row_count, byte_size, checksum, schema, updated=(None, None)):
+    """
+    Describes one table's object for a run manifest.
+
+    Args:
+        key (str): The object's S3 key.
+        row_count (int): Rows written.
+        byte_size (int): Size of the object body.
+        checksum (str): Hex sha256 of the object body.
+        schema: Any JSON serialisable description of the columns, hashed so a stage can tell
+            when a table's schema changes.
+        updated (tuple, optional): The oldest and newest last_updated written.
+
+    Returns:
+        dict: The manifest entry.
+    """
+    schema = json.dumps(schema, default=str)
+    return {
+        "key": key,
+        "row_count": row_count,
+        "byte_size": byte_size,
+        "sha256": checksum,
+        "min_last_updated": updated[0],
+        "max_last_updated": updated[1],
+        "schema_hash": hashlib.sha256(schema.encode("utf-8")).hexdigest()[:16],
+    }
+
+
+def combine_entries(key, parts):
+    """
+    Describes a table written as several part objects as one manifest entry.
+
+    Row counts and byte sizes are summed and the last_updated range spans every part. The
+    parts' own entries are kept under "parts", in order, so a stage can read them all; there
+    is no checksum for the table as a whole.
+
+    Args:
+        key (str): The prefix the parts were written under.
+        parts (list): The manifest_entry of every part, in order.
+
+    Returns:
+        dict: The manifest entry.
+    """
+    oldest = [part["min_last_updated"] for part in parts if part["min_last_updated"]]
+    newest = [part["max_last_updated"] for part in parts if part["max_last_updated"]]
+    return {
+        "key": key,
+        "row_count": sum(part["row_count"] for part in parts),
+        "byte_size": sum(part["byte_size"] for part in parts),
+        "sha256": None,
+        "min_last_updated": min(oldest, default=None),
+        "max_last_updated": max(newest, default=None),
+        "schema_hash": parts[0]["schema_hash"] if parts else None,
+        "parts": parts,
+    }
+
+
+def manifest_keys(manifest):
+    """Returns the keys of every non-empty object in a manifest, expanding tables written in parts."""  # noqa
+    return [
+        part["key"]
+        for entry in manifest["tables"].values()
+        if entry["row_count"]
+        for part in entry.get("parts", [entry])
+        if part["row_count"]
+    ]
+
+
+def write_manifest(s3_client, bucketname, stage, run, prefix, tables, layout="by-time"):
+    """
+    Writes a run manifest to "{prefix}/_manifest.json" and returns it.
+
+    The manifest is also passed on in the handler's result, so the next stage can see which
+    tables are empty, how big each object is and whether a schema changed without reading
+    any objects. It records the key layout the run was written in, so the next stage can
+    write its own objects the same way.
+
+    Args:
+        s3_client (boto3.client): The S3 client instance.
+        bucketname (str): The S3 bucket name.
+        stage (str): The stage writing the manifest, e.g. "extract".
+        run (str): The timestamp of the run.
+        prefix (str): The run's key prefix.
+        tables (dict): Table name to manifest_entry.
+        layout (str, optional): One of LAYOUTS. Defaults to "by-time".
+
+    Returns:
+        dict: The manifest.
+    """
+    manifest = {
+        "stage": stage,
+        "run": run,
+        "layout": layout,
+        "prefix": prefix,
+        "tables": tables,
+    }
+    s3_client.put_object(
+        Bucket=bucketname,
+        Key=f"{prefix}/_manifest.json",
+        Body=json.dumps(manifest),
+        ContentType="application/json",
+    )
+    return manifest
+
+
+def run_id(run):
+    """Turns a run timestamp into the form used in keys, e.g. "20250307T221713.872739"."""
+    return run.replace("-", "").replace(":", "").replace(" ", "T")
+
+
+def run_time(run_id):
+    """The inverse of run_id."""
+    day, time_of_day = run_id.split("T")
+    return (
+        f"{day[:4]}-{day[4:6]}-{day[6:]} "
+        f"{time_of_day[:2]}:{time_of_day[2:4]}:{time_of_day[4:]}"
+    )
+
+
+def partition_prefix(table, run):
+    """
+    Returns the Hive style prefix a table's objects for a run are written under.
+
+    Keys look like "data/table=sales_order/dt=2025-03-07/run=20250307T221713.872739", so
+    they sort by date and run and a date range of one table can be found by listing
+    "data/table=sales_order/dt=" without touching the rest of the bucket.
+
+    Args:
+        table (str): The table name.
+        run (str): The timestamp of the run.
+
+    Returns:
+        str: The prefix, without a trailing slash.
+    """
+    return f"{PARTITION_ROOT}/table={table}/dt={run.split(' ')[0]}/run={run_id(run)}"
+
+
+def partition_values(key):
+    """Returns the "name=value" segments of a Hive style key as a dictionary."""
+    return dict(segment.split("=", 1) for segment in key.split("/") if "=" in segment)
+
+
+def run_manifest_prefix(run):
+    """Returns the prefix a Hive style run's manifest is written under."""
+    return f"{PARTITION_ROOT}/_runs/dt={run.split(' ')[0]}/run={run_id(run)}"
+
+
+def update_partition_index(s3_client, bucketname, run, tables):
+    """
+    Records a run in the index object of every table partition it wrote to.
+
+    Each "data/table=.../dt=.../_index.json" lists the runs in that partition with their
+    keys and row counts, so a date range can be reprocessed from the indexes alone. A run
+    already in the index is replaced rather than listed twice.
+
+    Args:
+        s3_client (boto3.client): The S3 client instance.
+        bucketname (str): The S3 bucket name.
+        run (str): The timestamp of the run.
+        tables (dict): Table name to manifest_entry, as passed to write_manifest.
+    """
+    for table, entry in tables.items():
+        partition = partition_prefix(table, run).rsplit("/", 1)[0]
+        key = f"{partition}/{PARTITION_INDEX}"
+        try:
+            response = s3_client.get_object(Bucket=bucketname, Key=key)
+            index = json.loads(response["Body"].read())
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                logger.error(f"ERROR! Issues reading partition index {key}.")
+                raise
+            index = {"table": table, "dt": run.split(" ")[0], "runs": []}
+        index["runs"] = [r for r in index["runs"] if r["run"] != run_id(run)]
+        index["runs"].append(
+            {"run": run_id(run), "key": entry["key"], "row_count": entry["row_count"]}
+        )
+        index["runs"].sort(key=lambda r: r["run"])
+        s3_client.put_object(
+            Bucket=bucketname,
+            Key=key,
+            Body=json.dumps(index),
+            ContentType="application/json",
+        )
+
+
+def out_of_time(context, margin_ms=CONTINUATION_MARGIN_MS):
+    """Whether a Lambda is within `margin_ms` of its timeout; never for a context without a clock."""  # noqa
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    return remaining is not None and remaining() < margin_ms
+
+
+def save_continuation(s3_client, bucketname, stage, run, state):
+    """
+    Persists a stage's partial progress and returns the continuation token for it.
+
+    A handler that stops early returns {"continuation": token}; the state machine calls it
+    again with the token until it finishes. The token is just the object's key, so the state
+    passed between steps stays small however much progress there is.
+
+    Args:
+        s3_client (boto3.client): The S3 client instance.
+        bucketname (str): The S3 bucket name.
+        stage (str): The stage, e.g. "transform".
+        run (str): The timestamp of the run.
+        state (dict): Anything JSON serialisable the stage needs to carry on.
+
+    Returns:
+        str: The continuation token.
+    """
+    key = f"{CONTINUATION_PREFIX}/{stage}/{run.replace(' ', 'T')}.json"
+    s3_client.put_object(
+        Bucket=bucketname,
+        Key=key,
+        Body=json.dumps(state, default=str),
+        ContentType="application/json",
+    )
+    logger.info(f"Out of time, {stage} will continue from {key}.")
+    return key
+
+
+def load_continuation(s3_client, bucketname, token):
+    """Reads back the state saved by save_continuation."""
+    response = s3_client.get_object(Bucket=bucketname, Key=token)
+    return json.loads(response["Body"].read())
+
+
+def get_db_credentials(secret_name, region_name="eu-west-2", ttl=None, refresh=False):
     """
     Fetch database credentials from AWS Secrets Manager.
+
+    Secrets are cached in-process for CREDENTIALS_TTL seconds (overridable with the
+    CREDENTIALS_TTL_SECONDS environment variable or the ttl argument), so warm
+    invocations don't pay a Secrets Manager round trip. Pass refresh=True to bypass
+    the cache, e.g. after the database rejects the cached password.
     """
-    client = boto3.client("secretsmanager", region_name=region_name)
+    key = (secret_name, region_name)
+    if not refresh:
+        cached = cached_credentials(key)
+        if cached is not None:
+            return cached
+
+    client = get_secrets_client(region_name)
 
     try:
         response = client.get_secret_value(SecretId=secret_name)
         secret = json.loads(response["SecretString"])
+        cache_credentials(key, secret, ttl)
         return secret
     except Exception as e:
         logger.error(f"ERROR! couldn't retrieve secret: {e}")
         raise
 
 
+def get_secrets_client(region_name):
+    """
+    Returns a Secrets Manager client for the region, created once per process.
+    """
+    with _credentials_lock:
+        if region_name not in _secrets_clients:
+            _secrets_clients[region_name] = boto3.client(
+                "secretsmanager", region_name=region_name
+            )
+        return _secrets_clients[region_name]
+
+
+def cached_credentials(key):
+    """
+    Returns the cached secret for (secret_name, region_name), or None if it is missing
+    or has expired.
+    """
+    with _credentials_lock:
+        cached = _credentials_cache.get(key)
+    if cached is None or cached[0] <= time.monotonic():
+        return None
+    return cached[1]
+
+
+def cache_credentials(key, secret, ttl=None):
+    if ttl is None:
+        ttl = float(os.environ.get("CREDENTIALS_TTL_SECONDS", CREDENTIALS_TTL))
+    with _credentials_lock:
+        _credentials_cache[key] = (time.monotonic() + ttl, secret)
+
+
+def invalidate_credentials(secret_name=None):
+    """
+    Drops cached credentials for one secret, or all of them.
+    """
+    with _credentials_lock:
+        for key in list(_credentials_cache):
+            if secret_name is None or key[0] == secret_name:
+                del _credentials_cache[key]
+        if secret_name is None:
+            _secrets_clients.clear()
+
+
+def is_auth_error(error):
+    """
+    Whether a connection error means the password was rejected (SQLSTATE 28P01/28000),
+    looking through SQLAlchemy's wrapper to the pg8000 error if there is one.
+    """
+    error = getattr(error, "orig", None) or error
+    for arg in getattr(error, "args", ()):
+        if isinstance(arg, dict) and arg.get("C") in AUTH_ERROR_CODES:
+            return True
+    return "password authentication failed" in str(error)
+
+
 def connect_to_database(
     secret_name="project_database_credentials", region_name="eu-west-2"
 ):
@@ -34,13 +356,57 @@ def connect_to_database(
 
         credentials = get_db_credentials(secret_name, region_name)
 
-        conn = pg8000.connect(
-            user=credentials["user"],
-            password=credentials["password"],
-            host=credentials["host"],
-            port=int(credentials["port"]),
-            database=credentials["database"],
-        )
+        conn, credentials = open_with_refresh(secret_name, region_name, credentials)
+
+        print("Database connection successful!")  # nosec
+        return conn
+
+    except ClientError as err:
+        logger.error(f"ERROR! Failed to retrieve database credentials:{err}")
+        raise
+    except Exception as e:
+        logger.error(f"ERROR! couldn't connect to database: {e}")
+        raise
+
+
+def open_connection(credentials):
+    """
+    Opens a new pg8000 connection from a credentials dictionary.
+    """
+    return pg8000.connect(
+        user=credentials["user"],
+        password=credentials["password"],
+        host=credentials["host"],
+        port=int(credentials["port"]),
+        database=credentials["database"],
+    )
+
+
+def get_connection(secret_name="project_database_credentials", region_name="eu-west-2"):
+    """
+    Returns a database connection that is kept open across warm Lambda invocations.
+
+    A connection left over from a previous invocation is reused if it passes a cheap
+    liveness check and the credentials it was opened with haven't been rotated.
+    Otherwise it is closed and replaced with a new one.
+    """
+    try:
+        credentials = get_db_credentials(secret_name, region_name)
+        fingerprint = credentials_fingerprint(credentials)
+
+        with _connections_lock:
+            cached = _connections.pop(secret_name, None)
+            if cached is not None:
+                conn, cached_fingerprint = cached
+                if cached_fingerprint == fingerprint and is_alive(conn):
+                    _connections[secret_name] = cached
+                    logger.info("Reusing pooled database connection.")
+                    return conn
+                logger.info("Pooled connection is stale or credentials rotated.")
+                close_quietly(conn)
+
+            conn, credentials = open_with_refresh(secret_name, region_name, credentials)
+            _connections[secret_name] = (conn, credentials_fingerprint(credentials))
 
         print("Database connection successful!")  # nosec
         return conn
@@ -51,3 +417,93 @@ def connect_to_database(
     except Exception as e:
         logger.error(f"ERROR! couldn't connect to database: {e}")
         raise
+
+
+def open_with_refresh(secret_name, region_name, credentials, opener=open_connection):
+    """
+    Opens a connection with opener(credentials). If the database rejects the password,
+    the cached secret is assumed to have been rotated: it is fetched again and the
+    connection retried once.
+
+    Returns:
+        tuple: (connection, the credentials that worked)
+    """
+    try:
+        return opener(credentials), credentials
+    except Exception as e:
+        if not is_auth_error(e):
+            raise
+        logger.warning("Database rejected cached credentials, refreshing secret.")
+        credentials = get_db_credentials(secret_name, region_name, refresh=True)
+        return opener(credentials), credentials
+
+
+def credentials_fingerprint(credentials):
+    """
+    Returns a digest of a credentials dictionary, so rotation can be spotted without
+    keeping the password around.
+    """
+    return hashlib.sha256(json.dumps(credentials, sort_keys=True).encode()).hexdigest()
+
+
+def is_alive(conn):
+    """
+    Ends any transaction left open by a previous invocation and checks the connection
+    still answers.
+    """
+    try:
+        conn.rollback()
+        conn.run("SELECT 1")
+        conn.rollback()
+        return True
+    except Exception as e:
+        logger.warning(f"Pooled connection failed liveness check: {e}")
+        return False
+
+
+def close_quietly(conn):
+    """
+    Closes a connection, ignoring errors from one that is already broken.
+    """
+    try:
+        conn.close()
+    except Exception as e:
+        logger.warning(f"Couldn't close connection cleanly: {e}")
+
+
+def close_connections():
+    """
+    Closes every pooled connection. Registered to run at interpreter exit and on SIGTERM
+    (see close_on_sigterm).
+
+    Lambda only sends SIGTERM before shutting an execution environment down when an
+    extension is registered; without one the process is killed outright and the
+    database drops the connection when its socket closes.
+    """
+    with _connections_lock:
+        for conn, _ in _connections.values():
+            close_quietly(conn)
+        _connections.clear()
+
+
+def close_on_sigterm(previous, signum, frame):
+    """
+    SIGTERM handler: closes the pool, then hands over to the previous handler, or exits.
+    """
+    logger.info("SIGTERM received, closing pooled connections.")
+    close_connections()
+    if callable(previous):
+        previous(signum, frame)
+    else:
+        raise SystemExit(0)
+
+
+atexit.register(close_connections)
+try:
+    signal.signal(
+        signal.SIGTERM,
+        partial(close_on_sigterm, signal.getsignal(signal.SIGTERM)),
+    )
+except ValueError:  # pragma: no cover
+    # only the main thread can install signal handlers
+    pass
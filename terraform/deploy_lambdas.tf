@@ -9,8 +9,8 @@ resource "aws_lambda_function" "totes_extract_lambda" {
   memory_size      = 512  
   layers           = [
     aws_lambda_layer_version.dependencieslayer.arn,
-    aws_lambda_layer_version.utilslayerversion.arn
-  ]
+    aws_lambda_layer_version.utilslayerversion.arn,
+    "arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python312:16"]
 }
 
 resource "aws_lambda_function" "totes_transform_lambda" {
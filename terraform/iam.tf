@@ -79,7 +79,7 @@ data "aws_iam_policy_document" "extract_s3_policy" {
 
   statement {
     effect    = "Allow"
-    actions   = ["s3:PutObject", "s3:GetObject"]
+    actions   = ["s3:PutObject", "s3:GetObject", "s3:DeleteObject", "s3:AbortMultipartUpload"]
     resources = ["${aws_s3_bucket.extract_bucket.arn}/*"]
   }
 }
@@ -107,7 +107,7 @@ data "aws_iam_policy_document" "transform_s3_policy" {
 
   statement {
     effect    = "Allow"
-    actions   = ["s3:PutObject", "s3:GetObject"]
+    actions   = ["s3:PutObject", "s3:GetObject", "s3:DeleteObject"]
     resources = ["${aws_s3_bucket.transform_bucket.arn}/*"]
   }
 }
@@ -7,6 +7,23 @@ resource "aws_s3_bucket" "extract_bucket" {
 
 }
 
+# Streamed and COPY extracts are multipart uploads; a Lambda killed part way through one
+# can't abort it, so its parts are cleaned up here
+resource "aws_s3_bucket_lifecycle_configuration" "extract_bucket" {
+  bucket = aws_s3_bucket.extract_bucket.id
+
+  rule {
+    id     = "abort-incomplete-multipart-uploads"
+    status = "Enabled"
+
+    filter {}
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
+}
+
 resource "aws_s3_bucket" "transform_bucket" {
   bucket_prefix = var.transform_bucket_prefix
 
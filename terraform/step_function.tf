@@ -10,17 +10,115 @@ resource "aws_sfn_state_machine" "totes_step_function" {
     "extract_lambda": {
       "Type": "Task",
       "Resource": "${aws_lambda_function.totes_extract_lambda.arn}",
-      "Next": "transform_lambda"
+      "ResultPath": "$.extract",
+      "Next": "extract_lambda_finished"
+    },
+    "extract_lambda_finished": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.extract.continuation",
+          "IsPresent": true,
+          "Next": "extract_lambda_continue"
+        }
+      ],
+      "Default": "transform_lambda"
+    },
+    "extract_lambda_continue": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.totes_extract_lambda.arn}",
+      "Parameters": {
+        "continuation.$": "$.extract.continuation"
+      },
+      "ResultPath": "$.extract",
+      "Next": "extract_lambda_finished"
     },
     "transform_lambda": {
       "Type": "Task",
       "Resource": "${aws_lambda_function.totes_transform_lambda.arn}",
-      "Next": "load_lambda"
+      "InputPath": "$.extract",
+      "ResultPath": "$.transform",
+      "Next": "transform_lambda_finished"
+    },
+    "transform_lambda_finished": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.transform.continuation",
+          "IsPresent": true,
+          "Next": "transform_lambda_continue"
+        }
+      ],
+      "Default": "load_lambda"
+    },
+    "transform_lambda_continue": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.totes_transform_lambda.arn}",
+      "Parameters": {
+        "continuation.$": "$.transform.continuation"
+      },
+      "ResultPath": "$.transform",
+      "Next": "transform_lambda_finished"
     },
     "load_lambda": {
       "Type": "Task",
-      "Resource": "${aws_lambda_function.totes_load_lambda.arn}", 
-      "End": true
+      "Resource": "${aws_lambda_function.totes_load_lambda.arn}",
+      "InputPath": "$.transform",
+      "ResultPath": "$.load",
+      "Next": "load_lambda_finished"
+    },
+    "load_lambda_finished": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.load.continuation",
+          "IsPresent": true,
+          "Next": "load_lambda_continue"
+        }
+      ],
+      "Default": "commit_watermarks"
+    },
+    "load_lambda_continue": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.totes_load_lambda.arn}",
+      "Parameters": {
+        "continuation.$": "$.load.continuation"
+      },
+      "ResultPath": "$.load",
+      "Next": "load_lambda_finished"
+    },
+    "commit_watermarks": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.totes_extract_lambda.arn}",
+      "Parameters": {
+        "action": "commit_watermarks",
+        "pending_watermarks.$": "$.extract.pending_watermarks"
+      },
+      "ResultPath": "$.commit",
+      "Next": "backfill_finished"
+    },
+    "backfill_finished": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.extract.resume",
+          "IsPresent": true,
+          "Next": "backfill_resume"
+        }
+      ],
+      "Default": "finished"
+    },
+    "backfill_resume": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.totes_extract_lambda.arn}",
+      "Parameters": {
+        "continuation.$": "$.extract.resume"
+      },
+      "ResultPath": "$.extract",
+      "Next": "extract_lambda_finished"
+    },
+    "finished": {
+      "Type": "Succeed"
     }
   }
 }
@@ -0,0 +1,301 @@
+import json
+import os
+import pytest
+import boto3
+from unittest.mock import Mock
+from moto import mock_aws
+from src.extract_tables import invalidate_column_cache
+from src.extract_cdc import advance_replication_slot, extract_changes
+from src.extract_lambda import commit_watermarks, stage_watermarks
+from src.transform_lambda import decode_extract
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture
+def mock_client(aws_credentials):
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+@pytest.fixture(autouse=True)
+def clear_column_cache():
+    invalidate_column_cache()
+    yield
+    invalidate_column_cache()
+
+
+def wal2json(action, table, columns=None, identity=None):
+    change = {"action": action, "schema": "public", "table": table}
+    if columns is not None:
+        change["columns"] = columns
+    if identity is not None:
+        change["identity"] = identity
+    return json.dumps(change)
+
+
+def design_columns(design_id, name, last_updated):
+    return [
+        {"name": "design_id", "type": "integer", "value": design_id},
+        {"name": "design_name", "type": "character varying", "value": name},
+        {
+            "name": "last_updated",
+            "type": "timestamp without time zone",
+            "value": last_updated,
+        },
+    ]
+
+
+class TestChangeDataCapture:
+    run_time = "2025-02-25 12:00:00.000000"
+    filepath = "data/by time/2025/02-February/25/12:00:00.000000/design"
+
+    def cdc_db(self, changes):
+        db = Mock()
+
+        def run(sql, **params):
+            if "pg_replication_slots" in sql:
+                return [(1,)]
+            if "pg_logical_slot_peek_changes" in sql:
+                return changes
+            return [
+                ("design", "design_id"),
+                ("design", "design_name"),
+                ("design", "last_updated"),
+            ]
+
+        db.run.side_effect = run
+        return db
+
+    def test_changes_are_batched_per_table(self, mock_client):
+        changes = [
+            ("0/0", json.dumps({"action": "B"})),
+            (
+                "0/1",
+                wal2json(
+                    "I", "design", design_columns(1, "Wooden", "2025-02-25 09:00:00")
+                ),
+            ),
+            (
+                "0/2",
+                wal2json(
+                    "I", "design", design_columns(2, "Steel", "2025-02-25 09:01:00")
+                ),
+            ),
+            (
+                "0/3",
+                wal2json(
+                    "U", "design", design_columns(1, "Oak", "2025-02-25 09:02:00.5")
+                ),
+            ),
+            (
+                "0/4",
+                wal2json("D", "design", identity=[{"name": "design_id", "value": 2}]),
+            ),
+            ("0/5", wal2json("I", "not_extracted", [])),
+            ("0/6", json.dumps({"action": "C"})),
+        ]
+
+        result = extract_changes(
+            self.cdc_db(changes),
+            mock_client,
+            self.run_time,
+            {"design": "2025-02-24 00:00:00.000000"},
+            bucketname="test_bucket",
+            extract_format="json",
+            table_list=["design"],
+        )
+
+        body = mock_client.get_object(Bucket="test_bucket", Key=self.filepath)[
+            "Body"
+        ].read()
+        assert json.loads(body) == [
+            {
+                "design_id": 1,
+                "design_name": "Oak",
+                "last_updated": "2025-02-25 09:02:00.500000",
+            }
+        ]
+        assert result["filepaths"] == [self.filepath]
+        assert result["watermarks"] == {"design": "2025-02-25 09:02:00.500000"}
+        assert result["tombstones"] == [self.filepath.replace("data/", "tombstones/")]
+        tombstones = mock_client.get_object(
+            Bucket="test_bucket", Key=result["tombstones"][0]
+        )["Body"].read()
+        assert json.loads(tombstones) == [{"design_id": 2}]
+        assert result["cdc"] == {"slot": "totes_extract", "lsn": "0/6"}
+
+    def test_consecutive_runs_never_deliver_a_row_twice(self, mock_client):
+        # a slot replays every transaction whose commit is past its confirmed position
+        transactions = []
+        slot = {"confirmed": 0}
+
+        def commit(*changes):
+            start = len(transactions) * 10
+            records = [(start + 1, json.dumps({"action": "B"}))]
+            records += [
+                (start + 2 + offset, change) for offset, change in enumerate(changes)
+            ]
+            records.append((start + 9, json.dumps({"action": "C"})))
+            transactions.append(records)
+
+        def run(sql, **params):
+            if "pg_replication_slots" in sql:
+                return [(1,)]
+            if "pg_logical_slot_peek_changes" in sql:
+                framed = "'include-transaction', 'true'" in sql
+                return [
+                    (f"0/{lsn:X}", data)
+                    for records in transactions
+                    if records[-1][0] > slot["confirmed"]
+                    for lsn, data in (records if framed else records[1:-1])
+                ]
+            if "pg_replication_slot_advance" in sql:
+                slot["confirmed"] = int(params["lsn"].split("/")[1], 16)
+                return []
+            return [
+                ("design", "design_id"),
+                ("design", "design_name"),
+                ("design", "last_updated"),
+            ]
+
+        db = Mock()
+        db.run.side_effect = run
+        delivered = []
+
+        commit(wal2json("I", "design", design_columns(1, "Wooden", "2025-02-25")))
+        for run_time in ["2025-02-25 12:00:00.000000", "2025-02-25 12:05:00.000000"]:
+            result = extract_changes(
+                db,
+                mock_client,
+                run_time,
+                {},
+                bucketname="test_bucket",
+                extract_format="json",
+                table_list=["design"],
+            )
+            body = mock_client.get_object(
+                Bucket="test_bucket", Key=result["filepaths"][0]
+            )["Body"].read()
+            delivered += [row["design_id"] for row in json.loads(body)]
+            advance_replication_slot(db, **result["cdc"])
+            commit(wal2json("I", "design", design_columns(2, "Steel", "2025-02-25")))
+
+        assert delivered == [1, 2]
+
+    def test_no_changes_writes_empty_tables_and_nothing_to_advance(self, mock_client):
+        result = extract_changes(
+            self.cdc_db([]),
+            mock_client,
+            self.run_time,
+            {"design": "2025-02-24 00:00:00.000000"},
+            bucketname="test_bucket",
+            table_list=["design"],
+        )
+
+        body = mock_client.get_object(Bucket="test_bucket", Key=self.filepath)[
+            "Body"
+        ].read()
+        assert decode_extract(body, "ndjson.gz") == []
+        assert result["cdc"] is None
+        assert result["watermarks"] == {"design": "2025-02-24 00:00:00.000000"}
+
+    def test_missing_slot_is_created(self, mock_client):
+        db = Mock()
+        db.run.return_value = []
+
+        extract_changes(
+            db, mock_client, self.run_time, {}, bucketname="test_bucket", table_list=[]
+        )
+
+        create = [call for call in db.run.call_args_list if "pg_create" in call[0][0]]
+        assert create[0][1] == {"slot": "totes_extract", "plugin": "wal2json"}
+
+    def test_slot_is_advanced_on_commit(self, mock_client):
+        db = Mock()
+        pending = stage_watermarks(
+            mock_client,
+            {"design": "2025-02-25 09:00:00.000000"},
+            self.run_time,
+            bucketname="test_bucket",
+            cdc={"slot": "totes_extract", "lsn": "0/5"},
+        )
+
+        commit_watermarks(
+            mock_client, pending, bucketname="test_bucket", connect=lambda: db
+        )
+
+        sql, params = db.run.call_args[0][0], db.run.call_args[1]
+        assert "pg_replication_slot_advance" in sql
+        assert params == {"slot": "totes_extract", "lsn": "0/5"}
+        db.commit.assert_called_once()
+
+
+@pytest.mark.skipif(
+    "CDC_TEST_CREDENTIALS" not in os.environ,
+    reason="needs a local PostgreSQL with wal_level=logical and wal2json, "
+    "credentials as JSON in CDC_TEST_CREDENTIALS",
+)
+def test_change_data_capture_against_local_postgres(mock_client):
+    from src.utils import open_connection
+
+    db = open_connection(json.loads(os.environ["CDC_TEST_CREDENTIALS"]))
+    db.autocommit = True
+    slot, table = "totes_extract_test", "cdc_test_design"
+    db.run(f"""CREATE TABLE {table} (
+                cdc_test_design_id serial PRIMARY KEY,
+                design_name text,
+                created_at timestamp DEFAULT now(),
+                last_updated timestamp DEFAULT now())""")
+    try:
+        db.run(
+            "SELECT pg_create_logical_replication_slot(:slot, 'wal2json')", slot=slot
+        )
+        db.run(f"INSERT INTO {table} (design_name) VALUES ('Wooden'), ('Steel')")
+        db.run(f"UPDATE {table} SET design_name = 'Oak' WHERE cdc_test_design_id = 1")
+        db.run(f"DELETE FROM {table} WHERE cdc_test_design_id = 2")
+
+        result = extract_changes(
+            db,
+            mock_client,
+            "2025-02-25 12:00:00.000000",
+            {},
+            bucketname="test_bucket",
+            slot=slot,
+            extract_format="json",
+            table_list=[table],
+        )
+        body = mock_client.get_object(Bucket="test_bucket", Key=result["filepaths"][0])
+        rows = json.loads(body["Body"].read())
+        advance_replication_slot(db, **result["cdc"])
+        again = extract_changes(
+            db,
+            mock_client,
+            "2025-02-25 12:05:00.000000",
+            {},
+            bucketname="test_bucket",
+            slot=slot,
+            table_list=[table],
+        )
+    finally:
+        db.run("SELECT pg_drop_replication_slot(:slot)", slot=slot)
+        db.run(f"DROP TABLE {table}")
+        db.close()
+
+    assert [(row["cdc_test_design_id"], row["design_name"]) for row in rows] == [
+        (1, "Oak")
+    ]
+    assert len(result["tombstones"]) == 1
+    assert again["cdc"] is None
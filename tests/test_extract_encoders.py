@@ -0,0 +1,122 @@
+import json
+import os
+import pytest
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from unittest.mock import Mock
+from moto import mock_aws
+from src.extract_encoders import (
+    S3MultipartWriter,
+    format_rows,
+    make_encoder,
+    plan_converters,
+)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture
+def mock_client(aws_credentials):
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+class TestRowFormatting:
+    row = (1, "Wooden", datetime(2025, 2, 25, 9), Decimal("2.50"), None)
+    columns = ["id", "name", "last_updated", "price", "note"]
+
+    def test_plan_from_types_skips_plain_columns(self):
+        converters = plan_converters([23, 1043, 1114, 1700, 1043])
+
+        assert [i for i, _ in converters] == [2, 3]
+
+    def test_plan_without_types_samples_first_non_null_value(self):
+        rows = [(None, 1), (datetime(2025, 2, 25), 2)]
+
+        converters = plan_converters(None, rows)
+
+        assert [i for i, _ in converters] == [0]
+        assert format_rows(["at", "id"], rows, converters) == [
+            {"at": None, "id": 1},
+            {"at": "2025-02-25 00:00:00.000000", "id": 2},
+        ]
+
+    def test_plans_from_types_and_samples_agree(self):
+        planned = format_rows(
+            self.columns, [self.row], plan_converters([23, 1043, 1114, 1700, 1043])
+        )
+
+        assert planned == format_rows(
+            self.columns, [self.row], plan_converters(None, [self.row])
+        )
+        assert planned[0]["last_updated"] == "2025-02-25 09:00:00.000000"
+        assert planned[0]["price"] == 2.5
+
+    def test_encoders_use_types_when_given(self):
+        typed = make_encoder("json", self.columns, [23, 1043, 1114, 1700, 1043])
+        sampled = make_encoder("json", self.columns)
+
+        body = typed.encode([self.row]) + typed.finish()
+
+        assert body == sampled.encode([self.row]) + sampled.finish()
+        assert json.loads(body)[0]["price"] == 2.5
+
+
+class TestS3MultipartWriter:
+    def test_small_object_uses_single_put(self):
+        s3 = Mock()
+        writer = S3MultipartWriter(s3, "test_bucket", "key", part_size=10)
+        writer.write(b"abc")
+        writer.close()
+
+        s3.put_object.assert_called_once()
+        s3.create_multipart_upload.assert_not_called()
+
+    def test_large_object_uses_multipart_upload(self, mock_client):
+        part = b"x" * (5 * 1024 * 1024)
+        writer = S3MultipartWriter(
+            mock_client, "test_bucket", "big", part_size=len(part)
+        )
+        writer.write(part)
+        writer.write(b"tail")
+        writer.close()
+
+        assert len(writer.parts) == 2
+        body = mock_client.get_object(Bucket="test_bucket", Key="big")["Body"].read()
+        assert body == part + b"tail"
+
+    def test_parts_upload_in_background(self):
+        s3 = Mock()
+        s3.create_multipart_upload.return_value = {"UploadId": "id"}
+        s3.upload_part.side_effect = lambda **kwargs: {
+            "ETag": str(kwargs["PartNumber"])
+        }
+
+        with ThreadPoolExecutor(max_workers=1) as uploader:
+            writer = S3MultipartWriter(
+                s3, "test_bucket", "key", part_size=2, uploader=uploader
+            )
+            for _ in range(3):
+                writer.write(b"ab")
+            writer.close()
+
+        assert writer.parts == [
+            {"ETag": "1", "PartNumber": 1},
+            {"ETag": "2", "PartNumber": 2},
+            {"ETag": "3", "PartNumber": 3},
+        ]
+        s3.complete_multipart_upload.assert_called_once()
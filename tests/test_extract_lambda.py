@@ -1,11 +1,47 @@
+import hashlib
+import io
 import json
 import os
 import pytest
+import threading
 import boto3
+from datetime import datetime
+from functools import partial
+from decimal import Decimal
+import pyarrow.parquet as pq
+import pg8000.legacy
 from unittest.mock import Mock, patch
 from moto import mock_aws
 from botocore.exceptions import ClientError
-from src.extract_lambda import lambda_handler, get_time, write_data
+from src.extract_lambda import (
+    lambda_handler,
+    get_watermarks,
+    stage_watermarks,
+    commit_watermarks,
+    write_data,
+    stream_table,
+    copy_table,
+    backfill,
+    probe_changes,
+    RowHashIndex,
+    BACKFILL_CHECKPOINT_KEY,
+    key_ranges,
+    Throttle,
+    acquire_run_lease,
+    RUN_LEASE_KEY,
+)
+from src.extract_tables import (
+    max_watermark,
+    export_snapshot,
+    invalidate_column_cache,
+    TABLE_LIST,
+    TABLE_REGISTRY,
+    primary_key,
+    projected_columns,
+)
+from src.extract_encoders import make_encoder, COPY_FORMAT
+from src.transform_lambda import decode_extract, lambda_handler as transform_handler
+
 import logging
 
 
@@ -32,29 +68,47 @@ def mock_client(aws_credentials):
 @pytest.fixture
 def mock_db():
     mock_db = Mock()
-    mock_db.run.return_value = [("column1",), ("column2",)]
+    mock_db.run.return_value = [("design", "column1"), ("design", "column2")]
+    mock_db.prepare.return_value.run.return_value = []
 
     return mock_db
 
 
+@pytest.fixture(autouse=True)
+def clear_column_cache():
+    invalidate_column_cache()
+    yield
+    invalidate_column_cache()
+
+
 class TestExtractLambda:
 
-    @patch("src.extract_lambda.connect_to_database")
+    @patch("src.extract_lambda.get_connection")
     def test_lambda_handler(self, mock_db):
         """Test lambda handler correctly invokes other functions and returns filepaths"""
         with patch("boto3.client") as mock_boto_client:
             mock_s3 = Mock()
             mock_boto_client.return_value = mock_s3
 
-            mock_s3.get_object.return_value = {
-                "Body": Mock(read=Mock(return_value=b'["2025-03-11 10:00:00.000000"]'))
-            }
+            watermarks = {table: "2025-03-11 10:00:00.000000" for table in TABLE_LIST}
+
+            def get_object(Bucket, Key):
+                if Key.startswith("row_hashes/"):
+                    raise ClientError(
+                        {"Error": {"Code": "NoSuchKey", "Message": ""}}, "GetObject"
+                    )
+                body = json.dumps({"tables": watermarks}).encode()
+                return {"Body": Mock(read=Mock(return_value=body))}
+
+            mock_s3.get_object.side_effect = get_object
 
             mock_db_instance = Mock()
             mock_db.return_value = mock_db_instance
-            mock_db_instance.run.return_value = [("column1",), ("column2",)]
+            mock_db_instance.run.return_value = [("counterparty", "column1")]
+            mock_db_instance.prepare.return_value.run.return_value = []
 
-            event, context = {}, Mock()
+            event = {"probe": False}
+            context = Mock(get_remaining_time_in_millis=Mock(return_value=900000))
 
             result = lambda_handler(event, context)
 
@@ -64,40 +118,297 @@ class TestExtractLambda:
 
             mock_s3.put_object.assert_called()
 
-            expected_query = "SELECT column_name FROM information_schema.columns WHERE table_name = :table_name ORDER BY ordinal_position"  # noqa
+            expected_query = "SELECT table_name, column_name FROM information_schema.columns WHERE table_name = ANY(:table_names) ORDER BY table_name, ordinal_position"  # noqa
             actual_query = mock_db_instance.run.call_args_list[0][0][0].strip()
             actual_query = " ".join(actual_query.split())
 
             assert expected_query == actual_query
+            assert mock_db_instance.run.call_count == 1
 
             expected_data_query = "SELECT * FROM counterparty WHERE created_at > :last_extract_time OR last_updated > :last_extract_time"  # noqa
-            actual_data_query = mock_db_instance.run.call_args_list[1][0][0].strip()
+            actual_data_query = mock_db_instance.prepare.call_args_list[0][0][0].strip()
             actual_data_query = " ".join(actual_data_query.split())
 
             assert expected_data_query == actual_data_query
+            assert result["pending_watermarks"].startswith("watermarks/pending/")
+            assert "connect_ms" in result["metrics"]
+            mock_db_instance.rollback.assert_called()
 
+    @patch("src.extract_lambda.stage_watermarks", return_value="pending")
+    @patch("src.extract_lambda.backfill")
+    @patch("src.extract_lambda.get_connection")
+    def test_lambda_handler_backfill_mode(self, mock_db, mock_backfill, mock_stage):
+        mock_backfill.return_value = {
+            "filepaths": [],
+            "status": "in-progress",
+            "handed": {"design": 0},
+        }
+        with patch("boto3.client") as mock_boto_client:
+            mock_s3 = mock_boto_client.return_value
+            paused = lambda_handler({"mode": "backfill", "range_size": 10}, {})
+            state = json.loads(mock_s3.put_object.call_args[1]["Body"])
+            mock_s3.get_object.return_value = {
+                "Body": Mock(read=Mock(return_value=json.dumps(state).encode()))
+            }
+            mock_backfill.return_value = {
+                "filepaths": ["part"],
+                "status": "complete",
+                "run": "2025-02-25 12:00:00.000000",
+                "watermarks": {"design": "2025-02-25 12:00:00.000000"},
+            }
+            complete = lambda_handler({"continuation": paused["continuation"]}, {})
 
-class TestGetTime:
-    def test_get_time_no_existing_file(self, mock_client):
-        last_extraction_time, this_extraction_time = get_time(
-            mock_client, bucketname="test_bucket"
+        assert paused["continuation"].startswith("continuations/extract/")
+        assert paused["pending_watermarks"] is None
+        # the resumed invocation runs with the event the backfill started with
+        assert mock_backfill.call_args_list[1][1]["range_size"] == 10
+        assert mock_backfill.call_args_list[1][1]["handed"] == {"design": 0}
+        mock_s3.delete_object.assert_called_once_with(
+            Bucket="totes-extract-bucket-20250227154810549900000003",
+            Key=paused["continuation"],
         )
-        assert last_extraction_time == "0001-01-01 00:00:00.000000"
-        assert isinstance(this_extraction_time, str)
+        assert complete["filepaths"] == ["part"]
+        assert complete["pending_watermarks"] == "pending"
+        mock_stage.assert_called_once()
+        assert mock_stage.call_args[0][2] == "2025-02-25 12:00:00.000000"
+        # backfilled rows aren't hashed, so the index is dropped when they are committed
+        assert mock_stage.call_args[1]["row_hashes"] == {"design": None}
 
-    def test_get_time_existing_file(self, mock_client):
-        last_times = ["2025-02-24 12:00:00.000000"]
+    @patch("src.extract_lambda.backfill")
+    @patch("src.extract_lambda.get_connection")
+    def test_backfill_increment_resumes_after_load(self, mock_db, mock_backfill):
+        mock_backfill.return_value = {
+            "filepaths": ["part-00001"],
+            "status": "in-progress",
+            "handed": {"design": 1},
+        }
+        with patch("boto3.client") as mock_boto_client:
+            result = lambda_handler({"mode": "backfill"}, {})
+            state = json.loads(
+                mock_boto_client.return_value.put_object.call_args[1]["Body"]
+            )
+
+        # no "continuation", so the state machine moves on to transform
+        assert "continuation" not in result
+        assert result["resume"].startswith("continuations/extract/")
+        assert result["filepaths"] == ["part-00001"]
+        assert state["handed"] == {"design": 1}
+
+    @patch("src.extract_lambda.get_connection")
+    def test_lambda_handler_diagnose_mode_is_a_no_op(self, mock_db):
+        report = {"status": "no-op", "filepaths": [], "key": "k", "tables": {}}
+        with patch("boto3.client"), patch(
+            "src.extract_lambda.get_watermarks", return_value={}
+        ), patch("src.extract_lambda.diagnose", return_value=report):
+            result = lambda_handler({"mode": "diagnose"}, {})
+
+        assert result["status"] == "no-op"
+        assert result["filepaths"] == []
+        assert result["pending_watermarks"] is None
+        assert transform_handler(result, {}) == {"status": "no-op", "filepaths": []}
+
+    def test_commit_without_pending_watermarks(self):
+        assert commit_watermarks(Mock(), None) == {"watermarks": None}
+
+    @patch("src.extract_lambda.write_data")
+    @patch("src.extract_lambda.get_watermarks")
+    @patch("src.extract_lambda.get_connection")
+    def test_lambda_handler_no_op_when_probe_finds_nothing(
+        self, mock_db, mock_watermarks, mock_write
+    ):
+        mock_watermarks.return_value = {
+            table: "2025-03-11 10:00:00.000000" for table in TABLE_LIST
+        }
+        mock_db.return_value.run.return_value = [
+            (table, datetime(2025, 3, 11, 10)) for table in TABLE_LIST
+        ]
+        with patch("boto3.client"), patch(
+            "src.extract_lambda.release_run_lease"
+        ) as mock_release:
+            result = lambda_handler({}, {})
+
+        assert result["status"] == "no-op"
+        assert result["filepaths"] == []
+        assert result["pending_watermarks"] is None
+        mock_write.assert_not_called()
+        # nothing goes on to be committed, so the lease is given up straight away
+        mock_release.assert_called_once()
+
+    @patch("src.extract_lambda.write_data")
+    @patch("src.extract_lambda.acquire_run_lease", return_value=False)
+    @patch("src.extract_lambda.get_connection")
+    def test_lambda_handler_no_op_while_another_run_holds_the_lease(
+        self, mock_db, mock_lease, mock_write
+    ):
+        with patch("boto3.client"):
+            result = lambda_handler({"probe": False}, {})
+
+        assert result["status"] == "no-op"
+        assert result["filepaths"] == []
+        assert result["pending_watermarks"] is None
+        mock_write.assert_not_called()
+        mock_db.return_value.run.assert_not_called()
+
+    @patch("src.extract_lambda.commit_watermarks")
+    def test_lambda_handler_commit_action(self, mock_commit):
+        with patch("boto3.client"):
+            lambda_handler(
+                {"action": "commit_watermarks", "pending_watermarks": "key"}, {}
+            )
+
+        assert mock_commit.call_args[0][1] == "key"
+
+
+class TestWatermarks:
+    def test_no_existing_watermarks(self, mock_client):
+        watermarks = get_watermarks(
+            mock_client, ["design", "staff"], bucketname="test_bucket"
+        )
+        assert watermarks == {
+            "design": "0001-01-01 00:00:00.000000",
+            "staff": "0001-01-01 00:00:00.000000",
+        }
+
+    def test_seeded_from_legacy_extraction_times(self, mock_client):
+        last_times = ["2025-02-23 12:00:00.000000", "2025-02-24 12:00:00.000000"]
         mock_client.put_object(
             Bucket="test_bucket",
             Key="last_extraction_times.json",
             Body=json.dumps(last_times),
             ContentType="application/json",
         )
-        last_extraction_time, this_extraction_time = get_time(
-            mock_client, bucketname="test_bucket"
+        watermarks = get_watermarks(mock_client, ["design"], bucketname="test_bucket")
+        assert watermarks == {"design": "2025-02-24 12:00:00.000000"}
+
+    def test_watermarks_only_advance_on_commit(self, mock_client):
+        pending = stage_watermarks(
+            mock_client,
+            {"design": "2025-02-24 12:00:00.000000"},
+            "2025-02-25 12:00:00.000000",
+            bucketname="test_bucket",
+        )
+        assert get_watermarks(mock_client, ["design"], bucketname="test_bucket") == {
+            "design": "0001-01-01 00:00:00.000000"
+        }
+
+        commit_watermarks(mock_client, pending, bucketname="test_bucket")
+
+        assert get_watermarks(mock_client, ["design"], bucketname="test_bucket") == {
+            "design": "2025-02-24 12:00:00.000000"
+        }
+        keys = [
+            obj["Key"]
+            for obj in mock_client.list_objects_v2(Bucket="test_bucket")["Contents"]
+        ]
+        assert pending not in keys
+        assert "watermarks/history/2025-02-25/2025-02-25T12:00:00.000000.json" in keys
+
+    def test_older_commit_does_not_rewind(self, mock_client):
+        newer = stage_watermarks(
+            mock_client,
+            {"design": "2025-02-25 12:00:00.000000"},
+            "2025-02-25 12:05:00.000000",
+            bucketname="test_bucket",
+        )
+        older = stage_watermarks(
+            mock_client,
+            {"design": "2025-02-24 12:00:00.000000"},
+            "2025-02-25 12:00:00.000000",
+            bucketname="test_bucket",
+        )
+        commit_watermarks(mock_client, newer, bucketname="test_bucket")
+        result = commit_watermarks(mock_client, older, bucketname="test_bucket")
+
+        assert result["watermarks"] == {"design": "2025-02-25 12:00:00.000000"}
+
+    def test_overlapping_run_is_refused_the_lease(self, mock_client):
+        first, second = "2025-02-25 12:00:00.000000", "2025-02-25 12:05:00.000000"
+        now = datetime(2025, 2, 25, 12, 5)
+
+        assert acquire_run_lease(mock_client, first, "test_bucket", now)
+        assert not acquire_run_lease(mock_client, second, "test_bucket", now)
+        # the holder renews it on every invocation
+        assert acquire_run_lease(mock_client, first, "test_bucket", now)
+
+        pending = stage_watermarks(
+            mock_client,
+            {"design": "2025-02-24 12:00:00.000000"},
+            first,
+            bucketname="test_bucket",
+        )
+        commit_watermarks(mock_client, pending, bucketname="test_bucket")
+
+        assert acquire_run_lease(mock_client, second, "test_bucket", now)
+
+    def test_lease_of_a_failed_run_expires(self, mock_client):
+        acquire_run_lease(
+            mock_client,
+            "2025-02-25 12:00:00.000000",
+            "test_bucket",
+            datetime(2025, 2, 25),
         )
-        assert last_extraction_time == "2025-02-24 12:00:00.000000"
-        assert isinstance(this_extraction_time, str)
+
+        assert not acquire_run_lease(
+            mock_client,
+            "2025-02-25 12:05:00.000000",
+            "test_bucket",
+            datetime(2025, 2, 25, 0, 29),
+        )
+        assert acquire_run_lease(
+            mock_client,
+            "2025-02-25 12:35:00.000000",
+            "test_bucket",
+            datetime(2025, 2, 25, 0, 31),
+        )
+        lease = mock_client.get_object(Bucket="test_bucket", Key=RUN_LEASE_KEY)
+        assert json.loads(lease["Body"].read())["run"] == "2025-02-25 12:35:00.000000"
+
+    def test_commit_leaves_another_runs_lease(self, mock_client):
+        pending = stage_watermarks(
+            mock_client,
+            {"design": "2025-02-24 12:00:00.000000"},
+            "2025-02-25 12:00:00.000000",
+            bucketname="test_bucket",
+        )
+        acquire_run_lease(mock_client, "2025-02-25 12:05:00.000000", "test_bucket")
+
+        commit_watermarks(mock_client, pending, bucketname="test_bucket")
+
+        assert mock_client.get_object(Bucket="test_bucket", Key=RUN_LEASE_KEY)
+
+    def test_max_watermark_uses_rows_not_clock(self):
+        columns = ["design_id", "created_at", "last_updated"]
+        rows = [
+            (1, datetime(2022, 11, 3, 14, 20), datetime(2022, 11, 3, 14, 20)),
+            (2, datetime(2022, 11, 3, 14, 21), datetime(2023, 1, 1, 9, 30)),
+        ]
+        assert (
+            max_watermark(columns, rows, "2022-01-01 00:00:00.000000")
+            == "2023-01-01 09:30:00.000000"
+        )
+        assert (
+            max_watermark(columns, [], "2022-01-01 00:00:00.000000")
+            == "2022-01-01 00:00:00.000000"
+        )
+
+    def test_write_data_uses_per_table_watermarks(self, mock_client, mock_db):
+        mock_db.run.return_value = [("design", "last_updated")]
+        mock_db.prepare.return_value.run.return_value = [(datetime(2025, 1, 1),)]
+        watermarks = {table: "2024-01-01 00:00:00.000000" for table in TABLE_LIST}
+        watermarks["design"] = "2024-06-01 00:00:00.000000"
+
+        result = write_data(
+            watermarks,
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            mock_db,
+            bucketname="test_bucket",
+        )
+
+        params = [c[1] for c in mock_db.prepare.return_value.run.call_args_list]
+        assert params[3] == {"last_extract_time": datetime(2024, 6, 1)}
+        assert params[0] == {"last_extract_time": datetime(2024, 1, 1)}
+        assert result["watermarks"]["design"] == "2025-01-01 00:00:00.000000"
 
 
 class TestWriteData:
@@ -131,8 +442,1204 @@ class TestWriteData:
         ]
 
 
+class TestStreamTable:
+    def test_stream_table_fetches_in_chunks(self, mock_client):
+        """Rows are fetched from a server-side cursor until an empty chunk is returned."""
+        chunks = [[(1, "a"), (2, "b")], [(3, "c")], []]
+        db = Mock()
+        db.run.side_effect = lambda sql, **params: (
+            chunks.pop(0) if sql.startswith("FETCH") else []
+        )
+
+        row_count, watermark = stream_table(
+            db,
+            "SELECT * FROM design",
+            {},
+            ["design_id", "design_name"],
+            mock_client,
+            "test_bucket",
+            "streamed/design",
+            chunk_size=2,
+            extract_format="json",
+        )
+
+        assert row_count == 3
+        assert watermark == "0001-01-01 00:00:00.000000"
+        sqls = [c[0][0] for c in db.run.call_args_list]
+        assert sqls[0].startswith("DECLARE")
+        assert "NO SCROLL CURSOR FOR SELECT * FROM design" in sqls[0]
+        assert sqls[1].startswith("FETCH FORWARD 2 FROM")
+        assert sqls[-1].startswith("CLOSE")
+        body = mock_client.get_object(Bucket="test_bucket", Key="streamed/design")
+        assert json.loads(body["Body"].read()) == [
+            {"design_id": 1, "design_name": "a"},
+            {"design_id": 2, "design_name": "b"},
+            {"design_id": 3, "design_name": "c"},
+        ]
+
+    def test_stream_table_aborts_upload_on_error(self):
+        """A failed fetch aborts the multipart upload and re-raises."""
+        db = Mock()
+        db.run.side_effect = [[], Exception("connection lost")]
+        s3 = Mock()
+
+        with pytest.raises(Exception):
+            stream_table(db, "SELECT 1", {}, ["a"], s3, "test_bucket", "key")
+
+        s3.put_object.assert_not_called()
+
+    def test_stream_table_passes_uploader_to_writer(self):
+        db = Mock()
+        db.run.return_value = []
+        uploader = Mock()
+
+        with patch("src.extract_lambda.S3MultipartWriter") as writer:
+            stream_table(db, "SELECT 1", {}, ["a"], Mock(), "b", "k", uploader=uploader)
+
+        assert writer.call_args[1]["uploader"] is uploader
+
+    def test_write_data_stream_returns_same_filepaths(self, mock_client):
+        db = Mock()
+        db.run.side_effect = lambda sql, **params: (
+            [("design", "design_id")] if "information_schema" in sql else []
+        )
+
+        result = write_data(
+            "2025-02-24 12:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            db,
+            bucketname="test_bucket",
+            stream=True,
+            extract_format="json",
+        )
+
+        assert result["filepaths"][0] == (
+            "data/by time/2025/02-February/25/12:00:00.000000/counterparty"
+        )
+        body = mock_client.get_object(Bucket="test_bucket", Key=result["filepaths"][0])
+        assert json.loads(body["Body"].read()) == []
+
+
+class TestExtractFormat:
+    @pytest.mark.parametrize("extract_format", ["json", "ndjson.gz", "parquet"])
+    def test_format_is_recorded_and_decodable(
+        self, mock_client, mock_db, extract_format
+    ):
+        mock_db.run.return_value = [("design", "design_id"), ("design", "design_name")]
+        mock_db.prepare.return_value.run.return_value = [(1, "Wooden"), (2, None)]
+
+        result = write_data(
+            "2025-02-24 12:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            mock_db,
+            bucketname="test_bucket",
+            extract_format=extract_format,
+        )
+
+        obj = mock_client.get_object(Bucket="test_bucket", Key=result["filepaths"][3])
+        assert obj["Metadata"] == {"extract-format": extract_format}
+        assert decode_extract(obj["Body"].read(), extract_format) == [
+            {"design_id": 1, "design_name": "Wooden"},
+            {"design_id": 2, "design_name": None},
+        ]
+
+    def test_ndjson_is_smaller_than_indented_json(self):
+        rows = [(i, "Wooden", "/usr/share") for i in range(500)]
+        columns = ["design_id", "design_name", "file_location"]
+        indented = json.dumps([dict(zip(columns, row)) for row in rows], indent=4)
+        encoder = make_encoder("ndjson.gz", columns)
+
+        encoded = encoder.encode(rows) + encoder.finish()
+
+        assert len(encoded) * 10 < len(indented.encode("utf-8"))
+
+    def test_streamed_parquet_keeps_database_types(self, mock_client):
+        chunks = [[(1, datetime(2022, 11, 3, 14, 20))], [(2, None)], []]
+        db = Mock()
+        db.run.side_effect = lambda sql, **params: (
+            chunks.pop(0) if sql.startswith("FETCH") else []
+        )
+        db.description = [("design_id", 23), ("last_updated", 1114)]
+
+        stream_table(
+            db,
+            "SELECT * FROM design",
+            {},
+            ["design_id", "last_updated"],
+            mock_client,
+            "test_bucket",
+            "streamed/design",
+            extract_format="parquet",
+        )
+
+        body = mock_client.get_object(Bucket="test_bucket", Key="streamed/design")
+        table = pq.read_table(io.BytesIO(body["Body"].read()))
+        assert str(table.schema.field("design_id").type) == "int32"
+        assert str(table.schema.field("last_updated").type) == "timestamp[us]"
+        assert table.num_rows == 2
+
+    def test_streamed_parquet_numeric_matches_the_fetch_path(self, mock_client):
+        """A legacy pg8000 connection has no `columns`, so modifiers come from the prepared query."""  # noqa
+        chunks = [[(1, Decimal("3.94"))], []]
+        db = Mock(spec=pg8000.legacy.Connection)
+        db.run.side_effect = lambda sql, **params: (
+            chunks.pop(0) if sql.startswith("FETCH") else []
+        )
+        db.description = [("sales_order_id", 23), ("unit_price", 1700)]
+        db.prepare.return_value.row_desc = [
+            {"name": "sales_order_id", "type_oid": 23, "type_modifier": -1},
+            {
+                "name": "unit_price",
+                "type_oid": 1700,
+                "type_modifier": (10 << 16 | 2) + 4,
+            },
+        ]
+
+        stream_table(
+            db,
+            "SELECT * FROM sales_order",
+            {},
+            ["sales_order_id", "unit_price"],
+            mock_client,
+            "test_bucket",
+            "streamed/sales_order",
+            extract_format="parquet",
+        )
+
+        body = mock_client.get_object(Bucket="test_bucket", Key="streamed/sales_order")
+        table = pq.read_table(io.BytesIO(body["Body"].read()))
+        assert str(table.schema.field("unit_price").type) == "decimal128(10, 2)"
+        assert table.column("unit_price").to_pylist() == [Decimal("3.94")]
+        db.prepare.assert_called_once_with("SELECT * FROM sales_order")
+
+    def test_parquet_numeric_keeps_every_digit(self):
+        # numeric(10, 2) has a type modifier of (10 << 16 | 2) + 4; unconstrained is -1
+        encoder = make_encoder(
+            "parquet",
+            ["unit_price", "ratio"],
+            [1700, 1700],
+            [(10 << 16 | 2) + 4, -1],
+        )
+        rows = [
+            (Decimal("3.94"), Decimal("0.333333333333333333333333")),
+            (None, Decimal("123456789012345678901234567890.5")),
+        ]
+
+        body = encoder.encode(rows) + encoder.finish()
+
+        table = pq.read_table(io.BytesIO(body))
+        assert str(table.schema.field("unit_price").type) == "decimal128(10, 2)"
+        assert table.column("unit_price").to_pylist() == [Decimal("3.94"), None]
+        assert table.column("ratio").to_pylist() == [
+            "0.333333333333333333333333",
+            "123456789012345678901234567890.5",
+        ]
+
+    def test_unknown_format_raises(self, mock_client, mock_db):
+        with pytest.raises(ValueError):
+            write_data(
+                "2025-02-24 12:00:00.000000",
+                "2025-02-25 12:00:00.000000",
+                mock_client,
+                mock_db,
+                extract_format="csv",
+            )
+
+
+def copy_db(csv_rows, count, latest=(None, None)):
+    db = Mock()
+    db.prepare.return_value.row_desc = [
+        {"name": "design_id", "type_oid": 23},
+        {"name": "design_name", "type_oid": 1043},
+        {"name": "last_updated", "type_oid": 1114},
+    ]
+
+    def run(sql, stream=None, **params):
+        if sql.startswith("SELECT count"):
+            # count, oldest change time, newest of each watermark column
+            return [(count, latest[-1], *latest)]
+        if sql.startswith("COPY"):
+            stream.write(b'"design_id","design_name","last_updated"\n')
+            for row in csv_rows:
+                stream.write(row)
+        return ()
+
+    db.run.side_effect = run
+    return db
+
+
+class TestTableRegistry:
+    def test_unused_columns_are_not_selected(self, mock_client):
+        invalidate_column_cache()
+        db = Mock()
+        db.run.return_value = [
+            ("department", column)
+            for column in [
+                "department_id",
+                "department_name",
+                "location",
+                "manager",
+                "created_at",
+                "last_updated",
+            ]
+        ]
+        db.prepare.return_value.run.return_value = []
+
+        write_data(
+            "2025-02-24 12:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            db,
+            bucketname="test_bucket",
+        )
+
+        queries = [call.args[0] for call in db.prepare.call_args_list]
+        department = next(q for q in queries if "FROM department" in q)
+        assert department.startswith(
+            "SELECT department_id, department_name, location, created_at, "
+            "last_updated FROM department"
+        )
+        assert "manager" not in department
+        invalidate_column_cache()
+
+    def test_registry_declares_keys_and_keeps_column_order(self):
+        assert TABLE_LIST == list(TABLE_REGISTRY)
+        assert primary_key("address") == "address_id"
+        assert primary_key("payment") == "payment_id"
+        assert projected_columns(
+            "counterparty",
+            [
+                "counterparty_id",
+                "counterparty_legal_name",
+                "legal_address_id",
+                "commercial_contact",
+                "delivery_contact",
+                "created_at",
+                "last_updated",
+            ],
+        ) == [
+            "counterparty_id",
+            "counterparty_legal_name",
+            "legal_address_id",
+            "created_at",
+            "last_updated",
+        ]
+        assert projected_columns("payment", ["payment_id", "notes"]) == [
+            "payment_id",
+            "notes",
+        ]
+
+
+def backfill_db(rows, tables=("design",)):
+    """A source whose tables all have ({table}_id, last_updated) and the same rows."""
+    db = Mock()
+
+    def run(sql, **params):
+        if "localtimestamp" in sql:
+            return [(datetime(2025, 2, 25, 12),)]
+        return [
+            (table, column)
+            for table in tables
+            for column in (f"{table}_id", "last_updated")
+        ]
+
+    def prepare(sql):
+        table = next(table for table in tables if f"{table}_id" in sql)
+        statement = Mock()
+        statement.row_desc = [
+            {"name": f"{table}_id", "type_oid": 23},
+            {"name": "last_updated", "type_oid": 1114},
+        ]
+
+        def page(limit, after=0):
+            return tuple(row for row in rows if row[0] > after)[:limit]
+
+        statement.run.side_effect = page
+        return statement
+
+    db.run.side_effect = run
+    db.prepare.side_effect = prepare
+    return db
+
+
+class TestBackfill:
+    rows = [(i, datetime(2025, 2, 20 + i, 13)) for i in range(1, 6)]
+    run_time = "2025-02-25 12:00:00.000000"
+    filepath = "data/by time/2025/02-February/25/12:00:00.000000/design"
+
+    def test_backfill_writes_key_ranges_as_parts(self, mock_client):
+        result = backfill(
+            backfill_db(self.rows),
+            mock_client,
+            {},
+            self.run_time,
+            bucketname="test_bucket",
+            range_size=2,
+            extract_format="json",
+            table_list=["design"],
+        )
+
+        assert result["status"] == "complete"
+        assert result["filepaths"] == [
+            f"{self.filepath}/part-00001",
+            f"{self.filepath}/part-00002",
+            f"{self.filepath}/part-00003",
+        ]
+        ids = []
+        for key in result["filepaths"]:
+            body = mock_client.get_object(Bucket="test_bucket", Key=key)["Body"].read()
+            ids += [row["design_id"] for row in json.loads(body)]
+        assert ids == [1, 2, 3, 4, 5]
+        # capped at the database time the backfill started
+        assert result["watermarks"] == {"design": "2025-02-25 12:00:00.000000"}
+        with pytest.raises(ClientError):
+            mock_client.get_object(Bucket="test_bucket", Key=BACKFILL_CHECKPOINT_KEY)
+
+    def test_backfill_resumes_from_checkpoint(self, mock_client):
+        context = Mock()
+        context.get_remaining_time_in_millis.side_effect = [900000, 1000]
+
+        paused = backfill(
+            backfill_db(self.rows),
+            mock_client,
+            context,
+            self.run_time,
+            bucketname="test_bucket",
+            range_size=2,
+            table_list=["design"],
+        )
+        resumed = backfill(
+            backfill_db(self.rows),
+            mock_client,
+            {},
+            "2025-02-25 12:15:00.000000",
+            bucketname="test_bucket",
+            range_size=2,
+            table_list=["design"],
+            handed=paused["handed"],
+        )
+
+        assert paused["status"] == "in-progress"
+        # the part written so far is handed on, and isn't handed on again
+        assert paused["filepaths"] == [f"{self.filepath}/part-00001"]
+        assert paused["handed"] == {"design": 1}
+        assert "watermarks" not in paused
+        assert resumed["status"] == "complete"
+        assert resumed["run"] == self.run_time
+        assert resumed["filepaths"] == [
+            f"{self.filepath}/part-00002",
+            f"{self.filepath}/part-00003",
+        ]
+        body = mock_client.get_object(
+            Bucket="test_bucket", Key=f"{self.filepath}/part-00002"
+        )["Body"].read()
+        assert [row["design_id"] for row in decode_extract(body, "ndjson.gz")] == [3, 4]
+
+    def test_dependent_tables_are_handed_on_together(self, mock_client):
+        tables = ["address", "counterparty", "department", "staff"]
+        context = Mock()
+        # out of time part way through counterparty, after all of address
+        context.get_remaining_time_in_millis.side_effect = [900000] * 4 + [1000]
+        paused = backfill(
+            backfill_db(self.rows, tables),
+            mock_client,
+            context,
+            self.run_time,
+            bucketname="test_bucket",
+            range_size=2,
+            table_list=tables,
+        )
+        resumed = backfill(
+            backfill_db(self.rows, tables),
+            mock_client,
+            {},
+            "2025-02-25 12:15:00.000000",
+            bucketname="test_bucket",
+            range_size=2,
+            table_list=tables,
+        )
+
+        assert paused["filepaths"] == []
+        assert len(resumed["filepaths"]) == 12
+        handed_on = {key.split("/")[-2] for key in resumed["filepaths"]}
+        assert handed_on == set(tables)
+
+    def test_parts_are_handed_on_in_bounded_increments(self, mock_client):
+        tables = ["design", "address", "counterparty"]
+        increments = []
+        handed = None
+        while True:
+            result = backfill(
+                backfill_db(self.rows, tables),
+                mock_client,
+                {},
+                self.run_time,
+                bucketname="test_bucket",
+                range_size=2,
+                table_list=tables,
+                handoff_parts=2,
+                handed=handed,
+            )
+            increments.append([key.split("/", 6)[-1] for key in result["filepaths"]])
+            handed = result["handed"]
+            if result["status"] == "complete":
+                break
+
+        parts = [f"part-{n:05d}" for n in (1, 2, 3)]
+        assert increments == [
+            [f"design/{part}" for part in parts[:2]],
+            [f"design/{parts[2]}"],
+            # counterparty is joined with address, so they go as one (larger) increment
+            [
+                f"{table}/{part}"
+                for table in ("address", "counterparty")
+                for part in parts
+            ],
+        ]
+        assert result["watermarks"] == dict.fromkeys(tables, self.run_time)
+
+    def test_empty_table_still_gets_a_part(self, mock_client):
+        result = backfill(
+            backfill_db([]),
+            mock_client,
+            {},
+            self.run_time,
+            bucketname="test_bucket",
+            table_list=["design"],
+        )
+
+        assert result["filepaths"] == [f"{self.filepath}/part-00001"]
+        assert result["watermarks"] == {"design": "0001-01-01 00:00:00.000000"}
+
+
+class TestRowHashIndex:
+    columns = ["design_id", "design_name", "last_updated"]
+
+    def test_merge_keeps_keys_sorted(self):
+        index = RowHashIndex()
+        index.changes = {5: 50, 1: 10}
+        index = index.merged()
+        index.changes = {3: 30, 5: 55}
+
+        merged = RowHashIndex.from_bytes(index.merged().to_bytes())
+
+        assert list(merged.keys) == [1, 3, 5]
+        assert [merged.get(key) for key in (1, 3, 5, 7)] == [10, 30, 55, None]
+
+    def test_filter_drops_rows_with_only_a_new_last_updated(self):
+        index = RowHashIndex()
+        first = [
+            (1, "Wooden", datetime(2025, 2, 24)),
+            (2, "Steel", datetime(2025, 2, 24)),
+        ]
+        index.filter("design", self.columns, first)
+        index = index.merged()
+
+        kept = index.filter(
+            "design",
+            self.columns,
+            [
+                (1, "Wooden", datetime(2025, 2, 25)),
+                (2, "Bronze", datetime(2025, 2, 25)),
+            ],
+        )
+
+        assert kept == [(2, "Bronze", datetime(2025, 2, 25))]
+        assert index.suppressed == 1
+        assert list(index.changes) == [2]
+
+    def test_filter_ignores_the_registered_watermark_columns(self):
+        columns = ["design_id", "design_name", "last_updated", "paid_at"]
+        spec = {"primary_key": "design_id", "watermark_columns": ("paid_at",)}
+        index = RowHashIndex()
+
+        with patch.dict(TABLE_REGISTRY, {"design": spec}):
+            index.filter("design", columns, [(1, "Oak", datetime(2025, 2, 24), 1)])
+            index = index.merged()
+            kept = index.filter(
+                "design",
+                columns,
+                [
+                    (1, "Oak", datetime(2025, 2, 24), 2),
+                    (1, "Oak", datetime(2025, 2, 25), 3),
+                ],
+            )
+
+        # only a moved paid_at is suppressed; last_updated is an ordinary column here
+        assert kept == [(1, "Oak", datetime(2025, 2, 25), 3)]
+
+    def test_unchanged_rows_suppressed_across_committed_runs(self, mock_client):
+        db = Mock()
+        db.run.return_value = [("design", column) for column in self.columns]
+        db.prepare.return_value.run.return_value = [
+            (1, "Wooden", datetime(2025, 2, 24))
+        ]
+
+        def run(this_extraction_time):
+            result = write_data(
+                "2025-02-23 00:00:00.000000",
+                this_extraction_time,
+                mock_client,
+                db,
+                bucketname="test_bucket",
+                extract_format="json",
+                suppress_unchanged=True,
+            )
+            pending = stage_watermarks(
+                mock_client,
+                result["watermarks"],
+                this_extraction_time,
+                bucketname="test_bucket",
+                row_hashes=result["row_hashes"],
+            )
+            commit_watermarks(mock_client, pending, bucketname="test_bucket")
+            return result
+
+        first = run("2025-02-24 12:00:00.000000")
+        db.prepare.return_value.run.return_value = [
+            (1, "Wooden", datetime(2025, 2, 25))
+        ]
+        second = run("2025-02-25 12:00:00.000000")
+
+        assert first["suppressed"]["design"] == 0
+        assert second["suppressed"]["design"] == 1
+        assert second["row_hashes"] == {}
+        design = [path for path in second["filepaths"] if path.endswith("/design")][0]
+        body = mock_client.get_object(Bucket="test_bucket", Key=design)["Body"].read()
+        assert json.loads(body) == []
+        assert second["watermarks"]["design"] == "2025-02-25 00:00:00.000000"
+        listed = mock_client.list_objects_v2(Bucket="test_bucket", Prefix="row_hashes/")
+        assert [obj["Key"] for obj in listed["Contents"]] == [
+            "row_hashes/current/design.bin"
+        ]
+
+    def test_rows_written_unhashed_drop_the_index(self, mock_client):
+        """Oak on a fetch run, Pine on a COPY run, then Oak again must not be suppressed."""
+        db = Mock()
+        db.run.return_value = [("design", column) for column in self.columns]
+
+        def run(this_extraction_time, rows, plan=None):
+            db.prepare.return_value.run.return_value = rows
+            with patch(
+                "src.extract_lambda.copy_table",
+                return_value=(1, "2025-02-25 00:00:00.000000"),
+            ):
+                result = write_data(
+                    "2025-02-23 00:00:00.000000",
+                    this_extraction_time,
+                    mock_client,
+                    db,
+                    bucketname="test_bucket",
+                    extract_format="json",
+                    suppress_unchanged=True,
+                    plan=plan,
+                )
+            pending = stage_watermarks(
+                mock_client,
+                result["watermarks"],
+                this_extraction_time,
+                bucketname="test_bucket",
+                row_hashes=result["row_hashes"],
+            )
+            commit_watermarks(mock_client, pending, bucketname="test_bucket")
+            return result
+
+        run("2025-02-24 12:00:00.000000", [(1, "Oak", datetime(2025, 2, 24))])
+        copied = run(
+            "2025-02-25 12:00:00.000000", [], plan={"design": {"strategy": "copy"}}
+        )
+        third = run("2025-02-26 12:00:00.000000", [(1, "Oak", datetime(2025, 2, 26))])
+
+        assert copied["row_hashes"]["design"] is None
+        assert third["suppressed"]["design"] == 0
+        design = [path for path in third["filepaths"] if path.endswith("/design")][0]
+        body = mock_client.get_object(Bucket="test_bucket", Key=design)["Body"].read()
+        assert json.loads(body) == [
+            {
+                "design_id": 1,
+                "design_name": "Oak",
+                "last_updated": "2025-02-26 00:00:00.000000",
+            }
+        ]
+
+    def test_stream_table_filters_chunks(self, mock_client):
+        db = Mock()
+        db.run.side_effect = [
+            None,
+            [(1, "Wooden", datetime(2025, 2, 25)), (2, "Steel", datetime(2025, 2, 26))],
+            [],
+            None,
+        ]
+
+        row_count, watermark = stream_table(
+            db,
+            "SELECT * FROM design",
+            {},
+            self.columns,
+            mock_client,
+            "test_bucket",
+            "design",
+            extract_format="json",
+            row_filter=lambda rows: rows[:1],
+        )
+
+        assert row_count == 1
+        assert watermark == "2025-02-26 00:00:00.000000"
+
+
+class TestChangeProbe:
+    def test_probe_is_one_query_for_all_tables(self):
+        db = Mock()
+        db.run.return_value = [
+            ("design", datetime(2025, 2, 25, 9)),
+            ("staff", datetime(2025, 2, 24, 9)),
+            ("currency", None),
+        ]
+
+        changed = probe_changes(
+            db,
+            {
+                "design": "2025-02-24 12:00:00.000000",
+                "staff": "2025-02-24 12:00:00.000000",
+            },
+            ["design", "staff", "currency"],
+        )
+
+        assert changed == {"design": "2025-02-25 09:00:00.000000"}
+        db.run.assert_called_once()
+        query = db.run.call_args[0][0]
+        assert query.count("UNION ALL") == 2
+        assert "greatest(max(created_at), max(last_updated))" in query
+
+    def test_probe_reads_each_tables_watermark_columns(self):
+        db = Mock()
+        db.run.return_value = [("payment", datetime(2025, 2, 25, 9))]
+        spec = {
+            "primary_key": "payment_id",
+            "watermark_columns": ("payment_date",),
+            "columns": None,
+        }
+
+        with patch.dict(TABLE_REGISTRY, {"payment": spec}):
+            changed = probe_changes(db, {}, ["payment", "design"])
+
+        assert changed == {"payment": "2025-02-25 09:00:00.000000"}
+        query = db.run.call_args[0][0]
+        assert "greatest(max(payment_date)) FROM payment" in query
+        assert "greatest(max(created_at), max(last_updated)) FROM design" in query
+
+
+class TestRunManifest:
+    columns = ["design_id", "design_name", "last_updated"]
+
+    def test_write_data_records_manifest(self, mock_client):
+        db = Mock()
+        db.run.return_value = [("design", column) for column in self.columns]
+        db.prepare.return_value.run.return_value = [
+            (1, "Wooden", datetime(2025, 2, 24, 9)),
+            (2, "Steel", datetime(2025, 2, 25, 9)),
+        ]
+
+        result = write_data(
+            "2025-02-23 00:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            db,
+            bucketname="test_bucket",
+        )
+
+        manifest = result["manifest"]
+        prefix = "data/by time/2025/02-February/25/12:00:00.000000"
+        assert manifest["stage"] == "extract"
+        assert manifest["prefix"] == prefix
+        assert list(manifest["tables"]) == TABLE_LIST
+        design = manifest["tables"]["design"]
+        body = mock_client.get_object(Bucket="test_bucket", Key=design["key"])[
+            "Body"
+        ].read()
+        assert design["row_count"] == 2
+        assert design["byte_size"] == len(body)
+        assert design["sha256"] == hashlib.sha256(body).hexdigest()
+        assert design["min_last_updated"] == "2025-02-24 09:00:00.000000"
+        assert design["max_last_updated"] == "2025-02-25 09:00:00.000000"
+        assert manifest["tables"]["staff"]["row_count"] == 2
+        assert design["schema_hash"] != manifest["tables"]["staff"]["schema_hash"]
+        stored = mock_client.get_object(
+            Bucket="test_bucket", Key=f"{prefix}/_manifest.json"
+        )
+        assert json.loads(stored["Body"].read()) == manifest
+
+    def test_write_data_continues_where_it_ran_out_of_time(self, mock_client):
+        db = Mock()
+        db.run.return_value = [("design", column) for column in self.columns]
+        db.prepare.return_value.run.return_value = [
+            (1, "Wooden", datetime(2025, 2, 24, 9)),
+        ]
+        context = Mock()
+        context.get_remaining_time_in_millis.side_effect = [900000, 900000] + [
+            1000
+        ] * len(TABLE_LIST)
+        prefix = "data/by time/2025/02-February/25/12:00:00.000000"
+
+        paused = write_data(
+            "2025-02-23 00:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            db,
+            bucketname="test_bucket",
+            context=context,
+        )
+        with pytest.raises(ClientError):
+            mock_client.get_object(Bucket="test_bucket", Key=f"{prefix}/_manifest.json")
+        resumed = write_data(
+            "2025-02-23 00:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            db,
+            bucketname="test_bucket",
+            completed=json.loads(json.dumps(paused)),
+        )
+
+        assert paused["remaining"] == sorted(TABLE_LIST[2:])
+        assert paused["filepaths"] == [f"{prefix}/{t}" for t in TABLE_LIST[:2]]
+        assert paused["watermarks"]["design"] == "2025-02-23 00:00:00.000000"
+        assert set(paused["manifest"]) == set(TABLE_LIST[:2])
+        assert resumed["remaining"] == []
+        assert resumed["filepaths"] == [f"{prefix}/{t}" for t in TABLE_LIST]
+        assert resumed["watermarks"]["design"] == "2025-02-24 09:00:00.000000"
+        assert list(resumed["manifest"]["tables"]) == TABLE_LIST
+        assert mock_client.get_object(
+            Bucket="test_bucket", Key=f"{prefix}/_manifest.json"
+        )
+
+    def test_hive_layout_partitions_by_table_and_date(self, mock_client):
+        db = Mock()
+        db.run.return_value = [("design", column) for column in self.columns]
+        db.prepare.return_value.run.return_value = [
+            (1, "Wooden", datetime(2025, 2, 24, 9)),
+        ]
+
+        result = write_data(
+            "2025-02-23 00:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            db,
+            bucketname="test_bucket",
+            layout="hive",
+        )
+
+        assert result["filepaths"][TABLE_LIST.index("design")] == (
+            "data/table=design/dt=2025-02-25/run=20250225T120000.000000/design"
+        )
+        assert result["manifest"]["layout"] == "hive"
+        mock_client.head_object(
+            Bucket="test_bucket",
+            Key="data/_runs/dt=2025-02-25/run=20250225T120000.000000/_manifest.json",
+        )
+        index = mock_client.get_object(
+            Bucket="test_bucket", Key="data/table=design/dt=2025-02-25/_index.json"
+        )
+        assert json.loads(index["Body"].read())["runs"] == [
+            {
+                "run": "20250225T120000.000000",
+                "key": result["filepaths"][TABLE_LIST.index("design")],
+                "row_count": 1,
+            }
+        ]
+
+    def test_streamed_table_fills_stats(self, mock_client):
+        db = Mock()
+        db.run.side_effect = [None, [(1, "Wooden", datetime(2025, 2, 25))], [], None]
+        stats = {}
+
+        stream_table(
+            db,
+            "SELECT * FROM design",
+            {},
+            self.columns,
+            mock_client,
+            "test_bucket",
+            "design",
+            stats=stats,
+        )
+
+        body = mock_client.get_object(Bucket="test_bucket", Key="design")["Body"].read()
+        assert stats["row_count"] == 1
+        assert stats["byte_size"] == len(body)
+        assert stats["sha256"] == hashlib.sha256(body).hexdigest()
+        assert stats["max_last_updated"] == "2025-02-25 00:00:00.000000"
+
+
+class TestCopyTable:
+    query = """SELECT * FROM design WHERE created_at > :last_extract_time
+               OR last_updated > :last_extract_time"""
+
+    def test_copy_output_is_gzipped_into_bucket(self, mock_client):
+        db = copy_db(
+            [b'"1","Wooden","2025-02-25 09:00:00.5"\n', b'"2",\\N,\\N\n'],
+            2,
+            (datetime(2025, 2, 25, 9), datetime(2025, 2, 25, 9, 0, 0, 500000)),
+        )
+
+        row_count, watermark = copy_table(
+            db,
+            "design",
+            self.query,
+            datetime(2025, 2, 24, 12),
+            mock_client,
+            "test_bucket",
+            "design",
+        )
+
+        copy_sql = db.run.call_args_list[-1][0][0]
+        assert copy_sql.startswith("COPY (SELECT * FROM design")
+        assert "'2025-02-24 12:00:00.000000'::timestamp" in copy_sql
+        assert ":last_extract_time" not in copy_sql
+        assert row_count == 2
+        assert watermark == "2025-02-25 09:00:00.500000"
+        response = mock_client.get_object(Bucket="test_bucket", Key="design")
+        assert response["Metadata"] == {
+            "extract-format": COPY_FORMAT,
+            "column-types": "23,1043,1114",
+        }
+        assert decode_extract(
+            response["Body"].read(), COPY_FORMAT, response["Metadata"]["column-types"]
+        ) == [
+            {
+                "design_id": 1,
+                "design_name": "Wooden",
+                "last_updated": "2025-02-25 09:00:00.500000",
+            },
+            {"design_id": 2, "design_name": None, "last_updated": None},
+        ]
+
+    def test_summary_reads_the_registered_watermark_columns(self, mock_client):
+        db = copy_db(
+            [b'"1","Wooden","2025-02-25 09:00:00"\n'],
+            1,
+            (datetime(2025, 2, 26, 9),),
+        )
+        spec = {"primary_key": "design_id", "watermark_columns": ("paid_at",)}
+
+        with patch.dict(TABLE_REGISTRY, {"design": spec}):
+            _, watermark = copy_table(
+                db,
+                "design",
+                self.query,
+                datetime(2025, 2, 24, 12),
+                mock_client,
+                "test_bucket",
+                "design",
+            )
+
+        summary = db.run.call_args_list[0][0][0]
+        assert "min(greatest(paid_at)), max(paid_at)" in summary
+        assert "last_updated" not in summary.split("FROM")[0]
+        assert watermark == "2025-02-26 09:00:00.000000"
+
+    def test_row_count_mismatch_aborts(self, mock_client):
+        db = copy_db([b'"1","Wooden","2025-02-25 09:00:00"\n'], 2)
+
+        with pytest.raises(ValueError, match="COPY wrote 1 rows"):
+            copy_table(
+                db,
+                "design",
+                self.query,
+                datetime(2025, 2, 24, 12),
+                mock_client,
+                "test_bucket",
+                "design",
+            )
+
+        assert "Contents" not in mock_client.list_objects_v2(Bucket="test_bucket")
+
+    def test_copy_rows_match_row_by_row_extract(self):
+        rows = [
+            (1, "Wooden", datetime(2025, 2, 25, 9, 0, 0, 123000)),
+            (2, "", None),
+        ]
+        csv_rows = [
+            b'"1","Wooden","2025-02-25 09:00:00.123"\n',
+            b'"2","",\\N\n',
+        ]
+        columns = ["design_id", "design_name", "last_updated"]
+        client = Mock()
+        copy_table(
+            copy_db(csv_rows, 2),
+            "design",
+            self.query,
+            datetime(2025, 2, 24, 12),
+            client,
+            "test_bucket",
+            "design",
+        )
+        put = client.put_object.call_args[1]
+
+        encoder = make_encoder("json", columns)
+        expected = decode_extract(encoder.encode(rows) + encoder.finish())
+        copied = decode_extract(
+            put["Body"],
+            put["Metadata"]["extract-format"],
+            put["Metadata"]["column-types"],
+        )
+        assert copied == expected
+
+    @patch(
+        "src.extract_lambda.copy_table", return_value=(0, "2025-02-26 00:00:00.000000")
+    )
+    def test_write_data_copies_selected_tables(self, mock_copy, mock_client, mock_db):
+        result = write_data(
+            "2025-02-24 12:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            mock_db,
+            bucketname="test_bucket",
+            copy_tables=["design"],
+        )
+
+        assert [call[0][1] for call in mock_copy.call_args_list] == ["design"]
+        assert result["watermarks"]["design"] == "2025-02-26 00:00:00.000000"
+        mock_db.run.assert_any_call("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        assert mock_db.prepare.return_value.run.call_count == len(TABLE_LIST) - 1
+
+
+class TestParallelExtraction:
+    def test_export_snapshot(self):
+        db = Mock()
+        db.run.return_value = [("00000003-0000001B-1",)]
+
+        assert export_snapshot(db) == "00000003-0000001B-1"
+        db.rollback.assert_called_once()
+        assert db.run.call_args_list[0][0][0] == (
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+        )
+
+    def test_workers_attach_to_exported_snapshot(self, mock_client, mock_db):
+        mock_db.run.side_effect = lambda sql, **params: (
+            [("00000003-0000001B-1",)] if "pg_export_snapshot" in sql else []
+        )
+        worker_conns = []
+
+        def connect():
+            conn = Mock()
+            conn.prepare.return_value.run.return_value = [(1,)]
+            worker_conns.append(conn)
+            return conn
+
+        result = write_data(
+            "2025-02-24 12:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            mock_db,
+            bucketname="test_bucket",
+            workers=3,
+            connect=connect,
+            extract_format="json",
+        )
+
+        assert 1 <= len(worker_conns) <= 3
+        for conn in worker_conns:
+            sqls = [c[0][0] for c in conn.run.call_args_list]
+            assert sqls[0] == "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+            assert sqls[1] == "SET TRANSACTION SNAPSHOT '00000003-0000001B-1'"
+            conn.close.assert_called_once()
+        for filepath in result["filepaths"]:
+            body = mock_client.get_object(Bucket="test_bucket", Key=filepath)
+            assert json.loads(body["Body"].read()) == [{}]
+        mock_db.prepare.assert_not_called()
+
+    def test_worker_error_is_raised_and_connections_closed(self, mock_client, mock_db):
+        mock_db.run.side_effect = lambda sql, **params: (
+            [("snapshot",)] if "pg_export_snapshot" in sql else []
+        )
+        conn = Mock()
+        conn.prepare.return_value.run.side_effect = Exception("query failed")
+
+        with pytest.raises(Exception, match="query failed"):
+            write_data(
+                "2025-02-24 12:00:00.000000",
+                "2025-02-25 12:00:00.000000",
+                mock_client,
+                mock_db,
+                bucketname="test_bucket",
+                workers=2,
+                connect=lambda: conn,
+            )
+
+        conn.close.assert_called()
+
+
+class TestRangeScan:
+    columns = ["sales_order_id", "units_sold", "last_updated"]
+
+    def test_key_ranges_cover_every_key(self):
+        db = Mock()
+        db.run.return_value = [(1, 10)]
+
+        ranges = key_ranges(db, "sales_order", 3, "2025-02-24 12:00:00.000000")
+
+        assert ranges == [(None, 5), (5, 9), (9, None)]
+        assert "min(sales_order_id)" in db.run.call_args[0][0]
+
+    def test_key_ranges_of_unchanged_table(self):
+        db = Mock()
+        db.run.return_value = [(None, None)]
+
+        assert key_ranges(db, "sales_order", 3, "2025-02-24 12:00:00.000000") == []
+
+    def test_ranges_are_scanned_in_parallel_as_parts(self, mock_client):
+        invalidate_column_cache()
+        rows = [(key, 10, datetime(2025, 2, 25, 9, key)) for key in range(1, 11)]
+        db = Mock()
+
+        def run(sql, **params):
+            if "information_schema" in sql:
+                return [("sales_order", column) for column in self.columns]
+            if sql.startswith("SELECT min"):
+                return [(1, 10)]
+            return [("snapshot",)]
+
+        db.run.side_effect = run
+        worker_conns = []
+        # every range has to be in flight at once for the scans to get past this
+        scanning = threading.Barrier(3, timeout=5)
+        scan_threads = set()
+
+        def scan(sql, **params):
+            if "FROM sales_order" in sql:
+                scan_threads.add(threading.get_ident())
+                scanning.wait()
+            return [
+                row
+                for row in rows
+                if "FROM sales_order" in sql
+                and row[0] >= params.get("range_start", row[0])
+                and row[0] < params.get("range_end", row[0] + 1)
+            ]
+
+        def connect():
+            conn = Mock()
+
+            def prepare(sql):
+                statement = Mock(row_desc=None)
+                statement.run.side_effect = partial(scan, sql)
+                return statement
+
+            conn.prepare.side_effect = prepare
+            worker_conns.append(conn)
+            return conn
+
+        result = write_data(
+            "2025-02-24 12:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            db,
+            bucketname="test_bucket",
+            connect=connect,
+            extract_format="json",
+            range_tables={"sales_order": 3},
+        )
+
+        prefix = "data/by time/2025/02-February/25/12:00:00.000000/sales_order"
+        parts = [f"{prefix}/part-0000{number}" for number in (1, 2, 3)]
+        assert [p for p in result["filepaths"] if "sales_order" in p] == parts
+        entry = result["manifest"]["tables"]["sales_order"]
+        assert entry["key"] == prefix
+        assert entry["row_count"] == 10
+        assert [part["row_count"] for part in entry["parts"]] == [4, 4, 2]
+        assert entry["max_last_updated"] == "2025-02-25 09:10:00.000000"
+        assert result["watermarks"]["sales_order"] == "2025-02-25 09:10:00.000000"
+        keys = []
+        for part in parts:
+            body = mock_client.get_object(Bucket="test_bucket", Key=part)["Body"]
+            keys += [row["sales_order_id"] for row in json.loads(body.read())]
+        assert keys == list(range(1, 11))
+        assert len(scan_threads) == 3
+        assert len(worker_conns) == 3
+        for conn in worker_conns:
+            assert (
+                conn.run.call_args_list[1][0][0]
+                == "SET TRANSACTION SNAPSHOT 'snapshot'"
+            )
+        db.prepare.assert_not_called()
+        invalidate_column_cache()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestThrottle:
+    def test_overdraft_is_slept_off(self):
+        clock = FakeClock()
+        throttle = Throttle(rows_per_second=100, clock=clock, sleep=clock.sleep)
+
+        throttle.consume(50)
+        throttle.consume(250)
+
+        assert clock.sleeps == [2.0]
+        assert throttle.metrics()["throttled_ms"] == 2000.0
+
+    def test_slow_queries_back_off_and_recover(self):
+        clock = FakeClock()
+        throttle = Throttle(
+            rows_per_second=100, latency_ms=100, clock=clock, sleep=clock.sleep
+        )
+
+        for _ in range(5):
+            with throttle.query():
+                clock.now += 0.5
+        assert throttle.backoff == 8
+        throttle.consume(100)
+        assert clock.sleeps == [pytest.approx(7.0)]
+
+        with throttle.query():
+            pass
+        assert throttle.backoff == 6.25
+        assert throttle.metrics()["slow_queries"] == 5
+        assert throttle.metrics()["max_backoff"] == 8
+
+    def test_table_budget_draws_on_run_budget(self):
+        clock = FakeClock()
+        run = Throttle(bytes_per_second=1000, clock=clock, sleep=clock.sleep)
+        table = Throttle(rows_per_second=10, parent=run, clock=clock, sleep=clock.sleep)
+
+        table.consume(5, 3000)
+
+        assert clock.sleeps == [2.0]
+        assert run.metrics()["throttled_ms"] == 2000.0
+        assert table.metrics()["throttled_ms"] == 0
+
+    def test_write_data_reports_throttling(self, mock_client, mock_db):
+        mock_db.prepare.return_value.run.return_value = [(1, "a")]
+
+        result = write_data(
+            "2025-02-24 12:00:00.000000",
+            "2025-02-25 12:00:00.000000",
+            mock_client,
+            mock_db,
+            bucketname="test_bucket",
+            budget={"max_queries": 1, "tables": {"design": {"rows_per_second": 1e6}}},
+        )
+
+        assert result["throttle"]["run"]["queries"] == len(TABLE_LIST)
+        assert list(result["throttle"]["tables"]) == ["design"]
+        assert result["throttle"]["tables"]["design"]["queries"] == 1
+
+
 class TestCloudWatchLogging:
-    def test_get_time_logs_correct_text_for_extraction_time_error(
+    def test_get_watermarks_logs_correct_text_for_extraction_time_error(
         self, caplog, aws_credentials
     ):
         with mock_aws():
@@ -143,10 +1650,10 @@ class TestCloudWatchLogging:
                 CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
             )
             with caplog.at_level(logging.INFO):
-                get_time(client, bucketname="testingBucket")
+                get_watermarks(client, ["design"], bucketname="testingBucket")
                 assert "No most recent extraction time." in caplog.text
 
-    def test_get_time_logs_correct_text_for_any_other_error(
+    def test_get_watermarks_logs_correct_text_for_any_other_error(
         self, caplog, aws_credentials
     ):
         with mock_aws():
@@ -158,7 +1665,7 @@ class TestCloudWatchLogging:
             )
             with caplog.at_level(logging.INFO):
                 with pytest.raises(ClientError):
-                    get_time(client, bucketname="noBucket")
+                    get_watermarks(client, ["design"], bucketname="noBucket")
                 assert "ERROR! Issues getting extraction time." in caplog.text
 
     def test_write_data_logs_correct_text(self, mock_client, mock_db, caplog):
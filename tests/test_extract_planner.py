@@ -0,0 +1,239 @@
+import json
+import os
+import pytest
+import boto3
+from unittest.mock import Mock, patch
+from moto import mock_aws
+from src.extract_tables import TABLE_LIST, invalidate_column_cache
+from src.extract_planner import (
+    PLAN_KEY,
+    choose_strategy,
+    diagnose,
+    diagnose_table,
+    plan_extraction,
+    record_plan,
+)
+from src.extract_lambda import write_data
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture
+def mock_client(aws_credentials):
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+@pytest.fixture
+def mock_db():
+    mock_db = Mock()
+    mock_db.run.return_value = [("design", "column1"), ("design", "column2")]
+    mock_db.prepare.return_value.run.return_value = []
+
+    return mock_db
+
+
+@pytest.fixture(autouse=True)
+def clear_column_cache():
+    invalidate_column_cache()
+    yield
+    invalidate_column_cache()
+
+
+def explained(node_type, cost, **analyze):
+    plan = {"Node Type": node_type, "Relation Name": "design", "Total Cost": cost}
+    plan.update(analyze)
+    return [[[{"Plan": plan, "Planning Time": 0.1, "Execution Time": 1.5}]]]
+
+
+class TestDiagnostics:
+    columns = ["design_id", "design_name", "created_at", "last_updated"]
+    watermark = "2025-02-24 12:00:00.000000"
+
+    def diagnostics_db(self, node_type="Seq Scan", earlier=0):
+        def run(sql, **params):
+            if sql.startswith("EXPLAIN (ANALYZE"):
+                return explained(
+                    node_type,
+                    25.0,
+                    **{
+                        "Actual Rows": 3,
+                        "Actual Loops": 1,
+                        "Rows Removed by Filter": 997,
+                        "Shared Hit Blocks": 10,
+                        "Shared Read Blocks": 2,
+                    },
+                )
+            if sql.startswith("EXPLAIN") and " UNION " in sql:
+                return explained("Append", 12.0)
+            if sql.startswith("EXPLAIN"):
+                return explained("Index Scan", 8.0)
+            if sql.startswith("SELECT count"):
+                return [(earlier,)]
+            return []
+
+        db = Mock()
+        db.run.side_effect = run
+        return db
+
+    def test_seq_scan_gets_single_column_rewrite(self):
+        db = self.diagnostics_db()
+
+        report = diagnose_table(db, "design", self.columns, self.watermark, set())
+
+        assert report["plan"]["seq_scans"] == ["design"]
+        assert report["plan"]["rows_scanned"] == 1000
+        assert report["plan"]["execution_ms"] == 1.5
+        assert report["candidates"]["union"]["estimated_cost"] == 12.0
+        assert report["recommendation"] == "last_updated_only"
+        assert report["index_ddl"] == [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS design_last_updated_idx "
+            "ON design (last_updated)"
+        ]
+
+    def test_union_when_last_updated_can_precede_created_at(self):
+        db = self.diagnostics_db(earlier=2)
+
+        report = diagnose_table(
+            db, "design", self.columns, self.watermark, {"created_at"}
+        )
+
+        assert not report["candidates"]["last_updated_only"]["valid"]
+        assert report["recommendation"] == "union"
+        assert report["index_ddl"] == [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS design_last_updated_idx "
+            "ON design (last_updated)"
+        ]
+
+    def test_indexed_plan_is_kept(self):
+        db = self.diagnostics_db(node_type="Bitmap Heap Scan")
+
+        report = diagnose_table(db, "design", self.columns, self.watermark, set())
+
+        assert report["recommendation"] == "keep"
+        assert report["index_ddl"] == []
+
+    def test_report_is_written_to_bucket(self, mock_client):
+        invalidate_column_cache()
+        db = self.diagnostics_db()
+        run = db.run.side_effect
+        db.run.side_effect = lambda sql, **params: (
+            [("design", column) for column in self.columns]
+            if "information_schema" in sql
+            else run(sql, **params)
+        )
+
+        result = diagnose(
+            db,
+            mock_client,
+            "2025-02-25 12:00:00.000000",
+            {"design": self.watermark},
+            bucketname="test_bucket",
+            table_list=["design"],
+        )
+
+        stored = mock_client.get_object(Bucket="test_bucket", Key=result["key"])
+        assert result["key"] == "diagnostics/20250225T120000.000000.json"
+        assert json.loads(stored["Body"].read()) == result["tables"]
+        assert not any(
+            call.args[0].startswith(("CREATE", "COPY", "DECLARE"))
+            for call in db.run.call_args_list
+        )
+        invalidate_column_cache()
+
+
+class TestExtractionPlanner:
+    watermark = "2025-02-24 12:00:00.000000"
+
+    @pytest.mark.parametrize(
+        "estimate,strategy",
+        [
+            (0, ("fetch", 1)),
+            (50000, ("fetch", 1)),
+            (200000, ("stream", 1)),
+            (1500000, ("copy", 1)),
+            (3500000, ("range", 4)),
+            (50000000, ("range", 8)),
+        ],
+    )
+    def test_choose_strategy(self, estimate, strategy):
+        assert choose_strategy(estimate) == strategy
+
+    def test_small_tables_are_counted_and_big_ones_use_last_run(self, mock_client):
+        mock_client.put_object(
+            Bucket="test_bucket",
+            Key=PLAN_KEY,
+            Body=json.dumps({"tables": {"sales_order": {"actual_rows": 900000}}}),
+        )
+        db = Mock()
+
+        def run(sql, **params):
+            if "pg_class" in sql:
+                return [("design", 1000.0), ("sales_order", 5000000.0)]
+            return [("design", 12), ("currency", 0)]
+
+        db.run.side_effect = run
+
+        plan = plan_extraction(
+            db,
+            mock_client,
+            {"design": self.watermark, "sales_order": self.watermark},
+            bucketname="test_bucket",
+            table_list=["design", "currency", "sales_order"],
+        )
+
+        assert plan["design"] == {
+            "strategy": "fetch",
+            "parts": 1,
+            "estimated_rows": 12,
+            "estimate_source": "count",
+        }
+        assert plan["sales_order"]["strategy"] == "copy"
+        assert plan["sales_order"]["estimate_source"] == "previous run"
+        count_sql, count_params = db.run.call_args_list[-1][0][0], db.run.call_args[1]
+        assert "sales_order" not in count_sql
+        assert set(count_params) == {"since_0", "since_1"}
+
+    def test_plan_overrides_run_wide_settings(self, mock_client, mock_db):
+        mock_db.prepare.return_value.run.return_value = []
+        plan = {
+            table: {"strategy": "fetch", "parts": 1, "estimated_rows": 0}
+            for table in TABLE_LIST
+        }
+
+        with patch("src.extract_lambda.stream_table") as stream:
+            result = write_data(
+                "2025-02-24 12:00:00.000000",
+                "2025-02-25 12:00:00.000000",
+                mock_client,
+                mock_db,
+                bucketname="test_bucket",
+                stream=True,
+                plan=plan,
+            )
+
+        stream.assert_not_called()
+        assert set(result["timings"]) == set(TABLE_LIST)
+        record = record_plan(
+            mock_client, "2025-02-25 12:00:00.000000", plan, result, "test_bucket"
+        )
+        stored = mock_client.get_object(Bucket="test_bucket", Key=PLAN_KEY)
+        assert json.loads(stored["Body"].read()) == record
+        run = mock_client.get_object(
+            Bucket="test_bucket", Key="plans/20250225T120000.000000.json"
+        )
+        assert json.loads(run["Body"].read()) == record
+        assert record["tables"]["design"]["actual_rows"] == 0
+        assert record["tables"]["design"]["elapsed_ms"] >= 0
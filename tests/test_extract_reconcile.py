@@ -0,0 +1,146 @@
+import io
+import json
+import os
+import pytest
+import boto3
+import numpy as np
+from unittest.mock import Mock
+from moto import mock_aws
+from src.extract_reconcile import (
+    KeyMerge,
+    KeySink,
+    diff_keys,
+    encode_keys,
+    iter_keys,
+    pk_snapshot_key,
+    reconcile,
+)
+from src.extract_lambda import commit_watermarks, stage_watermarks
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture
+def mock_client(aws_credentials):
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+def read_keys(data):
+    chunks = list(iter_keys(io.BytesIO(data)))
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+
+class TestReconcile:
+    @pytest.mark.parametrize(
+        "keys", [[], [7], list(range(1, 100001)), [3, 5, 1000, 2**40]]
+    )
+    def test_key_snapshots_round_trip(self, keys):
+        keys = np.array(keys, dtype=np.int64)
+
+        assert np.array_equal(read_keys(encode_keys(keys)), keys)
+        assert np.array_equal(read_keys(encode_keys(keys) * 2), np.tile(keys, 2))
+
+    def test_dense_keys_compress_to_a_few_bytes(self):
+        keys = np.arange(1, 10000001, dtype=np.int64)
+
+        assert len(encode_keys(keys)) < 100000
+
+    def test_diff_keys_finds_deleted_keys(self):
+        previous = np.array([1, 2, 3, 5, 8, 13], dtype=np.int64)
+        current = np.array([1, 3, 4, 8, 21], dtype=np.int64)
+
+        assert diff_keys(previous, current).tolist() == [2, 5, 13]
+        assert diff_keys(previous, current[:0]).tolist() == previous.tolist()
+
+    def test_key_sink_parses_copy_rows_in_chunks(self):
+        chunks = []
+        sink = KeySink(chunks.append, chunk_rows=2)
+        for key in (1, 2, 10, 300, 301):
+            sink.write(b"%d\n" % key)
+        sink.flush()
+
+        assert [chunk.tolist() for chunk in chunks] == [[1, 2], [10, 300], [301]]
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_key_merge_streams_deletes_one_chunk_at_a_time(self, seed):
+        rng = np.random.default_rng(seed)
+        previous = np.unique(rng.integers(1, 5000, 1000))
+        kept = previous[rng.random(previous.size) < 0.6]
+        current = np.union1d(kept, rng.integers(5000, 6000, 50))
+        gone, pending = [], []
+        snapshot = io.BytesIO()
+        merge = KeyMerge(
+            iter(np.array_split(previous, range(7, previous.size, 7))),
+            snapshot,
+            gone.append,
+        )
+        for chunk in np.array_split(current, range(11, current.size, 11)):
+            merge.add(chunk)
+            pending.append(merge.pending.size)
+        merge.finish()
+
+        assert np.concatenate(gone).tolist() == np.setdiff1d(previous, current).tolist()
+        assert np.array_equal(read_keys(snapshot.getvalue()), current)
+        assert max(pending) <= 7
+
+    def test_deleted_keys_become_tombstones_on_second_pass(self, mock_client):
+        source = {"design": [1, 2, 3, 4], "staff": [10, 11]}
+        db = Mock()
+
+        def run(sql, stream=None, **params):
+            for table, keys in source.items():
+                if f"FROM {table} " in sql:
+                    for key in keys:
+                        stream.write(b"%d\n" % key)
+            return []
+
+        db.run.side_effect = run
+
+        first = reconcile(
+            db,
+            mock_client,
+            "2025-02-25 12:00:00.000000",
+            bucketname="test_bucket",
+            table_list=["design", "staff"],
+        )
+        pending = stage_watermarks(
+            mock_client,
+            {},
+            "2025-02-25 12:00:00.000000",
+            bucketname="test_bucket",
+            pk_snapshots=first["pk_snapshots"],
+        )
+        commit_watermarks(mock_client, pending, bucketname="test_bucket")
+        source["design"] = [1, 4, 5]
+        second = reconcile(
+            db,
+            mock_client,
+            "2025-02-26 12:00:00.000000",
+            bucketname="test_bucket",
+            table_list=["design", "staff"],
+        )
+
+        assert first["tombstones"] == [] and first["deleted"] == {}
+        assert second["deleted"] == {"design": 2, "staff": 0}
+        assert second["tombstones"] == [
+            "tombstones/by time/2025/02-February/26/12:00:00.000000/design"
+        ]
+        body = mock_client.get_object(Bucket="test_bucket", Key=second["tombstones"][0])
+        assert json.loads(body["Body"].read()) == [{"design_id": 2}, {"design_id": 3}]
+        current = mock_client.get_object(
+            Bucket="test_bucket", Key=pk_snapshot_key("design")
+        )
+        assert read_keys(current["Body"].read()).tolist() == [1, 2, 3, 4]
@@ -0,0 +1,135 @@
+import pytest
+from unittest.mock import Mock
+from src.extract_tables import (
+    get_table_columns,
+    invalidate_column_cache,
+    run_table_query,
+)
+
+
+@pytest.fixture
+def mock_db():
+    mock_db = Mock()
+    mock_db.run.return_value = [("design", "column1"), ("design", "column2")]
+    mock_db.prepare.return_value.run.return_value = []
+
+    return mock_db
+
+
+@pytest.fixture(autouse=True)
+def clear_column_cache():
+    invalidate_column_cache()
+    yield
+    invalidate_column_cache()
+
+
+class TestColumnMetadata:
+    def test_single_query_for_all_tables(self):
+        db = Mock()
+        db.run.return_value = [
+            ("design", "design_id"),
+            ("design", "design_name"),
+            ("staff", "staff_id"),
+        ]
+
+        columns = get_table_columns(db, ["design", "staff", "currency"])
+
+        assert columns == {
+            "design": ["design_id", "design_name"],
+            "staff": ["staff_id"],
+            "currency": [],
+        }
+        db.run.assert_called_once()
+        assert db.run.call_args[1]["table_names"] == ["design", "staff", "currency"]
+
+    def test_metadata_is_cached_between_calls(self):
+        db = Mock()
+        db.run.return_value = [("design", "design_id")]
+
+        get_table_columns(db, ["design"])
+        columns = get_table_columns(db, ["design"])
+
+        assert columns == {"design": ["design_id"]}
+        db.run.assert_called_once()
+
+    def test_prepared_statement_is_reused(self, mock_db):
+        run_table_query(mock_db, "design", "SELECT 1", ["column1"])
+        run_table_query(mock_db, "design", "SELECT 1", ["column1"])
+
+        mock_db.prepare.assert_called_once_with("SELECT 1")
+        assert mock_db.prepare.return_value.run.call_count == 2
+
+    def test_schema_change_invalidates_cache(self):
+        db = Mock()
+        db.run.return_value = [("design", "design_id")]
+        get_table_columns(db, ["design"])
+        db.prepare.return_value.row_desc = [
+            {"name": "design_id"},
+            {"name": "design_name"},
+        ]
+        db.prepare.return_value.run.return_value = [(1, "Wooden")]
+        db.run.return_value = [("design", "design_id"), ("design", "design_name")]
+
+        data, columns, _ = run_table_query(db, "design", "SELECT 1", ["design_id"])
+
+        assert columns == ["design_id", "design_name"]
+        assert get_table_columns(db, ["design"]) == {
+            "design": ["design_id", "design_name"]
+        }
+        assert db.run.call_count == 2
+
+    def test_failed_prepared_statement_is_reprepared(self, mock_db):
+        mock_db.prepare.return_value.run.side_effect = [
+            Exception("cached plan must not change result type"),
+            [(1,)],
+        ]
+
+        data, columns, _ = run_table_query(mock_db, "design", "SELECT 1", ["column1"])
+
+        assert data == [(1,)]
+        mock_db.rollback.assert_called_once()
+        assert mock_db.prepare.call_count == 2
+
+    def test_dropped_column_is_projected_out_of_the_retry(self):
+        invalidate_column_cache()
+        db = Mock()
+        db.run.return_value = [
+            ("design", "design_id"),
+            ("design", "design_name"),
+            ("design", "file_name"),
+        ]
+        columns = get_table_columns(db, ["design"])["design"]
+        db.run.return_value = [("design", "design_id"), ("design", "design_name")]
+
+        def prepare(sql):
+            statement = Mock(row_desc=None)
+            if "file_name" in sql:
+                statement.run.side_effect = Exception(
+                    'column "file_name" does not exist'
+                )
+            else:
+                statement.run.return_value = [(1, "Wooden")]
+            return statement
+
+        db.prepare.side_effect = prepare
+
+        def build_query(columns):
+            return f"SELECT {', '.join(columns)} FROM design"
+
+        data, columns, _ = run_table_query(
+            db, "design", build_query(columns), columns, build_query=build_query
+        )
+
+        assert data == [(1, "Wooden")]
+        assert columns == ["design_id", "design_name"]
+        assert db.prepare.call_args[0][0] == "SELECT design_id, design_name FROM design"
+        invalidate_column_cache()
+
+    def test_failure_inside_a_shared_snapshot_is_not_retried(self, mock_db):
+        mock_db.prepare.return_value.run.side_effect = Exception("column dropped")
+
+        with pytest.raises(Exception, match="column dropped"):
+            run_table_query(mock_db, "design", "SELECT 1", ["column1"], snapshot=True)
+
+        mock_db.rollback.assert_not_called()
+        mock_db.prepare.assert_called_once()
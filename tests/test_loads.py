@@ -1,4 +1,5 @@
 from src.load_lambda import read_parquet, load_df_to_warehouse, lambda_handler
+from src.extract_encoders import S3MultipartWriter
 from src.transform_lambda import (
     transform_location,
     transform_counterparty,
@@ -12,8 +13,10 @@ from moto import mock_aws
 import pandas as pd
 import pytest
 import os
+import re
 import sqlite3  # import create_engine
 from botocore.exceptions import ClientError
+from unittest.mock import Mock, patch
 
 
 @pytest.fixture(scope="function")
@@ -480,3 +483,210 @@ def test_get_error_loading_to_warehouse_incorrect_data_type(
     print(exc_info.value)
 
     assert "has no" in str(exc_info.value) or "invalid" in str(exc_info.value).lower()
+
+
+def test_lambda_handler_no_op_skips_s3_and_warehouse():
+    client, conn = Mock(), Mock()
+
+    result = lambda_handler({"status": "no-op", "filepaths": []}, {}, client, conn)
+
+    assert result == {"status": "no-op"}
+    client.get_object.assert_not_called()
+    conn.assert_not_called()
+
+
+def test_lambda_handler_manifest_skips_empty_tables():
+    client, conn = Mock(), Mock()
+    tables = [
+        "dim_counterparty",
+        "dim_currency",
+        "dim_date",
+        "dim_design",
+        "dim_location",
+        "dim_staff",
+        "fact_sales_order",
+    ]
+    event = {
+        "filepaths": [f"run/{table}.parquet" for table in tables],
+        "manifest": {
+            "tables": {
+                table: {"key": f"run/{table}.parquet", "row_count": 0}
+                for table in tables
+            }
+        },
+    }
+
+    lambda_handler(event, {}, client, conn)
+
+    client.get_object.assert_not_called()
+
+
+def test_lambda_handler_fails_when_manifest_is_missing_a_table():
+    client = Mock()
+    event = {
+        "filepaths": ["run/dim_staff.parquet"],
+        "manifest": {
+            "tables": {
+                "dim_staff": {"key": "run/dim_staff.parquet", "row_count": 1},
+            }
+        },
+    }
+
+    with patch("src.load_lambda.read_parquet") as read, patch(
+        "src.load_lambda.load_df_to_warehouse"
+    ) as load:
+        with pytest.raises(RuntimeError, match="dim_counterparty"):
+            lambda_handler(event, {}, client, Mock())
+
+    read.assert_not_called()
+    load.assert_not_called()
+
+
+def test_lambda_handler_continues_after_running_short_of_time(aws_credentials):
+    tables = [
+        "dim_counterparty",
+        "dim_currency",
+        "dim_date",
+        "dim_design",
+        "dim_location",
+        "dim_staff",
+        "fact_sales_order",
+    ]
+    event = {"filepaths": [f"run/{table}.parquet" for table in tables]}
+    short = Mock(get_remaining_time_in_millis=Mock(return_value=1000))
+    with mock_aws():
+        client = boto3.client("s3", region_name="eu-west-2")
+        client.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.load_lambda.read_parquet") as read, patch(
+            "src.load_lambda.load_df_to_warehouse"
+        ) as load:
+            read.side_effect = lambda paths, *args: {
+                path.split("/")[-1].split(".")[0]: Mock() for path in paths
+            }
+
+            paused = lambda_handler(event, short, client, Mock(), "test_bucket")
+            result = lambda_handler(
+                {"continuation": paused["continuation"]},
+                {},
+                client,
+                Mock(),
+                "test_bucket",
+            )
+
+    assert paused["status"] == "in-progress"
+    assert result is None
+    assert read.call_args_list[1].args[0] == event["filepaths"][1:]
+    assert [call.args[1] for call in load.call_args_list] == tables
+
+
+def granted_s3_actions(role, bucket):
+    """
+    Reads terraform/iam.tf and returns the S3 actions role is granted on bucket and on
+    bucket's objects, as {"bucket": set, "objects": set}.
+    """
+    with open(
+        os.path.join(os.path.dirname(__file__), "..", "terraform", "iam.tf")
+    ) as f:
+        terraform = f.read()
+    blocks = {
+        (kind, name): body
+        for kind, name, body in re.findall(
+            r'^(?:data|resource) "(\w+)" "(\w+)" \{(.*?)^\}', terraform, re.S | re.M
+        )
+    }
+    arn = f"aws_s3_bucket.{bucket}.arn"
+    granted = {"bucket": set(), "objects": set()}
+    for (kind, name), body in blocks.items():
+        if (
+            kind != "aws_iam_policy_attachment"
+            or f"aws_iam_role.{role}.name" not in body
+        ):
+            continue
+        policy = re.search(r"aws_iam_policy\.(\w+)\.arn", body).group(1)
+        document = re.search(
+            r"aws_iam_policy_document\.(\w+)\.json",
+            blocks[("aws_iam_policy", policy)],
+        ).group(1)
+        statements = blocks[("aws_iam_policy_document", document)].split("statement")
+        for statement in statements:
+            actions = re.findall(r'"(s3:\w+)"', statement)
+            resources = re.search(r"resources\s*=\s*\[(.*?)\]", statement, re.S)
+            if not resources:
+                continue
+            if f'"${{{arn}}}/*"' in resources.group(1):
+                granted["objects"].update(actions)
+            elif arn in resources.group(1):
+                granted["bucket"].update(actions)
+    return granted
+
+
+def test_continuation_calls_are_granted_to_the_load_and_transform_roles(
+    aws_credentials,
+):
+    tables = ["dim_counterparty", "dim_currency"]
+    event = {"filepaths": [f"run/{table}.parquet" for table in tables]}
+    short = Mock(get_remaining_time_in_millis=Mock(return_value=1000))
+    calls = []
+    with mock_aws():
+        client = boto3.client("s3", region_name="eu-west-2")
+        client.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        client.meta.events.register(
+            "before-call.s3",
+            lambda model, params, **kwargs: calls.append(model.name),
+        )
+        with patch("src.load_lambda.read_parquet") as read, patch(
+            "src.load_lambda.load_df_to_warehouse"
+        ):
+            read.side_effect = lambda paths, *args: {
+                path.split("/")[-1].split(".")[0]: Mock() for path in paths
+            }
+            paused = lambda_handler(event, short, client, Mock(), "test_bucket")
+            lambda_handler(
+                {"continuation": paused["continuation"]},
+                {},
+                client,
+                Mock(),
+                "test_bucket",
+            )
+
+    assert "DeleteObject" in calls
+    for role in ["load_lambda_iam_role", "transform_lambda_iam_role"]:
+        granted = granted_s3_actions(role, "transform_bucket")
+        for call in set(calls) - {"CreateBucket"}:
+            assert f"s3:{call}" in granted["objects"], (role, call)
+
+
+# S3 API call -> the IAM action that authorises it, where the names differ
+S3_CALL_ACTIONS = {
+    "CreateMultipartUpload": "s3:PutObject",
+    "UploadPart": "s3:PutObject",
+    "CompleteMultipartUpload": "s3:PutObject",
+}
+
+
+def test_failed_multipart_upload_abort_is_granted_to_the_extract_role(aws_credentials):
+    calls = []
+    with mock_aws():
+        client = boto3.client("s3", region_name="eu-west-2")
+        client.create_bucket(
+            Bucket="test_bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        client.meta.events.register(
+            "before-call.s3",
+            lambda model, params, **kwargs: calls.append(model.name),
+        )
+        writer = S3MultipartWriter(client, "test_bucket", "big", part_size=5 * 1024**2)
+        writer.write(b"x" * 5 * 1024**2)
+        writer.abort()
+
+    assert "AbortMultipartUpload" in calls
+    granted = granted_s3_actions("extract_lambda_iam_role", "extract_bucket")
+    for call in set(calls) - {"CreateBucket"}:
+        assert S3_CALL_ACTIONS.get(call, f"s3:{call}") in granted["objects"], call
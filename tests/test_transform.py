@@ -4,6 +4,7 @@ from src.transform_lambda import (
     transform_design,
     get_currency_name,
     transform_currency,
+    CURRENCY_NAMES,
     transform_counterparty,
     transform_fact_sales_order,
     generate_date_table,
@@ -12,14 +13,20 @@ from src.transform_lambda import (
     read,
     write,
     lambda_handler,
+    decode_extract,
+    decode_columnar,
+    get_s3_client,
 )
+import gzip
 import pandas as pd
+import pyarrow as pa
 import pytest
 from moto import mock_aws
 import boto3
 import json
 import logging
-from unittest.mock import Mock
+import threading
+from unittest.mock import Mock, patch
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
@@ -190,6 +197,93 @@ class TestTransformRead:
             for record in caplog.records
         )
 
+    def test_read_decodes_compressed_ndjson_from_metadata(self, mock_s3_client_read):
+        """Objects tagged as ndjson.gz are decompressed and parsed line by line."""
+        client, bucket_name, time = mock_s3_client_read
+        file_path = f"data/by_time/2025/03-March/04/{time}/design"
+        lines = b'{"design_id": 1}\n{"design_id": 2}\n'
+        client.put_object(
+            Bucket=bucket_name,
+            Key=file_path,
+            Body=gzip.compress(lines),
+            Metadata={"extract-format": "ndjson.gz"},
+        )
+
+        loaded_files = read([file_path], client, bucket_name)
+
+        assert loaded_files["design"] == [{"design_id": 1}, {"design_id": 2}]
+
+    def test_read_concatenates_parts(self, mock_s3_client_read):
+        client, bucket_name, time = mock_s3_client_read
+        file_path = f"data/by_time/2025/03-March/04/{time}/design"
+        upload_mock_file(
+            client, bucket_name, f"{file_path}/part-00001", [{"design_id": 1}]
+        )
+        upload_mock_file(
+            client, bucket_name, f"{file_path}/part-00002", [{"design_id": 2}]
+        )
+
+        loaded_files = read(
+            [f"{file_path}/part-00001", f"{file_path}/part-00002"], client, bucket_name
+        )
+
+        assert loaded_files == {"design": [{"design_id": 1}, {"design_id": 2}]}
+
+    def test_read_fetches_concurrently_and_keeps_part_order(self):
+        # both requests have to be in flight at once to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        client = Mock()
+
+        def get_object(Bucket, Key):
+            barrier.wait()
+            body = json.dumps([{"design_id": int(Key[-1])}]).encode()
+            return {"Body": Mock(read=Mock(return_value=body))}
+
+        client.get_object.side_effect = get_object
+
+        loaded_files = read(
+            ["design/part-00002", "design/part-00001"], client, "bucket"
+        )
+
+        assert loaded_files == {"design": [{"design_id": 2}, {"design_id": 1}]}
+
+    def test_read_raises_errors_other_than_missing_key(self, caplog):
+        client = Mock()
+        client.get_object.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied", "Message": ""}}, "GetObject"
+        )
+
+        with pytest.raises(ClientError):
+            read(["design"], client, "bucket")
+        assert "Couldn't read design" in caplog.text
+
+    def test_s3_client_is_shared_with_a_pool_per_worker(self):
+        client = get_s3_client(4)
+
+        assert get_s3_client(4) is client
+        assert client.meta.config.max_pool_connections == 4
+
+    def test_decode_extract_empty_ndjson(self):
+        assert decode_extract(gzip.compress(b""), "ndjson.gz") == []
+
+    def test_decode_extract_copy_csv_restores_types(self):
+        body = gzip.compress(
+            b'"currency_id","currency_code","rate","active"\n'
+            b'"1","GBP","1.25","t"\n'
+            b'"2","",\\N,\\N\n'
+        )
+
+        rows = decode_extract(body, "csv.gz", "23,1043,1700,16")
+
+        assert rows == [
+            {"currency_id": 1, "currency_code": "GBP", "rate": 1.25, "active": True},
+            {"currency_id": 2, "currency_code": "", "rate": None, "active": None},
+        ]
+
+    def test_decode_extract_unknown_format(self):
+        with pytest.raises(ValueError):
+            decode_extract(b"", "xml")
+
     def test_read_raises_error(self, mock_s3_client_read):
         client, bucket_name, _ = mock_s3_client_read
 
@@ -205,6 +299,82 @@ class TestTransformRead:
         assert exc_info.value.response["Error"]["Code"] == "NoSuchBucket"
 
 
+class TestColumnarRead:
+    sales_order = [
+        {
+            "sales_order_id": order_id,
+            "created_at": f"2024-01-0{order_id} 14:30:00.000000",
+            "last_updated": "2024-02-01 16:45:00.125000",
+            "design_id": 101,
+            "staff_id": 201,
+            "counterparty_id": 301,
+            "units_sold": 10 * order_id,
+            "unit_price": 2.5,
+            "currency_id": 1,
+            "agreed_delivery_date": "2024-03-01",
+            "agreed_payment_date": "2024-03-15" if order_id == 2 else None,
+            "agreed_delivery_location_id": 401,
+        }
+        for order_id in (2, 1)
+    ]
+
+    def ndjson(self, rows):
+        return gzip.compress(b"".join(json.dumps(row).encode() + b"\n" for row in rows))
+
+    def test_ndjson_is_parsed_into_typed_columns(self):
+        table = decode_columnar(
+            self.ndjson(self.sales_order), "ndjson.gz", "sales_order"
+        )
+
+        assert table.column_names == list(self.sales_order[0])
+        assert table.schema.field("created_at").type == pa.timestamp("us")
+        assert table.schema.field("units_sold").type == pa.int64()
+        assert table.schema.field("agreed_payment_date").type == pa.string()
+        assert table.column("units_sold").to_pylist() == [20, 10]
+
+    def test_columns_missing_from_the_object_stay_missing(self):
+        rows = [{"design_id": 1, "design_name": "Wooden", "extra": "x"}]
+
+        table = decode_columnar(self.ndjson(rows), "ndjson.gz", "design")
+
+        assert table.column_names == ["design_id", "design_name", "extra"]
+        assert decode_columnar(gzip.compress(b""), "ndjson.gz", "design").num_rows == 0
+
+    def test_copy_csv_matches_the_schema(self):
+        body = gzip.compress(
+            b'"currency_id","currency_code","created_at"\n'
+            b'"1","GBP","2022-11-03 14:20:49.962"\n'
+            b'"2","",\\N\n'
+        )
+
+        table = decode_columnar(body, "csv.gz", "currency", "23,1043,1114")
+
+        assert table.column("currency_id").to_pylist() == [1, 2]
+        assert table.column("currency_code").to_pylist() == ["GBP", ""]
+        assert table.column("created_at").null_count == 1
+
+    def test_transform_output_matches_row_read(self, mock_s3_client_read):
+        client, bucket_name, time = mock_s3_client_read
+        file_path = f"data/by_time/2025/03-March/04/{time}/sales_order"
+        for number, row in enumerate(self.sales_order, 1):
+            client.put_object(
+                Bucket=bucket_name,
+                Key=f"{file_path}/part-0000{number}",
+                Body=self.ndjson([row]),
+                Metadata={"extract-format": "ndjson.gz"},
+            )
+        keys = [f"{file_path}/part-00001", f"{file_path}/part-00002"]
+
+        rows = read(keys, client, bucket_name)
+        columns = read(keys, client, bucket_name, columnar=True)
+
+        assert isinstance(columns["sales_order"], pd.DataFrame)
+        pd.testing.assert_frame_equal(
+            transform_fact_sales_order(columns["sales_order"]),
+            transform_fact_sales_order(rows["sales_order"]),
+        )
+
+
 class TestTransformWrite:
     @pytest.fixture
     def mock_s3_client_write(self):
@@ -324,6 +494,163 @@ class TestTransformWrite:
 
 
 class TestLambdaHandler:
+    def test_lambda_handler_passes_on_no_op(self):
+        client = Mock()
+
+        result = lambda_handler({"status": "no-op", "filepaths": []}, {}, client)
+
+        assert result == {"status": "no-op", "filepaths": []}
+        client.get_object.assert_not_called()
+        client.put_object.assert_not_called()
+
+    def test_lambda_handler_skips_when_manifest_is_all_empty(self):
+        client = Mock()
+        manifest = {
+            "run": "2025-03-11 12:07:07.196261",
+            "prefix": "data/by time/2025/03-March/11/12:07:07.196261",
+            "tables": {"design": {"key": "design", "row_count": 0}},
+        }
+
+        result = lambda_handler(
+            {"filepaths": ["design"], "manifest": manifest}, {}, client
+        )
+
+        assert result == {"status": "no-op", "filepaths": []}
+        client.get_object.assert_not_called()
+
+    def test_lambda_handler_follows_hive_layout(self):
+        with mock_aws():
+            client = boto3.client("s3", region_name="eu-west-2")
+            for bucket in ["extract-test-bucket", "transform-test-bucket"]:
+                client.create_bucket(
+                    Bucket=bucket,
+                    CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+                )
+            key = "data/table=design/dt=2025-03-11/run=20250311T120707.196261/design"
+            design = [
+                {
+                    "design_id": 10,
+                    "created_at": "2022-11-03 14:20:49.962000",
+                    "design_name": "Wooden",
+                    "file_location": "/usr",
+                    "file_name": "wooden-20220717-npgz.json",
+                    "last_updated": "2022-11-03 14:20:49.962000",
+                }
+            ]
+            client.put_object(
+                Bucket="extract-test-bucket", Key=key, Body=json.dumps(design)
+            )
+
+            result = lambda_handler(
+                {"filepaths": [key]},
+                {},
+                client,
+                extractbucketname="extract-test-bucket",
+                transformbucketname="transform-test-bucket",
+            )
+            index = client.get_object(
+                Bucket="transform-test-bucket",
+                Key="data/table=dim_design/dt=2025-03-11/_index.json",
+            )
+
+        assert (
+            "data/table=dim_design/dt=2025-03-11/run=20250311T120707.196261/dim_design.parquet"
+            in result["filepaths"]
+        )
+        assert json.loads(index["Body"].read())["runs"][0]["row_count"] == 1
+
+    def test_lambda_handler_continues_after_running_short_of_time(self):
+        with mock_aws():
+            client = boto3.client("s3", region_name="eu-west-2")
+            for bucket in ["extract-test-bucket", "transform-test-bucket"]:
+                client.create_bucket(
+                    Bucket=bucket,
+                    CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+                )
+            key = "data/table=design/dt=2025-03-11/run=20250311T120707.196261/design"
+            design = [
+                {
+                    "design_id": 10,
+                    "created_at": "2022-11-03 14:20:49.962000",
+                    "design_name": "Wooden",
+                    "file_location": "/usr",
+                    "file_name": "wooden-20220717-npgz.json",
+                    "last_updated": "2022-11-03 14:20:49.962000",
+                }
+            ]
+            client.put_object(
+                Bucket="extract-test-bucket", Key=key, Body=json.dumps(design)
+            )
+            buckets = {
+                "extractbucketname": "extract-test-bucket",
+                "transformbucketname": "transform-test-bucket",
+            }
+            short = Mock(get_remaining_time_in_millis=Mock(return_value=1000))
+
+            paused = lambda_handler({"filepaths": [key]}, short, client, **buckets)
+            state = json.loads(
+                client.get_object(
+                    Bucket="transform-test-bucket", Key=paused["continuation"]
+                )["Body"].read()
+            )
+            result = lambda_handler(
+                {"continuation": paused["continuation"]}, {}, client, **buckets
+            )
+            leftover = client.list_objects_v2(
+                Bucket="transform-test-bucket", Prefix="continuations/"
+            )
+
+        assert paused["status"] == "in-progress"
+        assert state["done"] == ["fact_sales_order"]
+        assert state["event"] == {"filepaths": [key]}
+        assert (
+            "data/table=dim_design/dt=2025-03-11/run=20250311T120707.196261/dim_design.parquet"
+            in result["filepaths"]
+        )
+        assert leftover["KeyCount"] == 0
+
+    def test_lambda_handler_fails_when_a_table_cannot_be_written(self):
+        with mock_aws():
+            client = boto3.client("s3", region_name="eu-west-2")
+            for bucket in ["extract-test-bucket", "transform-test-bucket"]:
+                client.create_bucket(
+                    Bucket=bucket,
+                    CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+                )
+            key = "data/table=design/dt=2025-03-11/run=20250311T120707.196261/design"
+            client.put_object(Bucket="extract-test-bucket", Key=key, Body="[]")
+            real_write = write
+
+            def failing_write(dataframe, client, filename, **kwargs):
+                if filename.endswith("/dim_design"):
+                    return None
+                return real_write(dataframe, client, filename, **kwargs)
+
+            with patch("src.transform_lambda.write", side_effect=failing_write):
+                with pytest.raises(RuntimeError, match="dim_design"):
+                    lambda_handler(
+                        {"filepaths": [key]},
+                        {},
+                        client,
+                        extractbucketname="extract-test-bucket",
+                        transformbucketname="transform-test-bucket",
+                    )
+            keys = [
+                obj["Key"]
+                for obj in client.list_objects_v2(Bucket="transform-test-bucket").get(
+                    "Contents", []
+                )
+            ]
+
+        assert not [key for key in keys if key.endswith("_manifest.json")]
+        assert not [key for key in keys if key.endswith("_index.json")]
+
+    def test_lambda_handler_skips_empty_extract(self):
+        client = Mock()
+
+        assert lambda_handler({"filepaths": []}, {}, client) == {"filepaths": []}
+        client.get_object.assert_not_called()
+
     def test_lambda_handler_success(self):
         """Test if lambda handler runs successfully with valid input."""
         with mock_aws():
@@ -937,6 +1264,17 @@ class TestGetCurrency:
         assert get_currency_name("usd") == "US Dollar"
         assert get_currency_name("eur") == "Euro"
 
+    def test_names_match_pycountry(self):
+        pycountry = pytest.importorskip("pycountry")
+        known = {currency.alpha_3: currency.name for currency in pycountry.currencies}
+
+        # codes added to or withdrawn from ISO 4217 since the table was built may differ
+        shared = set(CURRENCY_NAMES) & set(known)
+        assert len(shared) > 170
+        assert {code: CURRENCY_NAMES[code] for code in shared} == {
+            code: known[code] for code in shared
+        }
+
 
 class TestTransformCurrency:
     def test_transform_currency_empty_input(self):
@@ -981,6 +1319,21 @@ class TestTransformCurrency:
         assert "last_updated" not in result.columns
         assert not result.empty
 
+    def test_mixed_case_and_unknown_codes(self):
+        raw_data = [
+            {"currency_id": 1, "currency_code": "gbp"},
+            {"currency_id": 2, "currency_code": "XYZ"},
+            {"currency_id": 3, "currency_code": "Eur"},
+        ]
+
+        result = transform_currency(raw_data)
+
+        assert result.loc[[0, 2], "currency_name"].tolist() == [
+            "Pound Sterling",
+            "Euro",
+        ]
+        assert pd.isna(result.loc[1, "currency_name"])
+
     def test_transform_currency_no_currency_code(self):
         currency_data = [
             {
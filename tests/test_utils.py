@@ -1,10 +1,37 @@
-from src.utils import connect_to_database,get_db_credentials
+from src.utils import (
+    connect_to_database,
+    get_db_credentials,
+    get_connection,
+    close_connections,
+    close_on_sigterm,
+    invalidate_credentials,
+    is_auth_error,
+    partition_prefix,
+    partition_values,
+    run_id,
+    run_time,
+    update_partition_index,
+    combine_entries,
+    manifest_entry,
+    manifest_keys,
+    out_of_time,
+    save_continuation,
+    load_continuation,
+)
 import boto3
 import json
 from moto import mock_aws
 from unittest.mock import Mock, patch
 import pytest
 import logging
+import pg8000
+
+
+@pytest.fixture(autouse=True)
+def clear_credentials_cache():
+    invalidate_credentials()
+    yield
+    invalidate_credentials()
 
 
 @pytest.fixture
@@ -98,4 +125,234 @@ class TestConnectToDB:
                     connect_to_database("test-credentials", "eu-west-2")
                 
                 assert "ERROR! couldn't connect to database:" in caplog.text
-                assert "generic connection error" in str(exc_info.value)
\ No newline at end of file
+                assert "generic connection error" in str(exc_info.value)
+
+
+class TestGetConnection:
+    @pytest.fixture(autouse=True)
+    def empty_pool(self):
+        close_connections()
+        yield
+        close_connections()
+
+    @patch("pg8000.connect")
+    def test_live_connection_is_reused(self, mock_pg_connect, mock_secrets_manager):
+        first = get_connection("test-credentials", "eu-west-2")
+        second = get_connection("test-credentials", "eu-west-2")
+
+        assert first is second
+        mock_pg_connect.assert_called_once()
+        first.run.assert_called_with("SELECT 1")
+
+    @patch("pg8000.connect")
+    def test_sigterm_closes_the_pool(self, mock_pg_connect, mock_secrets_manager):
+        previous = Mock()
+        connection = get_connection("test-credentials", "eu-west-2")
+
+        close_on_sigterm(previous, 15, None)
+
+        connection.close.assert_called_once()
+        previous.assert_called_once_with(15, None)
+        with pytest.raises(SystemExit):
+            close_on_sigterm(None, 15, None)
+
+    @patch("pg8000.connect")
+    def test_stale_connection_is_replaced(self, mock_pg_connect, mock_secrets_manager):
+        stale, fresh = Mock(), Mock()
+        stale.run.side_effect = Exception("server closed the connection")
+        mock_pg_connect.side_effect = [stale, fresh]
+
+        get_connection("test-credentials", "eu-west-2")
+        connection = get_connection("test-credentials", "eu-west-2")
+
+        assert connection is fresh
+        stale.close.assert_called_once()
+
+    @patch("pg8000.connect")
+    def test_rotated_credentials_reconnect(self, mock_pg_connect, mock_secrets_manager):
+        old, new = Mock(), Mock()
+        mock_pg_connect.side_effect = [old, new]
+
+        get_connection("test-credentials", "eu-west-2")
+        mock_secrets_manager.put_secret_value(
+            SecretId="test-credentials",
+            SecretString=json.dumps(
+                {
+                    "user": "test-user",
+                    "password": "rotated-password",
+                    "host": "localhost",
+                    "port": "5432",
+                    "database": "test-db",
+                }
+            ),
+        )
+        invalidate_credentials("test-credentials")
+        connection = get_connection("test-credentials", "eu-west-2")
+
+        assert connection is new
+        old.close.assert_called_once()
+        assert mock_pg_connect.call_args[1]["password"] == "rotated-password"
+
+    @patch("pg8000.connect")
+    def test_close_connections(self, mock_pg_connect, mock_secrets_manager):
+        connection = get_connection("test-credentials", "eu-west-2")
+
+        close_connections()
+
+        connection.close.assert_called_once()
+
+
+class TestCredentialCache:
+    def test_secret_is_fetched_once_within_ttl(self, mock_secrets_manager):
+        with patch("src.utils.boto3.client", return_value=mock_secrets_manager) as client:
+            with patch.object(
+                mock_secrets_manager,
+                "get_secret_value",
+                wraps=mock_secrets_manager.get_secret_value,
+            ) as get_secret_value:
+                first = get_db_credentials("test-credentials")
+                second = get_db_credentials("test-credentials")
+
+        assert first == second
+        get_secret_value.assert_called_once()
+        client.assert_called_once()
+
+    def test_expired_secret_is_refetched(self, mock_secrets_manager):
+        get_db_credentials("test-credentials", ttl=0)
+        mock_secrets_manager.put_secret_value(
+            SecretId="test-credentials",
+            SecretString=json.dumps({"password": "rotated-password"}),
+        )
+
+        assert get_db_credentials("test-credentials")["password"] == "rotated-password"
+
+    @patch("pg8000.connect")
+    def test_auth_error_refreshes_cached_secret(self, mock_pg_connect, mock_secrets_manager):
+        get_db_credentials("test-credentials")
+        mock_secrets_manager.put_secret_value(
+            SecretId="test-credentials",
+            SecretString=json.dumps(
+                {
+                    "user": "test-user",
+                    "password": "rotated-password",
+                    "host": "localhost",
+                    "port": "5432",
+                    "database": "test-db",
+                }
+            ),
+        )
+        connection = Mock()
+        mock_pg_connect.side_effect = [
+            pg8000.dbapi.DatabaseError({"C": "28P01", "M": "password authentication failed"}),
+            connection,
+        ]
+
+        assert connect_to_database("test-credentials") is connection
+        assert mock_pg_connect.call_args[1]["password"] == "rotated-password"
+
+    @patch("pg8000.connect")
+    def test_other_errors_are_not_retried(self, mock_pg_connect, mock_secrets_manager):
+        mock_pg_connect.side_effect = Exception("could not connect to server")
+
+        with pytest.raises(Exception):
+            connect_to_database("test-credentials")
+
+        mock_pg_connect.assert_called_once()
+
+    def test_is_auth_error_unwraps_sqlalchemy_errors(self):
+        wrapped = Mock(orig=pg8000.dbapi.DatabaseError({"C": "28P01"}))
+
+        assert is_auth_error(wrapped)
+        assert not is_auth_error(Exception("connection refused"))
+
+
+class TestPartitionLayout:
+    run = "2025-03-07 22:17:13.872739"
+
+    def test_partition_prefix_sorts_by_table_date_and_run(self):
+        prefix = partition_prefix("sales_order", self.run)
+
+        assert prefix == "data/table=sales_order/dt=2025-03-07/run=20250307T221713.872739"
+        assert " " not in prefix and ":" not in prefix
+        assert partition_values(prefix) == {
+            "table": "sales_order",
+            "dt": "2025-03-07",
+            "run": "20250307T221713.872739",
+        }
+        assert run_time(run_id(self.run)) == self.run
+
+    def test_partition_index_lists_each_run_once(self):
+        with mock_aws():
+            s3 = boto3.client("s3", region_name="eu-west-2")
+            s3.create_bucket(
+                Bucket="test_bucket",
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+            later = "2025-03-07 23:00:00.000000"
+            for run, rows in [(later, 1), (self.run, 2), (self.run, 3)]:
+                key = f"{partition_prefix('design', run)}/design"
+                update_partition_index(
+                    s3, "test_bucket", run, {"design": {"key": key, "row_count": rows}}
+                )
+
+            index = json.loads(
+                s3.get_object(
+                    Bucket="test_bucket", Key="data/table=design/dt=2025-03-07/_index.json"
+                )["Body"].read()
+            )
+
+        assert index["table"] == "design"
+        assert [(r["run"], r["row_count"]) for r in index["runs"]] == [
+            ("20250307T221713.872739", 3),
+            ("20250307T230000.000000", 1),
+        ]
+
+
+class TestManifestParts:
+    def test_parts_are_read_as_one_table(self):
+        parts = [
+            manifest_entry("t/part-00001", 2, 10, "a", ["id"], ("2025-01-01", "2025-01-03")),
+            manifest_entry("t/part-00002", 0, 1, "b", ["id"]),
+            manifest_entry("t/part-00003", 1, 5, "c", ["id"], ("2025-01-02", "2025-01-04")),
+        ]
+        entry = combine_entries("t", parts)
+        manifest = {
+            "tables": {
+                "t": entry,
+                "empty": manifest_entry("empty", 0, 1, "d", ["id"]),
+                "single": manifest_entry("single", 1, 1, "e", ["id"]),
+            }
+        }
+
+        assert entry["row_count"] == 3
+        assert entry["byte_size"] == 16
+        assert (entry["min_last_updated"], entry["max_last_updated"]) == (
+            "2025-01-01",
+            "2025-01-04",
+        )
+        assert manifest_keys(manifest) == ["t/part-00001", "t/part-00003", "single"]
+
+
+class TestContinuation:
+    def test_out_of_time_only_near_the_timeout(self):
+        assert not out_of_time({})
+        assert not out_of_time(Mock(get_remaining_time_in_millis=Mock(return_value=600000)))
+        assert out_of_time(Mock(get_remaining_time_in_millis=Mock(return_value=5000)))
+        assert out_of_time(
+            Mock(get_remaining_time_in_millis=Mock(return_value=5000)), margin_ms=1000
+        ) is False
+
+    def test_state_round_trips_through_token(self):
+        with mock_aws():
+            s3 = boto3.client("s3", region_name="eu-west-2")
+            s3.create_bucket(
+                Bucket="test_bucket",
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+            state = {"event": {"filepaths": ["a"]}, "done": ["dim_staff"]}
+            token = save_continuation(
+                s3, "test_bucket", "transform", "2025-03-07 22:17:13.872739", state
+            )
+
+            assert token == "continuations/transform/2025-03-07T22:17:13.872739.json"
+            assert load_continuation(s3, "test_bucket", token) == state
@@ -0,0 +1,452 @@
+"""Encodes extracted rows in each of the EXTRACT_FORMATS and streams them to S3."""
+
+import hashlib
+import json
+import zlib
+from datetime import datetime
+from decimal import Decimal
+from functools import partial
+
+try:  # nosec  # noqa
+    import zstandard  # nosec  # noqa
+except ImportError:  # pragma: no cover
+    zstandard = None  # pragma: no cover
+
+try:  # nosec  # noqa
+    from src.extract_tables import TIMESTAMP_FORMAT  # nosec  # noqa
+except:  # nosec  # noqa
+    pass  # nosec # noqa
+
+try:  # nosec  # noqa
+    from extract_tables import TIMESTAMP_FORMAT  # nosec  # noqa
+except:  # nosec   # noqa
+    pass  # nosec  # noqa
+
+EXTRACT_FORMATS = ("json", "ndjson.gz", "ndjson.zst", "parquet")
+EXTRACT_FORMAT = "ndjson.gz"
+COPY_FORMAT = "csv.gz"
+
+# S3 needs at least 5 MiB for every part but the last
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# PostgreSQL type oid -> converter making the value JSON serialisable
+TYPE_CONVERTERS = {
+    1114: lambda value: value.isoformat(" ", "microseconds"),
+    1184: lambda value: value.strftime(TIMESTAMP_FORMAT),
+    1700: float,
+}
+
+
+def plan_converters(types, rows=()):
+    """
+    Works out once per table which columns need converting before they can go into JSON. # noqa
+
+    Columns are planned from their type oids where known. Without them each column is judged # noqa
+    by its first non-null value in `rows`, with the same rules as the type oids.
+
+    Args:
+        types (list): PostgreSQL type oids in column order, or None.
+        rows (list, optional): Rows to sample when `types` is None.
+
+    Returns:
+        list: (column position, converter) pairs for only the columns that need converting. # noqa
+    """
+    if types is not None:
+        return [
+            (i, TYPE_CONVERTERS[oid])
+            for i, oid in enumerate(types)
+            if oid in TYPE_CONVERTERS
+        ]
+    converters = []
+    for i in range(len(rows[0]) if rows else 0):
+        sample = next((row[i] for row in rows if row[i] is not None), None)
+        if isinstance(sample, datetime):
+            converters.append(
+                (i, TYPE_CONVERTERS[1114 if sample.tzinfo is None else 1184])
+            )
+        elif isinstance(sample, Decimal):
+            converters.append((i, float))
+    return converters
+
+
+def format_rows(columns, rows, converters):
+    """
+    Applies a plan from plan_converters to `rows` and zips them with their column names.
+
+    Args:
+        columns (list): The column names, in row order.
+        rows (list): Rows of raw database values.
+        converters (list): (column position, converter) pairs.
+
+    Returns:
+        list: The rows as JSON serialisable dictionaries.
+    """
+    if not converters:
+        return [dict(zip(columns, row)) for row in rows]
+    records = []
+    for row in rows:
+        row = list(row)
+        for i, convert in converters:
+            if row[i] is not None:
+                row[i] = convert(row[i])
+        records.append(dict(zip(columns, row)))
+    return records
+
+
+ENCODER_CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson.gz": "application/x-ndjson",
+    "ndjson.zst": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    COPY_FORMAT: "text/csv",
+}
+
+
+def make_encoder(extract_format, columns, types=None, modifiers=None):
+    """
+    Returns an encoder that serializes rows of a table in `extract_format`.
+
+    Encoders are incremental: encode() may be called once per chunk of rows and returns the # noqa
+    bytes for that chunk, and finish() returns whatever closes the object off.
+
+    Args:
+        extract_format (str): One of EXTRACT_FORMATS.
+        columns (list): The column names, in row order.
+        types (list, optional): PostgreSQL type oids of the columns, used to plan conversions. # noqa
+        modifiers (list, optional): PostgreSQL type modifiers of the columns, for the precision of parquet decimals. # noqa
+
+    Returns:
+        object: An encoder with encode(rows), finish() and content_type.
+    """
+    if extract_format == "json":
+        return JsonArrayEncoder(columns, types)
+    if extract_format == "ndjson.gz":
+        return NdjsonEncoder(columns, gzip_compressor(), types)
+    if extract_format == "ndjson.zst":
+        if zstandard is None:
+            raise ValueError("ndjson.zst needs the zstandard package")
+        return NdjsonEncoder(columns, zstandard.ZstdCompressor().compressobj(), types)
+    if extract_format == "parquet":
+        return ParquetEncoder(columns, types, modifiers)
+    raise ValueError(f"Unknown extract format: {extract_format}")
+
+
+def gzip_compressor():
+    """Returns a streaming compressor that produces a gzip file."""
+    # wbits of 16 + MAX_WBITS gives a gzip container rather than raw zlib
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class JsonRowsEncoder:
+    """
+    Base for the JSON encoders: formats rows with a conversion plan made on the first chunk. # noqa
+    """
+
+    def __init__(self, columns, types=None):
+        self.columns = columns
+        self.types = types
+        self.converters = None if types is None else plan_converters(types)
+
+    def records(self, rows):
+        if self.converters is None and rows:
+            self.converters = plan_converters(None, rows)
+        return format_rows(self.columns, rows, self.converters)
+
+
+class JsonArrayEncoder(JsonRowsEncoder):
+    """Encodes rows as one compact JSON array of objects, the original extract format."""
+
+    content_type = ENCODER_CONTENT_TYPES["json"]
+
+    def __init__(self, columns, types=None):
+        super().__init__(columns, types)
+        self.started = False
+
+    def encode(self, rows):
+        if not rows:
+            return b""
+        # one dumps call per chunk; strip its brackets so chunks can be joined
+        chunk = json.dumps(self.records(rows))[1:-1]
+        prefix = "," if self.started else "["
+        self.started = True
+        return (prefix + chunk).encode("utf-8")
+
+    def finish(self):
+        return b"]" if self.started else b"[]"
+
+
+class NdjsonEncoder(JsonRowsEncoder):
+    """Encodes rows as newline-delimited JSON objects fed through a streaming compressor."""
+
+    content_type = ENCODER_CONTENT_TYPES["ndjson.gz"]
+
+    def __init__(self, columns, compressor, types=None):
+        super().__init__(columns, types)
+        self.compressor = compressor
+
+    def encode(self, rows):
+        dumps = json.JSONEncoder().encode
+        lines = "".join(dumps(record) + "\n" for record in self.records(rows))
+        return self.compressor.compress(lines.encode("utf-8"))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# PostgreSQL type oid -> pyarrow type name; anything else is left to pyarrow to infer
+PARQUET_TYPES = {
+    16: "bool_",
+    20: "int64",
+    21: "int16",
+    23: "int32",
+    25: "string",
+    700: "float32",
+    701: "float64",
+    1043: "string",
+    1082: "date32",
+    1114: "timestamp",
+    1184: "timestamp",
+    1700: "decimal",
+}
+
+
+class ParquetEncoder:
+    """
+    Encodes rows as one Parquet file, one row group per chunk, keeping the database types. # noqa
+
+    The schema is built from the column type oids where known so every chunk is written with # noqa
+    the same types; columns of unknown type are inferred from the first chunk. NUMERIC columns # noqa
+    take their precision and scale from the type modifier (see numeric_arrow_type).
+    """
+
+    content_type = ENCODER_CONTENT_TYPES["parquet"]
+
+    def __init__(self, columns, types=None, modifiers=None):
+        import pyarrow  # noqa
+
+        self.pa = pyarrow
+        self.columns = columns
+        self.types = types
+        self.modifiers = modifiers
+        self.sink = _PositionedSink()
+        self.writer = None
+        self.schema = None
+        self.as_text = set()
+
+    def _arrow_type(self, oid, modifier=None):
+        name = PARQUET_TYPES.get(oid)
+        if name == "timestamp":
+            return self.pa.timestamp("us", tz="UTC" if oid == 1184 else None)
+        if name == "decimal":
+            return numeric_arrow_type(modifier)
+        return getattr(self.pa, name)() if name else None
+
+    def encode(self, rows):
+        import pyarrow.parquet  # noqa
+
+        values = list(zip(*rows)) if rows else [[] for _ in self.columns]
+        if self.schema is None:
+            types = self.types or [None] * len(self.columns)
+            modifiers = self.modifiers or [None] * len(self.columns)
+            fields = []
+            for position, (name, oid, modifier, column) in enumerate(
+                zip(self.columns, types, modifiers, values)
+            ):
+                arrow_type = self._arrow_type(oid, modifier)
+                if arrow_type is None:
+                    arrow_type = self.pa.array(column).type
+                elif (
+                    PARQUET_TYPES.get(oid) == "decimal"
+                    and arrow_type == self.pa.string()
+                ):
+                    self.as_text.add(position)
+                fields.append(self.pa.field(name, arrow_type))
+            self.schema = self.pa.schema(fields)
+            self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+        arrays = [
+            self.pa.array(
+                (
+                    [None if value is None else str(value) for value in column]
+                    if position in self.as_text
+                    else column
+                ),
+                type=field.type,
+            )
+            for position, (column, field) in enumerate(zip(values, self.schema))
+        ]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        return self.sink.drain()
+
+    def finish(self):
+        if self.writer is None:
+            self.encode([])
+        self.writer.close()
+        return self.sink.drain()
+
+
+def numeric_arrow_type(modifier):
+    """
+    Returns the Arrow type for a NUMERIC column from its type modifier.
+
+    numeric(p, s) becomes a decimal of that precision and scale. An unconstrained numeric (a # noqa
+    modifier of -1, or None when it isn't known) can hold any scale, so it is kept exactly as # noqa
+    a string rather than rounded into a fixed one.
+    """
+    import pyarrow  # noqa
+
+    if modifier is None or modifier < 4:
+        return pyarrow.string()
+    precision = ((modifier - 4) >> 16) & 0xFFFF
+    scale = (modifier - 4) & 0xFFFF
+    if not 0 <= scale <= precision:
+        # a negative scale (PostgreSQL 15+) has no Arrow decimal equivalent
+        return pyarrow.string()
+    if precision <= 38:
+        return pyarrow.decimal128(precision, scale)
+    if precision <= 76:
+        return pyarrow.decimal256(precision, scale)
+    return pyarrow.string()
+
+
+class _PositionedSink:
+    """Write-only file object that hands back what was written since the last drain()."""
+
+    closed = False
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        return data
+
+
+class S3MultipartWriter:
+    """
+    File-like sink that uploads whatever is written to it as an S3 multipart upload.
+
+    Bytes are buffered until at least `part_size` is available and then sent as one part. # noqa
+    Objects that never fill a single part are sent with a plain put_object on close.
+    Given an `uploader` executor, each part is sent in the background while the caller keeps # noqa
+    writing; at most one part is in flight, so memory stays bounded to two parts.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucketname,
+        key,
+        content_type="application/json",
+        part_size=MULTIPART_PART_SIZE,
+        uploader=None,
+        metadata=None,
+    ):
+        self.s3_client = s3_client
+        self.bucketname = bucketname
+        self.key = key
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self.part_size = part_size
+        self.uploader = uploader
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.in_flight = None
+        self.bytes_written = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        """Buffers `data` and uploads a part whenever the buffer reaches `part_size`."""
+        self.buffer += data
+        self.bytes_written += len(data)
+        self.sha256.update(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def checksum(self):
+        """Hex sha256 of everything written so far."""
+        return self.sha256.hexdigest()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucketname,
+                Key=self.key,
+                ContentType=self.content_type,
+                Metadata=self.metadata,
+            )
+            self.upload_id = response["UploadId"]
+        self._wait()
+        part_number = len(self.parts) + 1
+        send = partial(
+            self.s3_client.upload_part,
+            Bucket=self.bucketname,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+        self.buffer = bytearray()
+        if self.uploader is None:
+            self.parts.append({"ETag": send()["ETag"], "PartNumber": part_number})
+        else:
+            self.in_flight = (part_number, self.uploader.submit(send))
+
+    def _wait(self):
+        if self.in_flight is not None:
+            part_number, future = self.in_flight
+            self.in_flight = None
+            self.parts.append(
+                {"ETag": future.result()["ETag"], "PartNumber": part_number}
+            )
+
+    def close(self):
+        """Uploads any remaining bytes and completes the upload."""
+        if self.upload_id is None:
+            self.s3_client.put_object(
+                Bucket=self.bucketname,
+                Key=self.key,
+                Body=bytes(self.buffer),
+                ContentType=self.content_type,
+                Metadata=self.metadata,
+            )
+            self.buffer = bytearray()
+            return
+        if self.buffer:
+            self._upload_part()
+        self._wait()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucketname,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        """Abandons the upload so no partial object or orphaned parts are left behind."""
+        self.buffer = bytearray()
+        if self.in_flight is not None:
+            self.in_flight[1].cancel()
+            self.in_flight = None
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucketname, Key=self.key, UploadId=self.upload_id
+            )
+            self.upload_id = None